@@ -0,0 +1,77 @@
+import logging
+from typing import Optional, List, Dict, Tuple
+from core import DataClient, OrderManager
+from PairTrade import PairTrade, SIGNAL_DOWNSAMPLE
+
+
+class BasketTrade(PairTrade):
+    """PairTrade on the spread of a Johansen basket, weights . mid prices - const.
+
+    The bands, %b and signal logic are the ones of PairTrade. Long the spread holds every leg in the direction
+    of its weight, and the legs are sized so the gross notional of the basket is the capital.
+    """
+
+    def __init__(self,
+                 dataclient: DataClient,
+                 ordermanager: OrderManager,
+                 assets: List[str],
+                 weights: List[float],
+                 capital: Optional[float] = None,
+                 downsample: Optional[int] = None,
+                 const: float = 0.0,
+                 k: int = 2,
+                 signal_mode: str = SIGNAL_DOWNSAMPLE,
+                 half_life: Optional[float] = None):
+        assert len(assets) == len(weights) and len(assets) >= 2, "a basket needs one weight per asset and at least two assets"
+        super().__init__(dataclient=dataclient, ordermanager=ordermanager, asset1=assets[0], asset2=assets[-1], capital=capital, downsample=downsample,
+                         hedge_ratio=1.0, const=const, k=k, signal_mode=signal_mode, half_life=half_life)
+        self._assets : List[str] = list(assets)
+        self._weights : List[float] = list(weights)
+        self._max_positions_by_asset : Dict[str, Optional[float]] = {asset: None for asset in self._assets}
+
+    def get_name(self) -> str:
+        return "-".join(self._assets)
+
+    def get_symbols(self) -> List[str]:
+        return list(self._assets)
+
+    def get_state(self) -> dict:
+        state = super().get_state()
+        state["max positions"] = dict(self._max_positions_by_asset)
+        return state
+
+    def restore_state(self, state: dict) -> None:
+        super().restore_state(state)
+        self._max_positions_by_asset.update(state.get("max positions", {}))
+
+    def _spread(self, *mid_prices: float) -> float:
+        return sum(weight * mid_price for weight, mid_price in zip(self._weights, mid_prices)) - self._const
+
+    def _sample(self) -> Optional[Tuple[float, tuple]]:
+        mid_prices = tuple(self._dataclient.get_last_mid_price(asset) for asset in self._assets)
+        if any(mid_price is None for mid_price in mid_prices):
+            return None
+        return self._spread(*mid_prices), mid_prices
+
+    async def _calculate_max_position(self) -> None:
+        mid_prices = [self._dataclient.get_last_mid_price(asset) for asset in self._assets]
+        if any(mid_price is None for mid_price in mid_prices):
+            return
+        gross_per_unit = sum(abs(weight) * mid_price for weight, mid_price in zip(self._weights, mid_prices))
+        units = self._capital / gross_per_unit
+        for asset, weight in zip(self._assets, self._weights):
+            self._max_positions_by_asset[asset] = round(units * weight)  # Signed, the direction of the leg when long the spread
+        self._asset1_max_position = self._max_positions_by_asset[self._asset1]
+        self._asset2_max_position = self._max_positions_by_asset[self._asset2]
+
+    def _max_positions(self) -> Dict[str, Optional[float]]:
+        return dict(self._max_positions_by_asset)
+
+    def _target_positions(self) -> Dict[str, float]:
+        """Long the spread (signal -1) holds the signed leg sizes, short the spread their opposite."""
+        if self._signal in (-1, 1):
+            return {asset: - self._signal * max_position for asset, max_position in self._max_positions_by_asset.items()}
+        return {asset: 0 for asset in self._assets}
+
+    async def reparameterize(self, *args, **kwargs) -> None:
+        logging.warning(f"Basket {self.get_name()} keeps its weights until the next restart")
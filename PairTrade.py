@@ -1,10 +1,15 @@
+import math
 import asyncio
 import logging 
 import numpy as np
-from typing import Optional 
+from typing import Optional, List, Dict, Tuple
 from collections import deque
-from core import DataClient, OrderManager, Client
+from core import DataClient, OrderManager, Client, TimeSource
 from core import ORDER_TYPE_IOC, ORDER_TYPE_GTC, SIDE_BUY, SIDE_SELL
+from hedge import OnlineHedgeRatio
+
+SIGNAL_DOWNSAMPLE = "downsample"  # Rolling bands over the spread sampled every downsample seconds
+SIGNAL_EWMA = "ewma"  # Exponentially weighted bands updated on every quote
 
 class PairTrade:
 
@@ -17,7 +22,11 @@ class PairTrade:
                 downsample : Optional[int] = None,
                 hedge_ratio : Optional[float] = None,
                 const : Optional[float] = None,
-                k : int = 2):
+                k : int = 2,
+                hedge_estimator : Optional[OnlineHedgeRatio] = None,
+                hedge_index : int = 0,
+                signal_mode : str = SIGNAL_DOWNSAMPLE,
+                half_life : Optional[float] = None):
         self._dataclient: DataClient = dataclient
         self._ordermanager: OrderManager = ordermanager
         self._asset1 : Optional[str] = asset1
@@ -31,11 +40,148 @@ class PairTrade:
         self._k : int = k
         self._length_of_spread : int = int(1200 / self._downsample) 
         self._spread_list : deque = deque(maxlen=self._length_of_spread)
+        self._mid_price_list : deque = deque(maxlen=self._length_of_spread)  # (asset 1, asset 2) behind each spread, to recompute the window on new parameters
         self._spread_position : int = 0 
         self._pertb_list : deque = deque(maxlen= 2)
         self._signal : Optional[int] = None 
         self._order_type : str = ORDER_TYPE_IOC if self._downsample <= 5 else ORDER_TYPE_GTC
+        self._pending_order_ids : list = []
+        self._hedge_estimator : Optional[OnlineHedgeRatio] = hedge_estimator  # None trades the fixed hedge ratio and constant
+        self._hedge_index : int = hedge_index
+        self._signal_mode : str = signal_mode
+        self._ewma_decay : Optional[float] = None  # Per second, from the half life in downsampled samples
+        self._ewma_warmup : Optional[float] = None
+        if self._signal_mode == SIGNAL_EWMA:
+            assert half_life is not None and half_life > 0, "half_life is required for the ewma signal mode"
+            half_life_seconds = half_life * self._downsample
+            self._ewma_decay = math.log(2) / half_life_seconds
+            self._ewma_warmup = 3 * half_life_seconds
+        self._ewma_mean : Optional[float] = None
+        self._ewma_var : float = 0.0
+        self._ewma_time : Optional[float] = None
+        self._ewma_start : Optional[float] = None
+        self._window_time : Optional[float] = None  # Last sample of the spread window in the ewma signal mode, one per downsample seconds
+        self._signal_event : asyncio.Event = asyncio.Event()
+        self._stale_max_position : bool = False  # Parameters changed while in a position, size again on the next entry
+        self._retiring : bool = False
+
+    def get_name(self) -> str:
+        return f"{self._asset1}-{self._asset2}"
+
+    def get_symbols(self) -> List[str]:
+        return [self._asset1, self._asset2]
+
+    def get_state(self) -> dict:
+        state = {"asset 1": self._asset1,
+                 "asset 2": self._asset2,
+                 "asset 1 max position": self._asset1_max_position,
+                 "asset 2 max position": self._asset2_max_position,
+                 "spread list": list(self._spread_list),
+                 "mid price list": list(self._mid_price_list),
+                 "pertb list": list(self._pertb_list),
+                 "spread position": self._spread_position,
+                 "signal": self._signal,
+                 "pending order ids": list(self._pending_order_ids)}
+        if self._hedge_estimator is not None:
+            state["hedge estimator"] = self._hedge_estimator.get_state(self._hedge_index)
+        if self._ewma_mean is not None:
+            state["ewma mean"] = self._ewma_mean
+            state["ewma var"] = self._ewma_var
+        return state
+
+    def get_metrics(self) -> dict:
+        """Current spread, %b, spread position and hedge ratio, for the metrics endpoint."""
+        return {"spread": self._spread_list[-1] if self._spread_list else None,
+                "pertb": self._pertb_list[-1] if self._pertb_list else None,
+                "spread position": self._spread_position,
+                "hedge ratio": self._hedge_ratio,
+                "spread points": len(self._spread_list)}
+
+    def restore_state(self, state: dict) -> None:
+        self._asset1_max_position = state["asset 1 max position"]
+        self._asset2_max_position = state["asset 2 max position"]
+        self._spread_list.extend(state["spread list"])
+        self._mid_price_list.extend(tuple(mid_prices) for mid_prices in state.get("mid price list", []))
+        self._pertb_list.extend(state["pertb list"])
+        self._spread_position = state["spread position"]
+        self._signal = state["signal"]
+        self._pending_order_ids = list(state["pending order ids"])
+        if (self._hedge_estimator is not None) and ("hedge estimator" in state):
+            self._hedge_estimator.restore_state(self._hedge_index, state["hedge estimator"])
+            self._hedge_ratio, self._const = self._hedge_estimator.get_estimate(self._hedge_index)
+        if (self._signal_mode == SIGNAL_EWMA) and ("ewma mean" in state):
+            self._ewma_mean = state["ewma mean"]
+            self._ewma_var = state["ewma var"]
+            self._ewma_time = TimeSource.monotonic()
+            self._ewma_start = self._ewma_time - self._ewma_warmup  # Already warm
+        logging.info(f"Restored {self.get_name()} pair with {len(self._spread_list)} spread data points and spread position {self._spread_position}")
     
+    async def reparameterize(self,
+                             hedge_ratio: float,
+                             const: float,
+                             capital: Optional[float] = None,
+                             half_life: Optional[float] = None,
+                             hedge_estimator: Optional[OnlineHedgeRatio] = None,
+                             hedge_index: int = 0) -> None:
+        """New parameters for a pair that stays in the params file.
+
+        The spread window is recomputed from the stored mid prices, so the bands stay warm. A new hedge estimator
+        is fed the stored mid prices first. The position is kept, it is sized with the new parameters on the next entry.
+        """
+        self._hedge_ratio = hedge_ratio
+        self._const = const
+        if capital is not None:
+            self._capital = capital
+        self._hedge_estimator = hedge_estimator
+        self._hedge_index = hedge_index
+        self._spread_list.clear()
+        for mid_prices in self._mid_price_list:
+            self._spread_list.append(self._spread(*mid_prices))
+        self._pertb_list.clear()
+        if self._signal_mode == SIGNAL_EWMA:
+            if half_life is not None and half_life > 0:
+                half_life_seconds = half_life * self._downsample
+                self._ewma_decay = math.log(2) / half_life_seconds
+                self._ewma_warmup = 3 * half_life_seconds
+            self._seed_ewma()
+        if self._spread_position == 0:
+            await self._calculate_max_position()
+        else:
+            self._stale_max_position = True
+        logging.info(f"Reparameterized {self.get_name()} pair: hedge ratio {self._hedge_ratio}, constant {self._const}, "
+                     f"{len(self._spread_list)} spread data points recomputed")
+
+    def _seed_ewma(self) -> None:
+        """Runs the ewma over the spread window, one sample per downsample seconds, so the bands stay warm on new parameters."""
+        self._ewma_mean = None
+        self._ewma_var = 0.0
+        if len(self._spread_list) == 0:
+            return
+        alpha = 1 - math.exp(-self._downsample * self._ewma_decay)
+        for spread in self._spread_list:
+            if self._ewma_mean is None:
+                self._ewma_mean = spread
+            else:
+                diff = spread - self._ewma_mean
+                self._ewma_mean += alpha * diff
+                self._ewma_var = (1 - alpha) * (self._ewma_var + alpha * diff * diff)
+        self._ewma_time = TimeSource.monotonic()
+        self._ewma_start = self._ewma_time - self._downsample * (len(self._spread_list) - 1)  # The window counts towards the warm-up
+
+    def retire(self) -> None:
+        """Stops new entries. _trader closes the position of the pair and returns once both legs are flat."""
+        self._retiring = True
+        self._spread_position = 0
+        self._signal = 0
+        if self._signal_mode == SIGNAL_EWMA:
+            for symbol in self.get_symbols():
+                self._dataclient.remove_quote_listener(symbol, self._on_quote)
+        self._signal_event.set()
+        logging.info(f"Retire {self.get_name()} pair")
+
+    def is_retiring(self) -> bool:
+        return self._retiring
+
     async def _calculate_max_position(self) -> None: ## TODO tiny hedge ratio issue 
         mid_price_asset1 = self._dataclient.get_last_mid_price(self._asset1)
         mid_price_asset2 = self._dataclient.get_last_mid_price(self._asset2)
@@ -47,22 +193,40 @@ class PairTrade:
         else:
             pass
 
-    def _calculate_spread(self) -> None:
+    def _spread(self, mid_price_asset1: float, mid_price_asset2: float, update: bool = True) -> float:
+        """update False leaves the hedge estimator alone, it is fed once per downsample sample so its memory stays in samples."""
+        if self._hedge_estimator is not None:
+            if update:
+                spread = self._hedge_estimator.update_one(self._hedge_index, mid_price_asset1, mid_price_asset2)  # Spread under the prior estimate
+                self._hedge_ratio, self._const = self._hedge_estimator.get_estimate(self._hedge_index)
+                return spread
+            self._hedge_ratio, self._const = self._hedge_estimator.get_estimate(self._hedge_index)
+        return mid_price_asset2 - (self._hedge_ratio * mid_price_asset1 + self._const)
+
+    def _sample(self, update: bool = True) -> Optional[Tuple[float, tuple]]:
+        """Spread and the mid prices of the legs it is computed from, None until every leg has a mid price."""
         mid_price_asset1 = self._dataclient.get_last_mid_price(self._asset1)
         mid_price_asset2 = self._dataclient.get_last_mid_price(self._asset2)
-        if (mid_price_asset1 is not None) and (mid_price_asset2 is not None):
-            spread = mid_price_asset2 - (self._hedge_ratio * mid_price_asset1 + self._const)
+        if (mid_price_asset1 is None) or (mid_price_asset2 is None):
+            return None
+        return self._spread(mid_price_asset1, mid_price_asset2, update), (mid_price_asset1, mid_price_asset2)
+
+    def _calculate_spread(self) -> None:
+        sample = self._sample()
+        if sample is not None:
+            spread, mid_prices = sample
             self._spread_list.append(spread)
-            logging.info(f"spread of {self._asset1}-{self._asset2} is {spread}")
+            self._mid_price_list.append(mid_prices)
+            logging.info(f"spread of {self.get_name()} is {spread}")
         else:
             return
 
     def _calculate_pertb(self) -> None:
         if len(self._spread_list) < self._length_of_spread:
             len_spread_list = len(self._spread_list)
-            #logging.info(f"length of spread list of {self._asset1}-{self._asset2} is {len_spread_list}. Required length is {self._length_of_spread}")
+            #logging.info(f"length of spread list of {self.get_name()} is {len_spread_list}. Required length is {self._length_of_spread}")
             if len_spread_list % 10 == 0:
-                logging.info(f"fetching spread data for {self._asset1}-{self._asset2}. Number of data points is {len_spread_list}, requires {self._length_of_spread}")
+                logging.info(f"fetching spread data for {self.get_name()}. Number of data points is {len_spread_list}, requires {self._length_of_spread}")
             return
         else:
             spread_rolling_mean = np.mean(self._spread_list)
@@ -71,7 +235,7 @@ class PairTrade:
             lower_band = spread_rolling_mean - self._k * spread_rolling_std
             pertb = (self._spread_list[-1] - lower_band) / (upper_band - lower_band) ##TODO try backtest signal (self._spread_list[-1] - spread_rolling_mean) / (upper_band - lower_band) (z-score)     
             self._pertb_list.append(pertb)  
-            logging.info(f"%b of {self._asset1}-{self._asset2} pairs is {pertb}")
+            logging.info(f"%b of {self.get_name()} pairs is {pertb}")
 
     def _generate_signal(self) -> None:
         if len(self._pertb_list) < 2:
@@ -81,94 +245,139 @@ class PairTrade:
                 if self._pertb_list[-1] < 0:
                     self._spread_position = 1
                     self._signal = -1 # Long the spread 
-                    logging.info(f"Long the spread for {self._asset1}-{self._asset2} pair.")
+                    logging.info(f"Long the spread for {self.get_name()} pair.")
                 elif self._pertb_list[-1] > 1:
                     self._spread_position = -1
                     self._signal = 1 # Short the spread
-                    logging.info(f"Short the spread for {self._asset1}-{self._asset2} pair")
+                    logging.info(f"Short the spread for {self.get_name()} pair")
             elif self._spread_position == 1:
                 if (self._pertb_list[0] < 0.5) and  (self._pertb_list[-1] >= 0.5):
                     self._spread_position = 0
                     self._signal = 0 # Close Position
-                    logging.info(f"Close Position for {self._asset1}-{self._asset2} pair")
+                    logging.info(f"Close Position for {self.get_name()} pair")
                 else:
                     pass
             elif self._spread_position == -1:
                 if (self._pertb_list[0] > 0.5) and  (self._pertb_list[-1] <= 0.5): 
                     self._spread_position = 0
                     self._signal = 0 # Close Position
-                    logging.info(f"Close Position for {self._asset1}-{self._asset2} pair")
+                    logging.info(f"Close Position for {self.get_name()} pair")
                 else:
                     pass
 
+    def _on_quote(self, symbol: str, mid_price: float) -> None:
+        """Quote listener of the ewma signal mode. Updates the bands and the signal in O(1), wakes _trader when the position changes."""
+        sample = self._sample(update=False)
+        if sample is None:
+            return
+        spread, mid_prices = sample
+        now = TimeSource.monotonic()
+        if (self._window_time is None) or (now - self._window_time >= self._downsample):  # Window of the metrics and of reparameterize
+            if self._hedge_estimator is not None:
+                self._spread(*mid_prices)  # Fed per quote, the estimator would absorb the spread that is traded
+            self._spread_list.append(spread)
+            self._mid_price_list.append(mid_prices)
+            self._window_time = now
+        if self._ewma_mean is None:
+            self._ewma_mean = spread
+            self._ewma_start = now
+        else:
+            alpha = 1 - math.exp(-(now - self._ewma_time) * self._ewma_decay)  # Quotes arrive at irregular intervals
+            diff = spread - self._ewma_mean
+            self._ewma_mean += alpha * diff
+            self._ewma_var = (1 - alpha) * (self._ewma_var + alpha * diff * diff)
+        self._ewma_time = now
+        if (now - self._ewma_start < self._ewma_warmup) or (self._ewma_var <= 0):
+            return
+        band = self._k * math.sqrt(self._ewma_var)
+        self._pertb_list.append((spread - self._ewma_mean + band) / (2 * band))
+        previous_spread_position = self._spread_position
+        self._generate_signal()
+        if self._spread_position != previous_spread_position:
+            self._signal_event.set()
+
+    async def _wait_for_next_tick(self) -> None:
+        if self._signal_mode == SIGNAL_EWMA:
+            try:
+                await asyncio.wait_for(self._signal_event.wait(), timeout=self._downsample)  # Orders are still refreshed every downsample seconds
+            except asyncio.TimeoutError:
+                pass
+            self._signal_event.clear()
+        else:
+            await asyncio.sleep(self._downsample)
+
+    def _max_positions(self) -> Dict[str, Optional[float]]:
+        """Size of each leg in a position, None until it is known."""
+        return {self._asset1: self._asset1_max_position, self._asset2: self._asset2_max_position}
+
+    def _target_positions(self) -> Dict[str, float]:
+        """Position of each leg for the current signal. Long the spread is short asset 1 and long asset 2."""
+        if self._signal == - 1 :
+            return {self._asset1: - self._asset1_max_position, self._asset2: self._asset2_max_position}
+        elif self._signal == 1:
+            return {self._asset1: self._asset1_max_position, self._asset2: - self._asset2_max_position}
+        return {self._asset1: 0, self._asset2: 0}
+
+    async def _place_order(self, symbol: str, order_qty: float) -> None:
+        if (order_qty < 0):
+            side = SIDE_SELL
+        elif (order_qty > 0):
+            side = SIDE_BUY
+        try:
+            mid_price = self._dataclient.get_last_mid_price(symbol)
+            price = round(mid_price / 0.01) * 0.01 
+            logging.info(f"Placing {side} order for {symbol}, Qty={order_qty}, Price={price}, Type={self._order_type}")
+            order = await self._ordermanager.insert_order(symbol= symbol, price=price, quantity= abs(order_qty), side=side,order_type= self._order_type)
+            if order.success:
+                self._pending_order_ids.append(order.order_id)
+        except Exception as e:
+            logging.error(f"Error placing order for {symbol}: Qty={order_qty}, Price={mid_price}, Error: {e}")             
+
     async def _trader(self) -> None:
-        while (self._asset1_max_position == None) or (self._asset2_max_position == None):
+        while any(max_position is None for max_position in self._max_positions().values()) and not self._retiring:
             await self._calculate_max_position()
             await asyncio.sleep(1)
-        logging.info(f"Max Positions of {self._asset1} is {self._asset1_max_position} and {self._asset2} is {self._asset2_max_position}")
+        logging.info("Max Positions of " + " and ".join(f"{symbol} is {max_position}" for symbol, max_position in self._max_positions().items()))
+
+        if self._signal_mode == SIGNAL_EWMA and not self._retiring:
+            for symbol in self.get_symbols():
+                self._dataclient.add_quote_listener(symbol, self._on_quote)
 
+        previous_spread_position = self._spread_position
         while True:
-            self._calculate_spread()
-            self._calculate_pertb()
-            self._generate_signal()
+            if self._retiring:
+                if all(self._dataclient.get_position_by_symbol(symbol) == 0 for symbol in self.get_symbols()):
+                    logging.info(f"Retired {self.get_name()} pair is flat, stop trading it")
+                    return
+            elif self._signal_mode == SIGNAL_DOWNSAMPLE:
+                self._calculate_spread()
+                self._calculate_pertb()
+                self._generate_signal()
+            if (self._hedge_estimator is not None or self._stale_max_position) and (self._spread_position != 0) and (self._spread_position != previous_spread_position):
+                await self._calculate_max_position()  # Size a new position with the live hedge ratio
+                self._stale_max_position = False
+            previous_spread_position = self._spread_position
 
             if self._signal == None:
-                logging.info(f"No signal generated for {self._asset1}-{self._asset2} pair, awaiting more data or waiting for the next opportunity.")
-                await asyncio.sleep(self._downsample)
+                logging.info(f"No signal generated for {self.get_name()} pair, awaiting more data or waiting for the next opportunity.")
+                await self._wait_for_next_tick()
                 continue 
 
-            asset1_position = self._dataclient.get_position_by_symbol(self._asset1)
-            asset2_position = self._dataclient.get_position_by_symbol(self._asset2)
+            self._pending_order_ids = []
+            for symbol, target_position in self._target_positions().items():
+                order_qty = target_position - self._dataclient.get_position_by_symbol(symbol)
+                if order_qty != 0:
+                    await self._place_order(symbol, order_qty)
             
-            if self._signal == - 1 :
-                asset1_order_qty = - self._asset1_max_position - asset1_position
-                asset2_order_qty = self._asset2_max_position - asset2_position
-            elif self._signal == 1:
-                asset1_order_qty = self._asset1_max_position - asset1_position
-                asset2_order_qty = - self._asset2_max_position - asset2_position
-            elif self._signal == 0:
-                asset1_order_qty = 0 - asset1_position
-                asset2_order_qty = 0 - asset2_position
-
-            Order_IDs = []
-            if asset1_order_qty != 0:
-                if (asset1_order_qty < 0):
-                    side_asset1 = SIDE_SELL
-                elif (asset1_order_qty > 0):
-                    side_asset1 = SIDE_BUY
-                try:
-                    mid_price_asset1 = self._dataclient.get_last_mid_price(self._asset1)
-                    price_1 = round(mid_price_asset1 / 0.01) * 0.01 
-                    logging.info(f"Placing {side_asset1} order for {self._asset1}, Qty={asset1_order_qty}, Price={price_1}, Type={self._order_type}")
-                    Order_asset1 = await self._ordermanager.insert_order(symbol= self._asset1, price=price_1, quantity= abs(asset1_order_qty), side=side_asset1,order_type= self._order_type)
-                    if Order_asset1.success:
-                        Order_IDs.append(Order_asset1.order_id)
-                except Exception as e:
-                    logging.error(f"Error placing order for {self._asset1}: Qty={asset1_order_qty}, Price={mid_price_asset1}, Error: {e}")             
-
-            if asset2_order_qty != 0:
-                if (asset2_order_qty < 0):
-                    side_asset2 = SIDE_SELL
-                elif (asset2_order_qty > 0):
-                    side_asset2 = SIDE_BUY
-                try:
-                    mid_price_asset2 = self._dataclient.get_last_mid_price(self._asset2)
-                    price_2 = round(mid_price_asset2 / 0.01) * 0.01
-                    logging.info(f"Placing {side_asset2} order for {self._asset2}, Qty={asset2_order_qty}, Price={price_2}, Type={self._order_type}")
-                    Order_asset2 = await self._ordermanager.insert_order(symbol= self._asset2,  price=price_2,  quantity= abs(asset2_order_qty),  side=side_asset2, order_type= self._order_type)
-                    if Order_asset2.success:
-                        Order_IDs.append(Order_asset2.order_id)
-                except Exception as e:
-                    logging.error(f"Error placing order for {self._asset2}: Qty={asset2_order_qty}, Price={mid_price_asset2}, Error: {e}")  
-            
-            await asyncio.sleep(self._downsample)
+            await self._wait_for_next_tick()
 
             if self._order_type == ORDER_TYPE_GTC:
-                for order in Order_IDs:
+                for order in self._pending_order_ids:
                     try:
                         logging.info(f"Cancelled GTC order {order}")
                         await self._ordermanager.cancel_order(order)
                     except Exception as e:
                         logging.error(f"Error cancelling take-profit order {order}: {e}")
+            self._pending_order_ids = []
 
 ##TODO Ideas for execution 1. GTC + Cancel Order 2. Submit order every 1s until target volume when there is signal for trade
\ No newline at end of file
@@ -0,0 +1,654 @@
+"""Benchmarks for the hot paths of the data client, the strategy and the parameter calculator.
+
+    python benchmark.py                      # run all benchmarks and compare with benchmarks/baseline.json
+    python benchmark.py --only on_quote      # run the benchmarks whose name contains "on_quote"
+    python benchmark.py --quick              # smaller sizes, compared with benchmarks/baseline_quick.json
+    python benchmark.py --save-baseline      # store the results as the new baseline (of --quick with --quick)
+
+Every benchmark is run at several scales (symbols, pairs, window length, days) and reports the
+time per operation. All data is synthetic and seeded. Every timed run is paired with a run of a fixed
+reference workload of interpreter and numpy code, and timings are compared with the baseline in multiples
+of the reference, which cancels most of the speed difference between machines and of the load of a shared
+host. The remaining gap (cache sizes, BLAS, library versions) is why the versions of the baseline are
+printed on a mismatch, and baselines of another CPU are not compared at all. Timings run with the garbage
+collector off. The noise of a benchmark is how far apart the best ratios to the reference of its even and odd
+runs are, and a change is only flagged above max(REGRESSION_THRESHOLD, NOISE_MULTIPLE * noise) of this run or
+the baseline. Flagged benchmarks are timed again and only regressions that repeat are reported.
+"""
+import gc
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+from typing import Callable, List, Optional
+
+
+from alpaca_trade_api.entity import Quote, Trade
+from core import DataClient, OrderManager, RiskManager, SIDE_BUY, SIDE_SELL
+from PairTrade import PairTrade, SIGNAL_EWMA
+from hedge import OnlineHedgeRatio, HEDGE_KALMAN, HEDGE_RLS
+from find_coint_pairs_and_params import PairsTradeParamsCalculation
+
+BASELINE_FILENAME = os.path.join("benchmarks", "baseline.json")
+QUICK_BASELINE_FILENAME = os.path.join("benchmarks", "baseline_quick.json")  # Quick runs have other sizes and warm-up, they are compared with their own baseline
+REGRESSION_THRESHOLD = 0.25
+NOISE_MULTIPLE = 2  # A benchmark is only flagged above NOISE_MULTIPLE times its noise, when that is above REGRESSION_THRESHOLD
+MIN_SAMPLE_SECONDS = 2.0
+MIN_REPEAT = 5  # Runs for the noise estimate, fewer only when they take more than MAX_SAMPLE_SECONDS
+MAX_SAMPLE_SECONDS = 30.0
+MAX_REPEAT = 100
+CONFIRM_RUNS = 2
+BENCHMARKS = {}
+
+
+def benchmark(name: str, scales: List, quick_scales: List):
+    def register(fn: Callable) -> Callable:
+        BENCHMARKS[name] = (fn, scales, quick_scales)
+        return fn
+    return register
+
+
+_REFERENCE_DATA = np.random.default_rng(0).standard_normal(20_000)
+_REFERENCE_QUOTES = {f"SYM{i:04d}": float(i) for i in range(1000)}
+_reference_timings : List[float] = []  # Reference runs interleaved with the timings of the running benchmark
+_ratios : List[float] = []  # Every timing of the running benchmark over the reference run just before it
+
+
+def _reference_workload() -> float:
+    """A fixed mix of interpreter and numpy work of a few milliseconds, the unit of the comparison with the baseline."""
+    total = 0.0
+    for _ in range(30):
+        for symbol, price in _REFERENCE_QUOTES.items():
+            total += price * 0.5
+    for _ in range(15):
+        np.sort(_REFERENCE_DATA)
+        np.cumsum(_REFERENCE_DATA)
+    return total
+
+
+def _timed(fn: Callable) -> float:
+    """Wall time of fn with the garbage collector off, like timeit. Otherwise the collections of the objects left by the
+    benchmarks before it are timed as well, and a benchmark is slower in the full run than on its own."""
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _best_of(fn: Callable, repeat: int) -> float:
+    """Run fn at least `repeat` times and return the fastest wall time, which is the least noisy estimate. Benchmarks
+    run MIN_REPEAT times unless that takes more than MAX_SAMPLE_SECONDS, and short ones until MIN_SAMPLE_SECONDS of
+    timings, up to MAX_REPEAT times. Every run is preceded by a run of the reference workload, so both are sampled
+    under the same load of the machine."""
+    timings = []
+    while (len(timings) < repeat or (len(timings) < MIN_REPEAT and sum(timings) < MAX_SAMPLE_SECONDS)
+           or (sum(timings) < MIN_SAMPLE_SECONDS and len(timings) < MAX_REPEAT)):
+        _reference_timings.append(_timed(_reference_workload))
+        timings.append(_timed(fn))
+        _ratios.append(timings[-1] / _reference_timings[-1])
+    return min(timings)
+
+
+def reference_seconds(repeat: int = 20) -> float:
+    return min(_timed(_reference_workload) for _ in range(repeat))
+
+
+def _noise(ratios: List[float]) -> float:
+    """Relative difference of the best ratio of the even and of the odd runs, how well the best of the repeats is reproduced."""
+    if len(ratios) < 2:
+        return 0.0
+    best_even, best_odd = min(ratios[0::2]), min(ratios[1::2])
+    return abs(best_even - best_odd) / min(best_even, best_odd)
+
+
+# Synthetic data
+
+def make_symbols(nr_symbols: int) -> List[str]:
+    return [f"SYM{i:04d}" for i in range(nr_symbols)]
+
+
+def make_quote_entities(symbols: List[str], nr_quotes: int, seed: int = 0) -> List[Quote]:
+    """Quote entities shaped like the ones alpaca_trade_api.stream hands to DataClient.on_quote."""
+    rng = np.random.default_rng(seed)
+    symbol_idx = rng.integers(0, len(symbols), nr_quotes)
+    mids = 100 + np.cumsum(rng.normal(0, 0.01, nr_quotes))
+    timestamp = 1728566400000000000
+    return [Quote({"symbol": symbols[idx], "bid_price": round(mid - 0.01, 2), "bid_size": 100, "ask_price": round(mid + 0.01, 2), "ask_size": 200,
+                   "bid_exchange": "V", "ask_exchange": "V", "conditions": ["R"], "tape": "C", "timestamp": timestamp + i * 1000})
+            for i, (idx, mid) in enumerate(zip(symbol_idx.tolist(), mids.tolist()))]
+
+
+def make_trade_entities(symbols: List[str], nr_trades: int, seed: int = 0) -> List[Trade]:
+    rng = np.random.default_rng(seed)
+    symbol_idx = rng.integers(0, len(symbols), nr_trades)
+    prices = 100 + np.cumsum(rng.normal(0, 0.01, nr_trades))
+    timestamp = 1728566400000000000
+    return [Trade({"symbol": symbols[idx], "price": round(price, 2), "size": 100, "exchange": "V", "id": i, "conditions": ["@"], "tape": "C",
+                   "timestamp": timestamp + i * 1000})
+            for i, (idx, price) in enumerate(zip(symbol_idx.tolist(), prices.tolist()))]
+
+
+def make_quote_frame(nr_quotes: int, date: str = "2024-10-10", seed: int = 0) -> pd.DataFrame:
+    """Quotes shaped like the csv files written by PairsTradeParamsCalculation.fetch_data."""
+    rng = np.random.default_rng(seed)
+    session_start = pd.Timestamp(f"{date}T13:30:00Z").value
+    timestamps = np.sort(rng.integers(session_start, session_start + 23400 * 10**9, nr_quotes))
+    mids = 100 + np.cumsum(rng.normal(0, 0.005, nr_quotes))
+    half_spreads = rng.integers(1, 4, nr_quotes) * 0.01
+    return pd.DataFrame({"timestamp": pd.to_datetime(timestamps, utc=True),
+                         "ask_exchange": "V", "ask_price": np.round(mids + half_spreads, 2), "ask_size": rng.integers(1, 10, nr_quotes) * 100,
+                         "bid_exchange": "V", "bid_price": np.round(mids - half_spreads, 2), "bid_size": rng.integers(1, 10, nr_quotes) * 100,
+                         "conditions": "['R']", "tape": "C"}).set_index("timestamp")
+
+
+def make_pair_panel(nr_days: int, downsample: int, seed: int = 0) -> pd.DataFrame:
+    """Downsampled mid prices of a cointegrated pair over nr_days sessions."""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for day in range(nr_days):
+        index = pd.date_range(pd.Timestamp("2024-10-01T13:30:00Z") + pd.Timedelta(days=day), periods=23400 // downsample, freq=f"{downsample}s")
+        asset1 = 100 + np.cumsum(rng.normal(0, 0.05, len(index)))
+        spread = np.zeros(len(index))
+        for t in range(1, len(index)):
+            spread[t] = 0.95 * spread[t - 1] + rng.normal(0, 0.05)
+        frames.append(pd.DataFrame({"AAA": asset1, "BBB": 10 + 0.8 * asset1 + spread}, index=index))
+    return pd.concat(frames)
+
+
+def make_params_file(folder: str, nr_pairs: int, seed: int = 0) -> str:
+    rng = np.random.default_rng(seed)
+    filename = os.path.join(folder, f"params_{nr_pairs}.txt")
+    with open(filename, 'w') as file:
+        for i in range(nr_pairs):
+            file.write(json.dumps({"asset 1": f"SYM{2 * i:04d}", "asset 2": f"SYM{2 * i + 1:04d}", "res mean": float(rng.normal(0, 1e-12)),
+                                   "res std": float(rng.uniform(0.01, 1)), "adj rsquared": float(rng.uniform(0.3, 0.9)), "constant": float(rng.normal(10, 5)),
+                                   "hedge ratio": float(rng.uniform(0.1, 2)), "half life": float(rng.integers(5, 60)), "p-value of adf test": float(rng.uniform(0, 0.05)),
+                                   "adjustment coef": float(rng.uniform(-0.1, 0))}) + '\n')
+    return filename
+
+
+def _params_calculation(data_folder: str = "data", downsample: int = 30) -> PairsTradeParamsCalculation:
+    calculation = PairsTradeParamsCalculation(symbols=["AAA", "BBB"], date="2024-10-11", lookback=2, downsample=downsample)
+    calculation._data_folder_name = data_folder
+    return calculation
+
+
+# Benchmarks. Each returns the time per operation in seconds and the unit of an operation.
+
+@benchmark("DataClient.on_quote", scales=[10, 100, 1000], quick_scales=[10, 100])
+def bench_on_quote(nr_symbols: int, quick: bool):
+    nr_quotes = 20000 if quick else 200000
+    quotes = make_quote_entities(make_symbols(nr_symbols), nr_quotes)
+    dataclient = DataClient()
+
+    async def run():
+        for quote in quotes:
+            await dataclient.on_quote(quote)
+    return _best_of(lambda: asyncio.run(run()), repeat=3) / nr_quotes, "quote"
+
+
+@benchmark("DataClient.on_trade", scales=[10, 100, 1000], quick_scales=[10, 100])
+def bench_on_trade(nr_symbols: int, quick: bool):
+    nr_trades = 20000 if quick else 200000
+    trades = make_trade_entities(make_symbols(nr_symbols), nr_trades)
+    dataclient = DataClient()
+
+    async def run():
+        for trade in trades:
+            await dataclient.on_trade(trade)
+    return _best_of(lambda: asyncio.run(run()), repeat=3) / nr_trades, "trade"
+
+
+def _warm_pair_trade(downsample: int, dataclient: Optional[DataClient] = None, asset1: str = "AAA", asset2: str = "BBB") -> PairTrade:
+    dataclient = dataclient if dataclient is not None else DataClient()
+    pair_trade = PairTrade(dataclient=dataclient, ordermanager=OrderManager(), asset1=asset1, asset2=asset2, capital=10000,
+                           downsample=downsample, hedge_ratio=0.8, const=10)
+    rng = np.random.default_rng(0)
+    pair_trade._spread_list.extend(rng.normal(0, 0.05, pair_trade._length_of_spread).tolist())
+    pair_trade._pertb_list.extend([0.5, 0.5])
+    dataclient._last_mid_price.update({asset1: 100.0, asset2: 90.0})
+    return pair_trade
+
+
+@benchmark("PairTrade._calculate_spread", scales=[30, 5, 1], quick_scales=[30, 5])
+def bench_calculate_spread(downsample: int, quick: bool):
+    nr_ticks = 2000 if quick else 20000
+    pair_trade = _warm_pair_trade(downsample)
+    def run():
+        for _ in range(nr_ticks):
+            pair_trade._calculate_spread()
+    return _best_of(run, repeat=3) / nr_ticks, "tick"
+
+
+@benchmark("PairTrade._calculate_pertb", scales=[30, 5, 1], quick_scales=[30, 5])
+def bench_calculate_pertb(downsample: int, quick: bool):
+    """Scale is the downsample interval in seconds, the window is 1200 / downsample data points."""
+    nr_ticks = 2000 if quick else 20000
+    pair_trade = _warm_pair_trade(downsample)
+    def run():
+        for _ in range(nr_ticks):
+            pair_trade._calculate_pertb()
+    return _best_of(run, repeat=3) / nr_ticks, "tick"
+
+
+@benchmark("PairTrade._generate_signal", scales=[30], quick_scales=[30])
+def bench_generate_signal(downsample: int, quick: bool):
+    nr_ticks = 20000 if quick else 200000
+    pair_trade = _warm_pair_trade(downsample)
+    pertbs = np.random.default_rng(0).normal(0.5, 0.6, nr_ticks).tolist()
+    def run():
+        for pertb in pertbs:
+            pair_trade._pertb_list.append(pertb)
+            pair_trade._generate_signal()
+    return _best_of(run, repeat=3) / nr_ticks, "tick"
+
+
+@benchmark("PairTrade._on_quote (ewma)", scales=[30], quick_scales=[30])
+def bench_ewma_on_quote(downsample: int, quick: bool):
+    """Quote listener of the ewma signal mode: spread, bands, %b and signal for one quote."""
+    nr_quotes = 20000 if quick else 200000
+    dataclient = DataClient()
+    pair_trade = PairTrade(dataclient=dataclient, ordermanager=OrderManager(), asset1="AAA", asset2="BBB", capital=10000,
+                           downsample=downsample, hedge_ratio=0.8, const=10, signal_mode=SIGNAL_EWMA, half_life=20)
+    pair_trade._ewma_warmup = 0
+    mids = (90 + np.random.default_rng(0).normal(0, 0.05, nr_quotes)).tolist()
+    dataclient._last_mid_price.update({"AAA": 100.0, "BBB": 90.0})
+    def run():
+        for mid in mids:
+            dataclient._last_mid_price["BBB"] = mid
+            pair_trade._on_quote("BBB", mid)
+    return _best_of(run, repeat=3) / nr_quotes, "quote"
+
+
+@benchmark("PairTrade step across pairs", scales=[10, 100, 500], quick_scales=[10])
+def bench_pair_step(nr_pairs: int, quick: bool):
+    """One downsample tick of every pair on a shared DataClient, as the event loop sees it."""
+    nr_ticks = 20 if quick else 100
+    dataclient = DataClient()
+    symbols = make_symbols(2 * nr_pairs)
+    pair_trades = [_warm_pair_trade(30, dataclient, symbols[2 * i], symbols[2 * i + 1]) for i in range(nr_pairs)]
+    mids = 100 + np.random.default_rng(0).normal(0, 0.1, (nr_ticks, len(symbols)))
+    def run():
+        for tick in range(nr_ticks):
+            dataclient._last_mid_price.update(zip(symbols, mids[tick].tolist()))
+            for pair_trade in pair_trades:
+                pair_trade._calculate_spread()
+                pair_trade._calculate_pertb()
+                pair_trade._generate_signal()
+    return _best_of(run, repeat=3) / nr_ticks, "tick of all pairs"
+
+
+@benchmark("OnlineHedgeRatio.update_one", scales=[HEDGE_KALMAN, HEDGE_RLS], quick_scales=[HEDGE_KALMAN])
+def bench_hedge_update_one(method: str, quick: bool):
+    nr_ticks = 20000 if quick else 200000
+    estimator = OnlineHedgeRatio(hedge_ratios=[0.8], consts=[10], res_stds=[0.05], method=method)
+    rng = np.random.default_rng(0)
+    x = (100 + np.cumsum(rng.normal(0, 0.05, nr_ticks))).tolist()
+    y = [10 + 0.8 * value + noise for value, noise in zip(x, rng.normal(0, 0.05, nr_ticks).tolist())]
+    def run():
+        for i in range(nr_ticks):
+            estimator.update_one(0, x[i], y[i])
+    return _best_of(run, repeat=3) / nr_ticks, "sample"
+
+
+@benchmark("OnlineHedgeRatio.update across pairs", scales=[10, 100, 500], quick_scales=[10])
+def bench_hedge_update(nr_pairs: int, quick: bool):
+    """One vectorised Kalman update of every pair."""
+    nr_ticks = 2000 if quick else 20000
+    rng = np.random.default_rng(0)
+    estimator = OnlineHedgeRatio(hedge_ratios=rng.uniform(0.1, 2, nr_pairs), consts=rng.normal(10, 5, nr_pairs), res_stds=rng.uniform(0.01, 1, nr_pairs))
+    x = 100 + rng.normal(0, 0.1, (nr_ticks, nr_pairs))
+    y = 90 + rng.normal(0, 0.1, (nr_ticks, nr_pairs))
+    def run():
+        for tick in range(nr_ticks):
+            estimator.update(x[tick], y[tick])
+    return _best_of(run, repeat=3) / nr_ticks, "tick of all pairs"
+
+
+@benchmark("RiskManager.check_order", scales=[10, 500], quick_scales=[10])
+def bench_risk_check(nr_pairs: int, quick: bool):
+    """Check and release of one order with every limit set. Scale is the number of pairs with a limit."""
+    nr_orders = 20000 if quick else 200000
+    symbols = make_symbols(2 * nr_pairs)
+    dataclient = DataClient()
+    dataclient._last_mid_price.update({symbol: 100.0 for symbol in symbols})
+    risk_manager = RiskManager(dataclient, max_gross_notional=1e12, max_net_notional=1e12, max_order_notional=1e12, max_symbol_notional=1e12,
+                               max_symbol_positions={symbol: 1e9 for symbol in symbols}, max_pair_exposures={(symbols[2 * i], symbols[2 * i + 1]): 1e12 for i in range(nr_pairs)},
+                               max_orders_per_second=None, max_price_deviation=0.05)
+    orders = [(symbols[i % len(symbols)], SIDE_BUY if i % 3 else SIDE_SELL) for i in range(1000)]
+    def run():
+        for i in range(nr_orders):
+            symbol, side = orders[i % 1000]
+            risk_manager.check_order(symbol, 100.0, 10, side)
+            risk_manager.on_order_inserted(symbol, 10, side, None)
+    return _best_of(run, repeat=3) / nr_orders, "order"
+
+
+@benchmark("load_quote_data", scales=[100000, 1000000], quick_scales=[100000])
+def bench_load_quote_data(nr_quotes: int, quick: bool):
+    with tempfile.TemporaryDirectory() as data_folder:
+        make_quote_frame(nr_quotes).to_csv(os.path.join(data_folder, "AAA_20241010_quote.csv"), index=True)
+        calculation = _params_calculation(data_folder)
+        seconds = _best_of(lambda: calculation.load_quote_data(symbol="AAA", date="20241010"), repeat=2)
+    return seconds / nr_quotes * 1e6, "million quotes"
+
+
+@benchmark("load_quote_data (recorded tape)", scales=[100000, 1000000], quick_scales=[100000])
+def bench_load_quote_tape(nr_quotes: int, quick: bool):
+    from recorder import QUOTE_DTYPE, tape_filename
+    quote_frame = make_quote_frame(nr_quotes)
+    records = np.empty(nr_quotes, dtype=QUOTE_DTYPE)
+    records["timestamp"] = quote_frame.index.asi8
+    for name in ("bid_price", "bid_size", "ask_price", "ask_size"):
+        records[name] = quote_frame[name].to_numpy()
+    with tempfile.TemporaryDirectory() as data_folder:
+        records.tofile(tape_filename(data_folder, "AAA", "20241010"))
+        calculation = _params_calculation(data_folder)
+        seconds = _best_of(lambda: calculation.load_quote_data(symbol="AAA", date="20241010"), repeat=2)
+    return seconds / nr_quotes * 1e6, "million quotes"
+
+
+@benchmark("load_quote_data (response cache)", scales=[100000, 1000000], quick_scales=[100000])
+def bench_load_quote_cache(nr_quotes: int, quick: bool):
+    """Read and integrity check of a cached quote download."""
+    import pickle
+    from response_cache import ResponseCache
+    from find_coint_pairs_and_params import QUOTES_ENDPOINT
+    request = {"symbol": "AAA", "start": "2024-10-10T13:30:00Z", "end": "2024-10-10T20:00:00Z"}
+    with tempfile.TemporaryDirectory() as cache_folder:
+        cache = ResponseCache(cache_folder)
+        cache.put(QUOTES_ENDPOINT, request, pickle.dumps(make_quote_frame(nr_quotes), protocol=pickle.HIGHEST_PROTOCOL))
+        calculation = _params_calculation(cache_folder)
+        calculation._cache = cache
+        calculation._quote_requests[("AAA", "20241010")] = request
+        seconds = _best_of(lambda: calculation.load_quote_data(symbol="AAA", date="20241010"), repeat=2)
+    return seconds / nr_quotes * 1e6, "million quotes"
+
+
+@benchmark("calculate_midprice_and_downsample", scales=[100000, 1000000], quick_scales=[100000])
+def bench_midprice_and_downsample(nr_quotes: int, quick: bool):
+    quote_data = make_quote_frame(nr_quotes)
+    calculation = _params_calculation()
+    seconds = _best_of(lambda: calculation.calculate_midprice_and_downsample(quote_data=quote_data.copy(), downsample=30), repeat=3)
+    return seconds / nr_quotes * 1e6, "million quotes"
+
+
+@benchmark("cointegration_check_weighted", scales=[1, 2, 5], quick_scales=[1, 2])
+def bench_cointegration_check(nr_days: int, quick: bool):
+    """Scale is the number of formation days at downsample 5."""
+    price_data = make_pair_panel(nr_days, downsample=5)
+    calculation = _params_calculation(downsample=5)
+    seconds = _best_of(lambda: calculation.cointegration_check_weighted(price_data.copy(), "AAA", "BBB"), repeat=3)
+    return seconds / nr_days, "pair-day"
+
+
+@benchmark("bootstrap_pair", scales=[500, 2000], quick_scales=[500])
+def bench_bootstrap_pair(nr_replicates: int, quick: bool):
+    """Scale is the number of replicates, one formation day at downsample 5."""
+    from bootstrap import bootstrap_pair
+    price_data = make_pair_panel(1, downsample=5)
+    seconds = _best_of(lambda: bootstrap_pair(price_data, "AAA", "BBB", nr_replicates), repeat=3)
+    return seconds / nr_replicates * 1e3, "thousand replicates"
+
+
+@benchmark("johansen_trace", scales=[16, 64, 256], quick_scales=[16, 64])
+def bench_johansen_trace(nr_baskets: int, quick: bool):
+    """Scale is the number of baskets of three symbols tested in one batch, one day at downsample 5."""
+    from johansen import johansen_trace
+    rng = np.random.default_rng(0)
+    prices = 100 + np.cumsum(rng.normal(0, 0.05, size=(nr_baskets, 4680, 3)), axis=1)
+    seconds = _best_of(lambda: johansen_trace(prices), repeat=3)
+    return seconds / nr_baskets, "basket-day"
+
+
+@benchmark("main.load_params", scales=[10, 100, 1000], quick_scales=[10, 100])
+def bench_load_params(nr_pairs: int, quick: bool):
+    import main
+    with tempfile.TemporaryDirectory() as params_folder:
+        filename = make_params_file(params_folder, nr_pairs)
+        seconds = _best_of(lambda: main.load_params(filename), repeat=5)
+    return seconds, "file"
+
+
+STARTUP_IMPORTS = {"trade": "import main", "calibrate": "import main, find_coint_pairs_and_params"}
+
+
+@benchmark("startup imports", scales=["trade", "calibrate"], quick_scales=["trade"])
+def bench_startup(command: str, quick: bool):
+    """Imports of a command in a fresh interpreter. Also prints the peak resident memory of that interpreter."""
+    import subprocess
+    # VmHWM rather than ru_maxrss, which a child forked from this large process inherits
+    code = (f"import time; start = time.perf_counter(); {STARTUP_IMPORTS[command]}; seconds = time.perf_counter() - start; "
+            "print(seconds, [line.split()[1] for line in open('/proc/self/status') if line.startswith('VmHWM')][0])")
+    timings = []
+    for _ in range(3):
+        _reference_timings.append(_timed(_reference_workload))
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, max_rss = output.stdout.split()[-2:]
+        timings.append(float(seconds))
+        _ratios.append((time.perf_counter() - start) / _reference_timings[-1])
+    print(f"{'':<40} {command} peak resident memory {int(max_rss) / 1024:.0f} MB")
+    return min(timings), "startup"
+
+
+def make_order_response(seed: int = 0) -> str:
+    """Order json as returned by POST /v2/orders."""
+    return json.dumps({"id": "61e69015-8549-4bfd-b9c3-01e75843f47d", "client_order_id": "eb9e2aaa-f71a-4f51-b5b4-52a6c565dad4",
+                       "created_at": "2024-10-10T13:31:12.318273Z", "updated_at": "2024-10-10T13:31:12.318273Z", "submitted_at": "2024-10-10T13:31:12.316399Z",
+                       "filled_at": None, "expired_at": None, "canceled_at": None, "failed_at": None, "replaced_at": None, "replaced_by": None, "replaces": None,
+                       "asset_id": "b0b6dd9d-8b9b-48a9-ba46-b9d54906e415", "symbol": "NVDA", "asset_class": "us_equity", "notional": None, "qty": "12",
+                       "filled_qty": "0", "filled_avg_price": None, "order_class": "", "order_type": "limit", "type": "limit", "side": "buy",
+                       "time_in_force": "gtc", "limit_price": "131.27", "stop_price": None, "status": "accepted", "extended_hours": False, "legs": None,
+                       "trail_percent": None, "trail_price": None, "hwm": None})
+
+
+def make_quote_frame_bytes(nr_quotes: int, seed: int = 0) -> bytes:
+    """One market data frame of nr_quotes quotes, encoded like the Alpaca stream."""
+    import msgpack
+    rng = np.random.default_rng(seed)
+    return msgpack.packb([{"T": "q", "S": "NVDA", "bx": "V", "bp": float(bid), "bs": 100, "ax": "V", "ap": float(bid) + 0.01, "as": 200,
+                           "t": msgpack.Timestamp.from_unix_nano(1728566400000000000 + i), "c": ["R"], "z": "C"}
+                          for i, bid in enumerate(np.round(rng.uniform(100, 101, nr_quotes), 2))])
+
+
+@benchmark("json decode order response", scales=["default", "fast"], quick_scales=["default", "fast"])
+def bench_json_decode(profile: str, quick: bool):
+    import runtime
+    nr_messages = 20000 if quick else 200000
+    json_loads, _ = runtime.json_codecs(profile)
+    payload = make_order_response()
+    def run():
+        for _ in range(nr_messages):
+            json_loads(payload)
+    return _best_of(run, repeat=3) / nr_messages, "message"
+
+
+@benchmark("json encode order request", scales=["default", "fast"], quick_scales=["default", "fast"])
+def bench_json_encode(profile: str, quick: bool):
+    import runtime
+    nr_messages = 20000 if quick else 200000
+    _, json_dumps = runtime.json_codecs(profile)
+    params = {"symbol": "NVDA", "qty": 12, "side": "buy", "type": "limit", "limit_price": 131.27, "time_in_force": "gtc"}
+    def run():
+        for _ in range(nr_messages):
+            json_dumps(params)
+    return _best_of(run, repeat=3) / nr_messages, "message"
+
+
+@benchmark("msgpack decode quote frame", scales=["default", "fast"], quick_scales=["default", "fast"])
+def bench_msgpack_decode(profile: str, quick: bool):
+    """Frames of 10 quotes, per quote."""
+    import runtime
+    nr_frames = 2000 if quick else 20000
+    _, msgpack_unpackb = runtime.msgpack_codecs(profile)
+    frame = make_quote_frame_bytes(10)
+    def run():
+        for _ in range(nr_frames):
+            msgpack_unpackb(frame)
+    return _best_of(run, repeat=3) / (nr_frames * 10), "quote"
+
+
+@benchmark("event loop dispatch", scales=["default", "fast"], quick_scales=["default", "fast"])
+def bench_loop_dispatch(profile: str, quick: bool):
+    """One loop iteration per message: a coroutine callback plus a yield to the loop, as the stream consumer does."""
+    import runtime
+    nr_messages = 20000 if quick else 200000
+    dataclient = DataClient()
+    quotes = make_quote_entities(make_symbols(10), 1000)
+
+    async def run():
+        for i in range(nr_messages):
+            await dataclient.on_quote(quotes[i % 1000])
+            await asyncio.sleep(0)
+
+    def run_on_new_loop():
+        loop = runtime.event_loop_policy(profile).new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+    return _best_of(run_on_new_loop, repeat=3) / nr_messages, "message"
+
+
+# Runner
+
+def run_benchmarks(only: Optional[str] = None, quick: bool = False) -> dict:
+    results = {}
+    for name, (fn, scales, quick_scales) in BENCHMARKS.items():
+        if only is not None and only not in name:
+            continue
+        results[name] = {}
+        for scale in (quick_scales if quick else scales):
+            results[name][str(scale)] = run_benchmark(name, scale, quick)
+    return results
+
+
+def run_benchmark(name: str, scale, quick: bool = False) -> dict:
+    fn = BENCHMARKS[name][0]
+    _reference_timings.clear()
+    _ratios.clear()
+    gc.collect()
+    seconds, unit = fn(scale, quick)
+    reference = min(_reference_timings) if _reference_timings else reference_seconds()
+    noise = _noise(_ratios)
+    print(f"{name:<40} scale={scale:<10} {seconds * 1e6:>14.3f} us per {unit} noise {noise:.1%} over {len(_ratios)} runs", flush=True)
+    return {"seconds": seconds, "unit": unit, "reference": reference, "noise": noise}
+
+
+def compare(results: dict, baseline: dict, quick: bool = False) -> List[str]:
+    """Changes of the timings in multiples of the reference workload measured next to them, in this run and in the baseline."""
+    if baseline.get("quick", False) != quick:
+        print(f"The baseline is of a {'quick' if baseline.get('quick', False) else 'full'} run, compare with the baseline of the same mode")
+        return []
+    differences = {key: value for key, value in environment().items() if baseline.get(key, None) != value}
+    hosts = {key: value for key, value in differences.items() if key in HOST_KEYS}
+    if hosts:
+        print(f"The baseline was saved on another host {({key: baseline.get(key, None) for key in hosts})}, this one is {hosts}. "
+              f"The reference workload does not cancel cache and core differences, save a baseline of this host with --save-baseline --baseline <file>")
+        return []
+    if differences:
+        print(f"The baseline was saved with other versions {({key: baseline.get(key, None) for key in differences})}, this run has {differences}")
+    regressions = []
+    for name, by_scale in results.items():
+        for scale, result in by_scale.items():
+            base = baseline.get("results", {}).get(name, {}).get(scale, None)
+            if base is None or "reference" not in base:
+                continue
+            change = (result["seconds"] / result["reference"]) / (base["seconds"] / base["reference"]) - 1
+            threshold = max(REGRESSION_THRESHOLD, NOISE_MULTIPLE * max(result.get("noise", 0.0), base.get("noise", 0.0)))
+            flag = "REGRESSION" if change > threshold else ""
+            print(f"{name:<40} scale={scale:<10} {change:>+8.1%} vs baseline, threshold {threshold:.0%} {flag}")
+            if flag:
+                regressions.append((name, scale))
+    return regressions
+
+
+def confirm(regressions: List[tuple], baseline: dict, quick: bool = False) -> List[str]:
+    """Times the flagged benchmarks again CONFIRM_RUNS times and keeps the ones that are slower every time, single
+    runs on a busy host vary by more than the threshold."""
+    scales = {str(scale): scale for name, (fn, all_scales, quick_scales) in BENCHMARKS.items() for scale in (quick_scales if quick else all_scales)}
+    for _ in range(CONFIRM_RUNS):
+        if len(regressions) == 0:
+            break
+        print(f"Timing {len(regressions)} flagged benchmarks again")
+        results = {}
+        for name, scale in regressions:
+            results.setdefault(name, {})[scale] = run_benchmark(name, scales[scale], quick)
+        regressions = compare(results, baseline, quick)
+    return [f"{name} scale={scale}" for name, scale in regressions]
+
+
+HOST_KEYS = ["machine", "cpu", "cpus"]
+
+
+def _cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo", 'r') as file:
+            for line in file:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def environment() -> dict:
+    return {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__, "machine": platform.machine(),
+            "cpu": _cpu_model(), "cpus": os.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the hot paths")
+    parser.add_argument("--only", default=None, help="Run only benchmarks whose name contains this string")
+    parser.add_argument("--quick", action="store_true", help="Use smaller sizes")
+    parser.add_argument("--save-baseline", action="store_true", help=f"Write the results to {BASELINE_FILENAME}, {QUICK_BASELINE_FILENAME} with --quick")
+    parser.add_argument("--baseline", default=None)
+    args = parser.parse_args()
+    if args.baseline is None:
+        args.baseline = QUICK_BASELINE_FILENAME if args.quick else BASELINE_FILENAME
+
+    # Strategy code logs on every tick. Keep the formatting cost, drop the terminal output.
+    logging.getLogger().handlers = [logging.StreamHandler(open(os.devnull, 'w'))]
+    logging.getLogger().setLevel(logging.INFO)
+    warnings.simplefilter("ignore", FutureWarning)
+
+    results = run_benchmarks(only=args.only, quick=args.quick)
+
+    if args.save_baseline:
+        baseline = {**environment(), "quick": args.quick, "results": results}
+        if os.path.exists(args.baseline) and args.only is not None:
+            with open(args.baseline, 'r') as file:
+                stored = json.load(file)
+            stored["results"].update(results)
+            baseline["results"] = stored["results"]
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, quick=args.quick)
+        if regressions:
+            regressions = confirm(regressions, baseline, quick=args.quick)
+        if regressions:
+            print(f"{len(regressions)} regressions above their threshold: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Block bootstrap significance of the selected pairs.
+
+    results = bootstrap_pairs(mid_prices, pairs, nr_replicates=2000, seed=0)
+    results["NVDA-AMD"]  # {"bootstrap p-value": 0.004, "half life ci": [31.0, 118.0]}
+
+The ADF p-values of the calibration are asymptotic and the pair is accepted on its worst formation day, which
+lets through many false positives when hundreds of pairs are tested on one or two days of data. This stage
+estimates, for every formation day of a pair:
+
+- the empirical p-value of the Engle-Granger statistic. Under the null the two legs are random walks, so the
+  replicates integrate moving blocks of the joint first differences, which keeps the short term correlation of
+  the legs and breaks the cointegration. Every replicate fits its own hedge ratio, like the calibration.
+- the distribution of the half life, from moving blocks of the (lagged spread, spread change) pairs of the
+  regression of the half life.
+
+The statistic is the Dickey-Fuller t-stat with a constant and no lagged differences, computed the same way for
+the data and the replicates. Like the calibration, the p-value of the pair is the worst day and its half life is
+the nobs weighted average of the days, per replicate. Resamples are drawn as one (replicates, samples) index
+array per chunk and the regressions are closed form over the replicate axis. Pairs run on a process pool, each
+with a generator seeded from the seed and the name of the pair, so the results do not depend on the number of
+workers or the order of the pairs.
+"""
+import zlib
+import logging
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Dict, Tuple
+
+CHUNK_SIZE = 250  # Replicates resampled at once, bounds the memory to a few (chunk, samples) arrays
+CI_LEVEL = 0.95
+
+
+def default_block_length(nr_samples: int) -> int:
+    return max(int(round(nr_samples ** (1 / 3))), 1)
+
+
+def block_indices(rng: np.random.Generator, nr_replicates: int, nr_samples: int, block_length: int) -> np.ndarray:
+    """(nr_replicates, nr_samples) indices of moving blocks with uniform random starts."""
+    block_length = min(block_length, nr_samples)
+    nr_blocks = -(-nr_samples // block_length)
+    starts = rng.integers(0, nr_samples - block_length + 1, size=(nr_replicates, nr_blocks))
+    return (starts[:, :, None] + np.arange(block_length)).reshape(nr_replicates, -1)[:, :nr_samples]
+
+
+def _demean(x: np.ndarray) -> np.ndarray:
+    return x - x.mean(axis=-1, keepdims=True)
+
+
+def engle_granger_stat(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Dickey-Fuller t-stat of the residual of y on x with a constant, over the last axis."""
+    x = _demean(x)
+    y = _demean(y)
+    beta = (x * y).sum(axis=-1, keepdims=True) / (x * x).sum(axis=-1, keepdims=True)
+    resid = y - beta * x
+    return dickey_fuller_stat(resid)
+
+
+def dickey_fuller_stat(spread: np.ndarray) -> np.ndarray:
+    lag = _demean(spread[..., :-1])
+    change = _demean(np.diff(spread, axis=-1))
+    lag_ss = (lag * lag).sum(axis=-1)
+    rho = (lag * change).sum(axis=-1) / lag_ss
+    error = change - rho[..., None] * lag
+    sigma2 = (error * error).sum(axis=-1) / (change.shape[-1] - 2)
+    return rho / np.sqrt(sigma2 / lag_ss)
+
+
+def half_life_slope(lag: np.ndarray, change: np.ndarray) -> np.ndarray:
+    """Slope of the spread change on the lagged spread with a constant, over the last axis."""
+    lag = _demean(lag)
+    return (lag * _demean(change)).sum(axis=-1) / (lag * lag).sum(axis=-1)
+
+
+def to_half_life(slope: np.ndarray) -> np.ndarray:
+    """-log(2) / slope, infinite when the spread does not revert."""
+    with np.errstate(divide="ignore"):
+        return np.where(slope < 0, -np.log(2) / np.minimum(slope, -1e-300), np.inf)
+
+
+def bootstrap_day(x: np.ndarray, y: np.ndarray, nr_replicates: int, block_length: int, rng: np.random.Generator) -> Tuple[float, np.ndarray, np.ndarray]:
+    """Observed statistic, the replicated statistics under the null and the replicated half lives of one day."""
+    observed = float(engle_granger_stat(x, y))
+    x0, y0 = x - x.mean(), y - y.mean()
+    beta = (x0 * y0).sum() / (x0 * x0).sum()
+    spread = y0 - beta * x0
+    lag, change = spread[:-1], np.diff(spread)
+    diffs = np.diff(np.stack([x, y]), axis=-1)
+    null_stats = np.empty(nr_replicates)
+    half_lives = np.empty(nr_replicates)
+    for start in range(0, nr_replicates, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, nr_replicates - start)
+        index = block_indices(rng, size, diffs.shape[1], block_length)
+        levels = np.cumsum(diffs[:, index], axis=-1)  # (2, size, samples - 1)
+        null_stats[start:start + size] = engle_granger_stat(levels[0], levels[1])
+        index = block_indices(rng, size, len(lag), block_length)
+        half_lives[start:start + size] = to_half_life(half_life_slope(lag[index], change[index]))
+    return observed, null_stats, half_lives
+
+
+def bootstrap_pair(price_data: pd.DataFrame, asset1: str, asset2: str, nr_replicates: int, seed: int = 0,
+                   block_length: Optional[int] = None) -> dict:
+    """price_data holds the mid prices of the formation days, indexed by time."""
+    rng = np.random.default_rng([seed, zlib.crc32(f"{asset1}-{asset2}".encode())])
+    day_pvalues = []
+    nobs = []
+    half_lives = []
+    for _, day in price_data.groupby(price_data.index.date):
+        x = day[asset1].to_numpy(dtype=np.float64)
+        y = day[asset2].to_numpy(dtype=np.float64)
+        if len(x) < 10:
+            continue
+        observed, null_stats, day_half_lives = bootstrap_day(x, y, nr_replicates, block_length or default_block_length(len(x)), rng)
+        day_pvalues.append((1 + np.count_nonzero(null_stats <= observed)) / (nr_replicates + 1))
+        nobs.append(len(x))
+        half_lives.append(day_half_lives)
+    if len(nobs) == 0:
+        return {"bootstrap p-value": 1.0, "half life ci": [None, None]}
+    weights = np.array(nobs, dtype=np.float64)[:, None] / sum(nobs)
+    half_life = (np.stack(half_lives) * weights).sum(axis=0)
+    tail = (1 - CI_LEVEL) / 2
+    low, high = np.quantile(half_life, [tail, 1 - tail], method="inverted_cdf")  # No interpolation, the upper tail can be infinite
+    return {"bootstrap p-value": max(day_pvalues),
+            "half life ci": [round(float(low), 1) if np.isfinite(low) else None, round(float(high), 1) if np.isfinite(high) else None]}
+
+
+def _bootstrap_task(task: tuple) -> Tuple[str, dict]:
+    price_data, asset1, asset2, nr_replicates, seed, block_length = task
+    return f"{asset1}-{asset2}", bootstrap_pair(price_data, asset1, asset2, nr_replicates, seed, block_length)
+
+
+def bootstrap_pairs(mid_prices: pd.DataFrame, pairs: List[Tuple[str, str]], nr_replicates: int, seed: int = 0,
+                    block_length: Optional[int] = None, nr_workers: Optional[int] = None) -> Dict[str, dict]:
+    """Bootstrap results by pair name. Each worker gets the two columns of its pair only."""
+    if len(pairs) == 0:
+        return {}
+    tasks = [(mid_prices[[asset1, asset2]], asset1, asset2, nr_replicates, seed, block_length) for asset1, asset2 in pairs]
+    logging.info(f"Bootstrap of {len(pairs)} pairs with {nr_replicates} replicates")
+    if nr_workers == 1 or len(pairs) == 1:
+        return dict(map(_bootstrap_task, tasks))
+    with ProcessPoolExecutor(max_workers=nr_workers) as executor:
+        return dict(executor.map(_bootstrap_task, tasks))
@@ -0,0 +1,111 @@
+import os
+import time
+import zlib
+import pickle
+import asyncio
+import logging
+import datetime
+from typing import Optional, List
+from core import DataClient, OrderManager, TimeSource
+from PairTrade import PairTrade
+
+
+class Checkpointer:
+
+    def __init__(self,
+                 dataclient: DataClient,
+                 ordermanager: OrderManager,
+                 pair_trades: List[PairTrade],
+                 checkpoint_folder: str = "checkpoints",
+                 interval: float = 10,
+                 max_age: float = 900):
+        self._dataclient : DataClient = dataclient
+        self._ordermanager : OrderManager = ordermanager
+        self._pair_trades : List[PairTrade] = pair_trades
+        self._checkpoint_folder : str = checkpoint_folder
+        self._interval : float = interval
+        self._max_age : float = max_age
+        self._today : str = TimeSource.today().strftime('%Y%m%d')
+        self._checkpoint_filename : str = os.path.join(self._checkpoint_folder, f"checkpoint_{self._today}.pkl.z")
+        self._last_write_duration : Optional[float] = None
+
+    def snapshot(self) -> dict:
+        """Copy all state on the event loop. Only plain python objects are taken, so the write can happen in another thread."""
+        return {"date": self._today,
+                "timestamp": TimeSource.time(),
+                "dataclient": self._dataclient.get_state(),
+                "pairs": {pair.get_name(): pair.get_state() for pair in self._pair_trades}}
+
+    def _write(self, snapshot: dict) -> None:
+        start = time.perf_counter()
+        payload = zlib.compress(pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        os.makedirs(self._checkpoint_folder, exist_ok=True)
+        tmp_filename = self._checkpoint_filename + ".tmp"
+        with open(tmp_filename, 'wb') as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, self._checkpoint_filename)  # Atomic, a crash never leaves a half-written checkpoint
+        self._last_write_duration = time.perf_counter() - start
+
+    async def save(self) -> None:
+        snapshot = self.snapshot()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, snapshot)
+        except Exception as e:
+            logging.warning(f"Failed to write checkpoint {self._checkpoint_filename}: {e}")
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            await self.save()
+
+    def load(self) -> Optional[dict]:
+        if not os.path.exists(self._checkpoint_filename):
+            logging.info(f"No checkpoint {self._checkpoint_filename} to restore from")
+            return None
+        try:
+            with open(self._checkpoint_filename, 'rb') as file:
+                state = pickle.loads(zlib.decompress(file.read()))
+        except Exception as e:
+            logging.warning(f"Cannot load checkpoint {self._checkpoint_filename}! Error: {e}")
+            return None
+        age = TimeSource.time() - state["timestamp"]
+        if state["date"] != self._today or age > self._max_age:
+            logging.info(f"Checkpoint {self._checkpoint_filename} is {age:.0f} seconds old, max age is {self._max_age}. Not restoring")
+            return None
+        return state
+
+    def restore_state(self, state: dict) -> None:
+        """Refill in-memory state. Must be called before the data stream and the pair loops start."""
+        self._dataclient.restore_state(state["dataclient"])
+        for pair in self._pair_trades:
+            pair_state = state["pairs"].get(pair.get_name(), None)
+            if pair_state is not None:
+                pair.restore_state(pair_state)
+
+    async def reconcile(self, state: dict) -> None:
+        """Align restored pair state with the live account instead of flattening the book."""
+        await self._dataclient._position_manager.get_positions(force_refresh=True)
+
+        for pair in self._pair_trades:
+            for order_id in pair._pending_order_ids:  # Orders of the dead session, the pair loop re-issues its target
+                await self._ordermanager.cancel_order(order_id)
+            pair._pending_order_ids = []
+
+            positions = {symbol: self._dataclient.get_position_by_symbol(symbol) for symbol in pair.get_symbols()}
+            if pair._spread_position != 0 and all(position == 0 for position in positions.values()):
+                logging.warning(f"Checkpoint has spread position {pair._spread_position} for {pair.get_name()} but account is flat. Reset to flat")
+                pair._spread_position = 0
+                pair._signal = None
+            elif pair._spread_position == 0 and any(position != 0 for position in positions.values()):
+                logging.warning(f"Checkpoint is flat for {pair.get_name()} but account holds " + " and ".join(f"{position} {symbol}" for symbol, position in positions.items()) + ". Close positions")
+                pair._signal = 0
+
+        pair_symbols = {symbol for pair in self._pair_trades for symbol in pair.get_symbols()}
+        for symbol in list(self._dataclient.get_all_positions()):
+            if symbol not in pair_symbols and self._dataclient.get_position_by_symbol(symbol) != 0:
+                logging.warning(f"Position in {symbol} does not belong to any pair. Close position")
+                await self._ordermanager.close_position(symbol)
+        logging.info(f"Reconciled checkpoint taken at {datetime.datetime.fromtimestamp(state['timestamp'])} with live positions")
@@ -1,13 +1,19 @@
+import math
 import asyncio
 import aiohttp
 import logging 
 import json
 from collections import defaultdict, deque
-from typing import Optional, Set
+from typing import Optional, Set, Callable, List, Dict, Tuple, Iterable
 import time
 import datetime
+import runtime
+from order_events import OrderEventStore, ARCHIVE_FOLDER
+from recorder import MarketDataRecorder
+from response_cache import ResponseCache, CALENDAR_TTL
 
 from alpaca_trade_api.common import URL
+from alpaca_trade_api.entity import Trade, Bar
 from alpaca_trade_api.stream import Stream
 logging.basicConfig(level=logging.INFO , format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -16,7 +22,10 @@ PARTIAL_FILL = "partial_fill"
 FILL_EVENT = [FILL, PARTIAL_FILL]
 
 CANCELED = "canceled"
-ORDER_CYLE_END_EVENT = [FILL, CANCELED]
+EXPIRED = "expired"
+REJECTED = "rejected"
+REPLACED = "replaced"
+ORDER_CYLE_END_EVENT = [FILL, CANCELED, EXPIRED, REJECTED, REPLACED]
 
 
 SIDE_BUY = 'buy'
@@ -67,26 +76,164 @@ class Credentials:
         return cls.headers
 
 
+class Endpoints:
+    trading_url = "https://paper-api.alpaca.markets"
+    data_stream_url = "https://stream.data.alpaca.markets"
+
+    @classmethod
+    def configure(cls, trading_url: Optional[str] = None, data_stream_url: Optional[str] = None):
+        """Point all clients at another server, e.g. the local simulator. Must be called before the clients are created."""
+        if trading_url is not None:
+            cls.trading_url = trading_url
+        if data_stream_url is not None:
+            cls.data_stream_url = data_stream_url
+
+
+class TimeSource:
+    """Clock of the trading components. Wall time unless a replay installs the clock of its virtual time event loop."""
+    _time_ns : Callable[[], int] = time.time_ns
+    _monotonic : Callable[[], float] = time.monotonic
+
+    @classmethod
+    def configure(cls, time_ns: Optional[Callable[[], int]] = None, monotonic: Optional[Callable[[], float]] = None):
+        if time_ns is not None:
+            cls._time_ns = time_ns
+        if monotonic is not None:
+            cls._monotonic = monotonic
+
+    @classmethod
+    def reset(cls):
+        cls._time_ns = time.time_ns
+        cls._monotonic = time.monotonic
+
+    @classmethod
+    def time_ns(cls) -> int:
+        return cls._time_ns()
+
+    @classmethod
+    def time(cls) -> float:
+        return cls._time_ns() / 1e9
+
+    @classmethod
+    def monotonic(cls) -> float:
+        return cls._monotonic()
+
+    @classmethod
+    def today(cls) -> datetime.date:
+        return datetime.datetime.fromtimestamp(cls.time()).date()
+
+
+POOL_TRADING = "trading"
+POOL_DATA = "data"
+ALL_POOLS = [POOL_TRADING, POOL_DATA]
+
+
 class Client:
+    """Shared REST sessions, one connection pool each. session carries the orders and the position closes, data_session the
+    reads (clock, calendar, positions), so a slow read never holds a connection an order waits for."""
     session = None
+    data_session = None
+    trace_configs : List[aiohttp.TraceConfig] = []
+    pool_sizes : Dict[str, int] = {POOL_TRADING: 8, POOL_DATA: 4}
+    dns_cache_ttl : int = 300  # Seconds, aiohttp caches 10 by default
+    keepalive_timeout : float = 60.0  # Idle seconds before the connector closes a pooled connection
+    _connections : Dict[str, Dict[str, int]] = {pool: {"created": 0, "reused": 0} for pool in ALL_POOLS}
+    _last_request : Dict[str, float] = {pool: 0.0 for pool in ALL_POOLS}
+
+    @classmethod
+    def configure(cls, pool_sizes: Optional[Dict[str, int]] = None, dns_cache_ttl: Optional[int] = None, keepalive_timeout: Optional[float] = None):
+        """Sizes of the pools and connector settings, used by the sessions started afterwards."""
+        if pool_sizes is not None:
+            cls.pool_sizes = {**cls.pool_sizes, **pool_sizes}
+        if dns_cache_ttl is not None:
+            cls.dns_cache_ttl = dns_cache_ttl
+        if keepalive_timeout is not None:
+            cls.keepalive_timeout = keepalive_timeout
+
+    @classmethod
+    def _new_session(cls, pool: str) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(limit=cls.pool_sizes[pool], limit_per_host=cls.pool_sizes[pool], use_dns_cache=True,
+                                         ttl_dns_cache=cls.dns_cache_ttl, keepalive_timeout=cls.keepalive_timeout)
+        return aiohttp.ClientSession(connector=connector, headers=Credentials.HEADERS(), json_serialize=runtime.json_dumps,
+                                     trace_configs=list(cls.trace_configs) + [cls._pool_trace_config(pool)])
+
+    @classmethod
+    def _pool_trace_config(cls, pool: str) -> aiohttp.TraceConfig:
+        """Counts the connections opened and reused by the pool and stamps its last request."""
+        connections = cls._connections[pool]
+
+        async def on_connection_create_end(session, context, params) -> None:
+            connections["created"] += 1
+
+        async def on_connection_reuseconn(session, context, params) -> None:
+            connections["reused"] += 1
+
+        async def on_request_end(session, context, params) -> None:
+            cls._last_request[pool] = TimeSource.monotonic()
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
 
     @classmethod
     async def start_session(cls):
         if not cls.session:
-            cls.session = aiohttp.ClientSession(headers=Credentials.HEADERS())
+            cls.session = cls._new_session(POOL_TRADING)
+        if not cls.data_session:
+            cls.data_session = cls._new_session(POOL_DATA)
+
+    @classmethod
+    def get_session(cls, pool: str):
+        return cls.session if pool == POOL_TRADING else cls.data_session
+
+    @classmethod
+    def use_session(cls, session) -> None:
+        """Replaces both shared sessions, e.g. by the in-process session of replay.SimulatedBroker."""
+        cls.session = session
+        cls.data_session = session
+
+    @classmethod
+    async def add_trace_config(cls, trace_config: aiohttp.TraceConfig) -> None:
+        """Traces the requests of the shared sessions. Open sessions are replaced, since trace configs are fixed at creation."""
+        cls.trace_configs.append(trace_config)
+        if cls.session:
+            await cls.close_session()
+            await cls.start_session()
+
+    @classmethod
+    def idle_time(cls, pool: str) -> float:
+        """Seconds since the last response on the pool."""
+        return TimeSource.monotonic() - cls._last_request[pool]
+
+    @classmethod
+    def get_connection_stats(cls) -> Dict[str, dict]:
+        """Connections opened and reused per pool. A reuse ratio near 1 means the requests find a warm connection."""
+        stats = {}
+        for pool, connections in cls._connections.items():
+            total = connections["created"] + connections["reused"]
+            stats[pool] = {**connections, "reuse ratio": connections["reused"] / total if total > 0 else None}
+        return stats
 
     @classmethod
     async def close_session(cls):
+        if cls.data_session and cls.data_session is not cls.session:
+            await cls.data_session.close()
+        cls.data_session = None
         if cls.session:
             await cls.session.close()
             cls.session = None
 
 class DataClient(): 
-    def __init__(self, max_nr_trade_history: int = 100, max_nr_bar_history: int = 100, symbols : Optional[Set[str]] = None):   
+    def __init__(self, max_nr_trade_history: int = 100, max_nr_bar_history: int = 100, symbols : Optional[Set[str]] = None,
+                 recorder: Optional[MarketDataRecorder] = None, stream_factory: Optional[Callable[[], Stream]] = None,
+                 order_events_folder: str = ARCHIVE_FOLDER):   
         self._max_trade_history = max_nr_trade_history
         self._max_bar_history = max_nr_bar_history
-        self._symbols = symbols if symbols is not None else set()
-        self._base_url = URL('https://paper-api.alpaca.markets')
+        self._symbols = set(symbols) if symbols is not None else set()
+        self._base_url = URL(Endpoints.trading_url)
+        self._data_stream_url = URL(Endpoints.data_stream_url)
         self._data_feed = "iex"
         self._last_trade_price = {}
         #self._trade_tick_hist = defaultdict(deque)
@@ -97,26 +244,89 @@ class DataClient():
         self._last_bar = {}
         #self._bar_hist = defaultdict(deque)
         self._bar_hist = defaultdict(lambda: deque(maxlen=self._max_bar_history))
-        self._trade_update = defaultdict(dict)
+        self._order_events = OrderEventStore(terminal_events=ORDER_CYLE_END_EVENT, archive_folder=order_events_folder, today=TimeSource.today)
+        self._quote_listeners = {}
+        self._trade_update_listeners = []
+        self._nr_quotes : Dict[str, int] = defaultdict(int)  # Message counters for the metrics endpoint
+        self._nr_trades : Dict[str, int] = defaultdict(int)
+        self._nr_bars : Dict[str, int] = defaultdict(int)
+        self._nr_trade_updates : Dict[str, int] = defaultdict(int)
         self._position_manager = PositionManager()
+        self._recorder = recorder  # Writes every quote, trade and bar to the binary tape when set
+        self._stream : Optional[Stream] = None
+        self._stream_factory : Optional[Callable[[], Stream]] = stream_factory  # Builds the stream instead of the Alpaca one, e.g. replay.SimulatedStream
+        self._subscription_lock : asyncio.Lock = asyncio.Lock()
                       
     async def start(self):
         self._position_manager = await PositionManager.create()
-        stream = Stream(Credentials.KEY_ID(), Credentials.SECRET_KEY(), base_url=self._base_url, data_feed=self._data_feed)
-        stream.subscribe_trades(self.on_trade, *self._symbols)
-        stream.subscribe_quotes(self.on_quote, *self._symbols)
-        stream.subscribe_bars(self.on_bar, *self._symbols)
-        stream.subscribe_trade_updates(self.on_trade_update) 
+        if self._recorder is not None:
+            self._recorder.start()
+        if self._stream_factory is not None:
+            stream = self._stream_factory()
+        else:
+            stream = Stream(Credentials.KEY_ID(), Credentials.SECRET_KEY(), base_url=self._base_url, data_stream_url=self._data_stream_url, data_feed=self._data_feed)
+        async with self._subscription_lock:
+            symbols = list(self._symbols)
+            if len(symbols) > 0:
+                stream.subscribe_trades(self.on_trade, *symbols)
+                stream.subscribe_quotes(self.on_quote, *symbols)
+                stream.subscribe_bars(self.on_bar, *symbols)
+            stream.subscribe_trade_updates(self.on_trade_update) 
+            self._stream = stream
         if asyncio.get_event_loop().is_running():
             await stream._run_forever()
         else:
             await stream.run()
+
+    def get_symbols(self) -> Set[str]:
+        return set(self._symbols)
+
+    async def subscribe(self, symbols: Iterable[str]) -> Set[str]:
+        """Adds symbols to the live stream and returns the ones that were not subscribed yet.
+
+        The SDK sends the subscription with run_coroutine_threadsafe(...).result(), which would deadlock on the
+        loop thread, so it is called from the default executor.
+        """
+        async with self._subscription_lock:
+            new_symbols = set(symbols) - self._symbols
+            if len(new_symbols) == 0:
+                return new_symbols
+            self._symbols |= new_symbols
+            if self._stream is not None:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._stream.subscribe_trades, self.on_trade, *new_symbols)
+                await loop.run_in_executor(None, self._stream.subscribe_quotes, self.on_quote, *new_symbols)
+                await loop.run_in_executor(None, self._stream.subscribe_bars, self.on_bar, *new_symbols)
+            logging.info(f"Subscribed to {sorted(new_symbols)}")
+            return new_symbols
+
+    async def unsubscribe(self, symbols: Iterable[str]) -> Set[str]:
+        """Removes symbols from the live stream and forgets their last prices, so a later subscribe never sees stale quotes."""
+        async with self._subscription_lock:
+            old_symbols = set(symbols) & self._symbols
+            if len(old_symbols) == 0:
+                return old_symbols
+            self._symbols -= old_symbols
+            if self._stream is not None:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._stream.unsubscribe_trades, *old_symbols)
+                await loop.run_in_executor(None, self._stream.unsubscribe_quotes, *old_symbols)
+                await loop.run_in_executor(None, self._stream.unsubscribe_bars, *old_symbols)
+            for symbol in old_symbols:
+                self._last_quote.pop(symbol, None)
+                self._last_mid_price.pop(symbol, None)
+                self._last_trade_price.pop(symbol, None)
+            logging.info(f"Unsubscribed from {sorted(old_symbols)}")
+            return old_symbols
     
     async def on_trade(self,trade_tick ) -> None:    
         symbol = trade_tick.symbol
+        self._nr_trades[symbol] += 1
         self._last_trade_price[symbol] = trade_tick.price
         _trade_hist_to_update = self._trade_tick_hist[symbol]
         _trade_hist_to_update.append(trade_tick)
+        if self._recorder is not None:
+            self._recorder.record_trade(trade_tick)
         #while len(_trade_hist_to_update) > self._max_trade_history:
         #    _trade_hist_to_update.popleft()
         #logging.info(trade_tick)
@@ -126,10 +336,17 @@ class DataClient():
                                                   
     async def on_quote(self, quote) -> None:
         symbol = quote.symbol
+        self._nr_quotes[symbol] += 1
         self._last_quote[symbol] = quote
+        if self._recorder is not None:
+            self._recorder.record_quote(quote)
         if quote.ask_price != 0 and quote.bid_price != 0:
             midprice = (quote.ask_price + quote.bid_price) * 0.5 
             self._last_mid_price[symbol] = midprice
+            listeners = self._quote_listeners.get(symbol, None)
+            if listeners is not None:
+                for listener in listeners:
+                    listener(symbol, midprice)
         else: 
             pass        
         #logging.info(quote)
@@ -140,11 +357,33 @@ class DataClient():
     def get_last_quote(self, symbol : str) -> Optional[dict]:
         return self._last_quote.get(symbol, None) 
 
+    def add_quote_listener(self, symbol: str, listener: Callable[[str, float], None]) -> None:
+        """listener(symbol, mid price) is called synchronously on every quote with a valid mid price, it must not block."""
+        self._quote_listeners.setdefault(symbol, []).append(listener)
+
+    def add_trade_update_listener(self, listener: Callable) -> None:
+        """listener(trade_update) is called synchronously after the position of the order's symbol is updated."""
+        self._trade_update_listeners.append(listener)
+
+    def remove_trade_update_listener(self, listener: Callable) -> None:
+        if listener in self._trade_update_listeners:
+            self._trade_update_listeners.remove(listener)
+
+    def remove_quote_listener(self, symbol: str, listener: Callable[[str, float], None]) -> None:
+        listeners = self._quote_listeners.get(symbol, [])
+        if listener in listeners:
+            listeners.remove(listener)
+        if len(listeners) == 0:
+            self._quote_listeners.pop(symbol, None)
+
     async def on_bar(self, bar) -> None:
         symbol = bar.symbol
+        self._nr_bars[symbol] += 1
         self._last_bar[symbol] = bar
         _bar_hist_to_update = self._bar_hist[symbol]
         _bar_hist_to_update.append(bar)
+        if self._recorder is not None:
+            self._recorder.record_bar(bar)
     
     def get_last_bar(self, symbol):
         return self._last_bar.get(symbol, None)
@@ -157,12 +396,15 @@ class DataClient():
         id = trade_update.order["id"]      
         filled_qty = trade_update.order["filled_qty"]
         side = trade_update.order["side"]
+        self._nr_trade_updates[trade_update.event] += 1
         #logging.info(f"Symbol: {symbol}, ID: {id}, Type of _trade_update[symbol]: {type(self._trade_update[symbol])}")  
         if trade_update.event in FILL_EVENT:   ## TODO order status update : fill, cancel, rejected 
             #print(f"update position for {symbol}")
             position_qty = float(trade_update.position_qty) 
             await self._position_manager.update_position(symbol, position_qty)
-        self._trade_update[symbol][id] = trade_update
+        self._order_events.add(trade_update)
+        for listener in self._trade_update_listeners:
+            listener(trade_update)
         #logging.info(trade_update)
         if (trade_update.event == PARTIAL_FILL):
             logging.info(f"PARTIAL FILL: {side} order for {symbol}, filled {filled_qty}.")
@@ -173,14 +415,21 @@ class DataClient():
     #def get_trade_update(self, symbol : str, id :str):
     #        return self._trade_update.get(symbol, None)
         
-    def get_trade_update(self, symbol: str, id: str = None):
-        symbol_trades = self._trade_update.get(symbol, {})
+    def get_trade_update(self, symbol: str, id: str = None, search_archive: bool = False):
         if id is None:
-            return symbol_trades  # Return all trade updates for the symbol
+            return self._order_events.get_by_symbol(symbol)  # Working orders and recently completed ones for the symbol
         else:
-            return symbol_trades.get(id)  # Return a specific trade update for the id
+            return self._order_events.get(id, search_archive=search_archive)  # Return a specific trade update for the id, search_archive blocks on a file scan
+
+    async def get_archived_trade_update(self, id: str):
+        """Trade update of an order, evicted ones are read from the archive in the default executor."""
+        return await self._order_events.get_archived(id)
 
     
+    def get_message_counts(self) -> dict:
+        """Quotes, trades and bars received per symbol and trade updates per event since the start."""
+        return {"quote": self._nr_quotes, "trade": self._nr_trades, "bar": self._nr_bars, "trade update": self._nr_trade_updates}
+
     def get_position_by_symbol(self, symbol) -> float:
         position_info = self._position_manager._positions_by_symbol.get(symbol, None)
         if position_info is not None:
@@ -201,11 +450,29 @@ class DataClient():
             position_object = self._position_manager._position_objects_by_symbol.get(symbol, None)
         return position_object
 
+    def get_state(self) -> dict:
+        """Snapshot of the trade and bar ring buffers. Entities are stored as their raw dicts."""
+        return {"last trade price": dict(self._last_trade_price),
+                "trade tick hist": {symbol: [trade._raw for trade in hist] for symbol, hist in self._trade_tick_hist.items()},
+                "last bar": {symbol: bar._raw for symbol, bar in self._last_bar.items()},
+                "bar hist": {symbol: [bar._raw for bar in hist] for symbol, hist in self._bar_hist.items()}}
+
+    def restore_state(self, state: dict) -> None:
+        """Refill the ring buffers from a snapshot taken by get_state. Last quotes and mid prices are not restored, they are stale by definition."""
+        for symbol, price in state["last trade price"].items():
+            self._last_trade_price.setdefault(symbol, price)
+        for symbol, hist in state["trade tick hist"].items():
+            self._trade_tick_hist[symbol].extend(Trade(raw) for raw in hist)
+        for symbol, raw in state["last bar"].items():
+            self._last_bar.setdefault(symbol, Bar(raw))
+        for symbol, hist in state["bar hist"].items():
+            self._bar_hist[symbol].extend(Bar(raw) for raw in hist)
+
 
 class PositionManager():
     def __init__(self):
         #self.session = None 
-        self._pos_url = "https://paper-api.alpaca.markets/v2/positions"
+        self._pos_url = f"{Endpoints.trading_url}/v2/positions"
         self._position_objects_by_symbol = {}
         self._positions_by_symbol = {}
         self._last_update_time = 0
@@ -219,7 +486,7 @@ class PositionManager():
     
     async def get_positions(self, symbol=None, force_refresh=False):
         """Fetch positions from Alpaca API, with optional force refresh."""
-        current_time = time.time()
+        current_time = TimeSource.time()
 
         # Check if we need to refresh the positions (e.g., every 60 seconds or if forced)
         if not force_refresh and (current_time - self._last_update_time < 5):
@@ -228,9 +495,9 @@ class PositionManager():
 
         url = f"{self._pos_url}/{symbol}" if symbol else self._pos_url
         try:
-            async with Client.session.get(url) as result:
+            async with Client.data_session.get(url) as result:
                 if result.status == 200:
-                    response = await result.json()
+                    response = await result.json(loads=runtime.json_loads)
                     if symbol:
                         response = [response]  # Ensure uniform list format
 
@@ -261,28 +528,48 @@ class PositionManager():
 
 
 class OrderManager():
-    def __init__(self):
-        self._order_url = "https://paper-api.alpaca.markets/v2/orders"
-        self._pos_url = "https://paper-api.alpaca.markets/v2/positions"
+    def __init__(self, risk_manager: Optional["RiskManager"] = None):
+        self._order_url = f"{Endpoints.trading_url}/v2/orders"
+        self._pos_url = f"{Endpoints.trading_url}/v2/positions"
+        self._risk_manager : Optional[RiskManager] = risk_manager
+        self._nr_requests : Dict[str, int] = defaultdict(int)  # Order requests by outcome, for the metrics endpoint
         self.session = None  # We'll initialize this in an async context
         #self._submitted_order_by_order_id = defaultdict(dict)
            
     async def start(self):
-        if not Client.session:
-            await Client.start_session()
+        await Client.start_session()
+
+    def get_request_counts(self) -> Dict[str, int]:
+        """Order requests since the start by outcome: inserted, insert failed, risk rejected, canceled, cancel failed."""
+        return self._nr_requests
+
+    def get_risk_manager(self) -> Optional["RiskManager"]:
+        return self._risk_manager
 
     async def insert_order(self, symbol: str, price: float, quantity: int, side: str, order_type: str):
         assert side in ALL_SIDES, f"side must be one of {ALL_SIDES}"
         assert order_type in ALL_ORDER_TYPES, f"order_type must be one of {ALL_ORDER_TYPES}"
-        params = {"symbol": symbol,"qty": quantity, "side": side, "type": ORDER_TYPE_LIMIT, "limit_price": price,"time_in_force": order_type}
-        await Client.start_session()
+        if self._risk_manager is not None:
+            error = self._risk_manager.check_order(symbol, price, quantity, side)
+            if error is not None:
+                logging.warning(f"Order Rejected by Risk Manager - Symbol : {symbol}, Qty : {quantity}, Side : {side}, Price : {price}. {error}")
+                self._nr_requests["risk rejected"] += 1
+                return InsertOrderResponse(success=False, order_id=None, error=error)
+        response = await self._insert_order(symbol, price, quantity, side, order_type)
+        self._nr_requests["inserted" if response.success else "insert failed"] += 1
+        if self._risk_manager is not None:
+            self._risk_manager.on_order_inserted(symbol, quantity, side, response.order_id if response.success else None)
+        return response
+
+    async def _insert_order(self, symbol: str, price: float, quantity: int, side: str, order_type: str):
+        params = {"symbol": symbol,"qty": quantity, "side": side, "type": ORDER_TYPE_LIMIT, "limit_price": price,"time_in_force": order_type}  # The session is opened by start()
         try:
             async with Client.session.post(self._order_url, json=params) as result:
             #async with self.session.post(self._order_url, json=params) as result:
                 response_text = await result.text()
                 if result.status == 200:
                     logging.info(f"Succesful Order Insertion - Symbol : {symbol}, Qty : {quantity}, Side : {side}, Price : {price}")
-                    order_response = await result.json()
+                    order_response = runtime.json_loads(response_text)
                     #logging.info(f"Successful Order Insertion: {order_response}")
                     symbol = order_response["symbol"]
                     id = order_response["id"]
@@ -304,7 +591,7 @@ class OrderManager():
                 response_text = await result.text()
                 if result.status == 207:  # Handle Multi-Status responses
                     logging.info("Close All Positions Request Received Multi-Status Response")
-                    response = await result.json()
+                    response = runtime.json_loads(response_text)
 
                     # Process each individual response in the multi-status response
                     for individual_response in response:
@@ -357,7 +644,7 @@ class OrderManager():
                 # Check for a successful response.
                 if result.status == 200:
                     logging.info(f"Closed position for {symbol}.")
-                    order_response = await result.json()
+                    order_response = runtime.json_loads(response_text)
                     logging.info(f"Order response: {order_response}")
                     return ClosePositionResponse(symbol=symbol, success=True, status=result.status)
                 else:
@@ -376,7 +663,7 @@ class OrderManager():
 
                 if result.status == 207:  # Multi-Status
                     logging.info("Received multi-status response for canceling all orders.")
-                    order_statuses = await result.json()  # Parse the JSON response
+                    order_statuses = await result.json(loads=runtime.json_loads)  # Parse the JSON response
 
                     # Process each order's cancellation status
                     success = True
@@ -414,23 +701,45 @@ class OrderManager():
                 # Check for the success code (204)
                 if result.status == 204:
                     logging.info(f"Successfully canceled Order ID : {order_id}")
+                    self._nr_requests["canceled"] += 1
                     return CancelOrderResponse(success=True)
                 elif result.status == 404:
                     logging.warning(f"Order {order_id} not found: {response_text}")
+                    self._nr_requests["cancel failed"] += 1
                     return CancelOrderResponse(success=False, error="Order not found")
                 elif result.status == 422:
                     logging.warning(f"Order {order_id} is no longer cancelable (Status {result.status}): {response_text}")
+                    self._nr_requests["cancel failed"] += 1
                     return CancelOrderResponse(success=False, error="Order no longer cancelable")
                 else:
                     logging.warning(f"Failed to cancel order {order_id} (Status {result.status}): {response_text}")
+                    self._nr_requests["cancel failed"] += 1
                     return CancelOrderResponse(success=False, error=f"Failed with status {result.status}")
         except Exception as e:
             logging.warning(f"Error cancelling order {order_id}: {e}")
+            self._nr_requests["cancel failed"] += 1
             return CancelOrderResponse(success=False, error=str(e))
     
 
     
-    ## TODO Get orders and get order by id
+    async def get_orders(self, status: str = "open", symbols: Optional[List[str]] = None, limit: int = 500) -> Optional[List[dict]]:
+        params = {"status": status, "limit": limit}
+        if symbols:
+            params["symbols"] = ",".join(symbols)
+        await Client.start_session()
+        try:
+            async with Client.session.get(self._order_url, params=params) as result:
+                response_text = await result.text()
+                if result.status == 200:
+                    return runtime.json_loads(response_text)
+                else:
+                    logging.warning(f"Failed to get {status} orders (Status {result.status}): {response_text}")
+                    return None
+        except Exception as e:
+            logging.warning(f"Error getting {status} orders: {e}")
+            return None
+
+    ## TODO Get order by id
 
     ## Todo 
     async def replace_order(self):
@@ -475,21 +784,22 @@ class CancelAllOrdersResponse:
     
 class MarketClockCalendar:
 
-    def __init__(self):
-        self._clock_url = "https://paper-api.alpaca.markets/v2/clock"
-        self._calendar_url = "https://paper-api.alpaca.markets/v2/calendar"
+    def __init__(self, cache: Optional[ResponseCache] = None, calendar_ttl: float = CALENDAR_TTL):
+        self._clock_url = f"{Endpoints.trading_url}/v2/clock"
+        self._calendar_url = f"{Endpoints.trading_url}/v2/calendar"
         self.session = None  # We'll initialize this in an async context
+        self._cache : Optional[ResponseCache] = cache  # Calendar responses only, the clock is never cached
+        self._calendar_ttl : float = calendar_ttl
 
     async def start(self):
-        if not Client.session:
-            await Client.start_session()
+        await Client.start_session()
 
     async def get_market_clock_info(self) -> Optional[dict]:
         try:
-            async with Client.session.get(self._clock_url) as result:
+            async with Client.data_session.get(self._clock_url) as result:
                 response_text = await result.text()
                 if result.status == 200:
-                    market_clock_info = await result.json()   
+                    market_clock_info = runtime.json_loads(response_text)   
                     return market_clock_info
                 else:
                     logging.warning(f"Failed to get market clock info. Error (Status {result.status}): {response_text} ")
@@ -501,11 +811,18 @@ class MarketClockCalendar:
         allowed_date_types = ["TRADING" , "SETTLEMENT"]
         assert date_type in allowed_date_types, f"date_type must in {allowed_date_types}"
         _calendar_url_params = self._calendar_url + f"?start={start}T00%3A00%3A00Z&end={end}T23%3A59%3A59Z&date_type={date_type}"
+        cache_request = (self._calendar_url, {"start": start, "end": end, "date_type": date_type})
+        if self._cache is not None:
+            payload = self._cache.get(*cache_request, ttl=self._calendar_ttl)
+            if payload is not None:
+                return runtime.json_loads(payload)
         try:
-            async with Client.session.get(_calendar_url_params) as result:
+            async with Client.data_session.get(_calendar_url_params) as result:
                 response_text = await result.text()
             if result.status == 200:
-                market_calendar_info = await result.json()   
+                market_calendar_info = runtime.json_loads(response_text)   
+                if self._cache is not None:
+                    self._cache.put(*cache_request, response_text.encode())
                 return market_calendar_info
             else:
                 logging.warning(f"Failed to get market calendar info. Error (Status {result.status}): {response_text} ")
@@ -547,5 +864,197 @@ class ModifyOrderResponse:
 
 
 class RiskManager():
-    pass
+    """Pre-trade checks on the insert_order path of OrderManager.
+
+    The limits are turned into dict lookups when the RiskManager is built, and the exposure of every symbol is
+    kept up to date from the trade updates, so a check is a few dict reads and never a request. Exposure is the
+    position plus the unfilled quantity of the orders sent through the OrderManager, valued at the last mid.
+    Orders that only reduce a position skip the price band, the exposure and rate limits, and are the only ones that pass
+    the kill switch, so flattening never gets stuck behind a fast market.
+    """
+
+    def __init__(self,
+                 dataclient: DataClient,
+                 max_gross_notional: Optional[float] = None,
+                 max_net_notional: Optional[float] = None,
+                 max_order_notional: Optional[float] = None,
+                 max_symbol_notional: Optional[float] = None,
+                 max_symbol_positions: Optional[Dict[str, float]] = None,
+                 max_pair_exposures: Optional[Dict[Tuple[str, str], float]] = None,
+                 max_orders_per_second: Optional[int] = None,
+                 max_price_deviation: Optional[float] = 0.05):
+        self._dataclient : DataClient = dataclient
+        self._max_gross_notional : float = math.inf if max_gross_notional is None else max_gross_notional
+        self._max_net_notional : float = math.inf if max_net_notional is None else max_net_notional
+        self._max_order_notional : float = math.inf if max_order_notional is None else max_order_notional
+        self._max_symbol_notional : float = math.inf if max_symbol_notional is None else max_symbol_notional
+        self._max_symbol_positions : Dict[str, float] = dict(max_symbol_positions) if max_symbol_positions is not None else {}
+        self._max_orders_per_second : float = math.inf if max_orders_per_second is None else max_orders_per_second
+        self._max_price_deviation : float = math.inf if max_price_deviation is None else max_price_deviation
+        self._pairs_by_symbol : Dict[str, List[Tuple[str, float, str]]] = defaultdict(list)  # symbol -> [(other leg, max exposure, pair name)]
+        self._set_pair_exposures(max_pair_exposures)
+        self._order_times : deque = deque()
+        self._open_orders : Dict[str, list] = {}  # order id -> [symbol, signed unfilled quantity]
+        self._pending : Dict[str, float] = defaultdict(float)  # symbol -> signed unfilled quantity of its open orders
+        self._exposure : Dict[str, float] = {}  # symbol -> signed notional of position and open orders
+        self._gross_notional : float = 0.0
+        self._net_notional : float = 0.0
+        self._kill_reason : Optional[str] = None
+        self._nr_rejected : int = 0
+
+    def _set_pair_exposures(self, max_pair_exposures: Optional[Dict[Tuple[str, str], float]]) -> None:
+        pairs_by_symbol = defaultdict(list)
+        for (asset1, asset2), max_exposure in (max_pair_exposures or {}).items():
+            pairs_by_symbol[asset1].append((asset2, max_exposure, f"{asset1}-{asset2}"))
+            pairs_by_symbol[asset2].append((asset1, max_exposure, f"{asset1}-{asset2}"))
+        self._pairs_by_symbol = pairs_by_symbol
+
+    def set_pair_limits(self, max_order_notional: Optional[float], max_pair_exposures: Optional[Dict[Tuple[str, str], float]]) -> None:
+        """Replaces the per pair limits when the traded pairs change."""
+        self._max_order_notional = math.inf if max_order_notional is None else max_order_notional
+        self._set_pair_exposures(max_pair_exposures)
+
+    def start(self) -> None:
+        """Call once the positions of the DataClient are loaded."""
+        self._dataclient.add_trade_update_listener(self._on_trade_update)
+        for symbol in list(self._dataclient.get_all_positions()):
+            self._refresh(symbol)
+        logging.info(f"Risk manager started. Gross notional {self._gross_notional:.2f}, net notional {self._net_notional:.2f}")
+
+    def kill(self, reason: str = "manual") -> None:
+        """Blocks every new order that does not reduce a position, for all pairs at once."""
+        if self._kill_reason is None:
+            logging.warning(f"Kill switch on: {reason}. Only orders that reduce a position are accepted")
+        self._kill_reason = reason
+
+    def reset(self) -> None:
+        if self._kill_reason is not None:
+            logging.warning("Kill switch off")
+        self._kill_reason = None
+
+    def is_killed(self) -> bool:
+        return self._kill_reason is not None
+
+    def get_exposure(self) -> dict:
+        return {"gross notional": self._gross_notional, "net notional": self._net_notional, "open orders": len(self._open_orders),
+                "rejected": self._nr_rejected, "killed": self._kill_reason}
+
+    def _projected_position(self, symbol: str) -> float:
+        return self._dataclient.get_position_by_symbol(symbol) + self._pending.get(symbol, 0.0)
+
+    def _refresh(self, symbol: str) -> None:
+        mid_price = self._dataclient.get_last_mid_price(symbol)
+        if mid_price is None:
+            return
+        exposure = self._projected_position(symbol) * mid_price
+        old_exposure = self._exposure.get(symbol, 0.0)
+        self._gross_notional += abs(exposure) - abs(old_exposure)
+        self._net_notional += exposure - old_exposure
+        self._exposure[symbol] = exposure
+
+    def check_order(self, symbol: str, price: float, quantity: float, side: str) -> Optional[str]:
+        """None if the order may be sent, otherwise the reason it is rejected."""
+        error = self._check_order(symbol, price, quantity, side)
+        if error is not None:
+            self._nr_rejected += 1
+        return error
+
+    def _check_order(self, symbol: str, price: float, quantity: float, side: str) -> Optional[str]:
+        mid_price = self._dataclient.get_last_mid_price(symbol)
+        if mid_price is None:
+            return f"No mid price for {symbol}"
+        self._refresh(symbol)
+        position = self._projected_position(symbol)
+        new_position = position + quantity if side == SIDE_BUY else position - quantity
+        reduce_only = abs(new_position) <= abs(position) and position * new_position >= 0
+        now = TimeSource.monotonic()
+        order_times = self._order_times
+        while len(order_times) > 0 and now - order_times[0] >= 1:
+            order_times.popleft()
+        if not reduce_only:
+            if abs(price - mid_price) > self._max_price_deviation * mid_price:
+                return f"Price {price} is more than {self._max_price_deviation:.1%} away from the mid {mid_price}"
+            if self._kill_reason is not None:
+                return f"Kill switch: {self._kill_reason}"
+            if len(order_times) >= self._max_orders_per_second:
+                return f"More than {self._max_orders_per_second} orders per second"
+            if quantity * mid_price > self._max_order_notional:
+                return f"Order notional {quantity * mid_price:.2f} above {self._max_order_notional}"
+            if abs(new_position) > self._max_symbol_positions.get(symbol, math.inf):
+                return f"Position {new_position} of {symbol} above {self._max_symbol_positions[symbol]}"
+            new_exposure = new_position * mid_price
+            if abs(new_exposure) > self._max_symbol_notional:
+                return f"Notional {new_exposure:.2f} of {symbol} above {self._max_symbol_notional}"
+            old_exposure = self._exposure.get(symbol, 0.0)
+            gross_notional = self._gross_notional + abs(new_exposure) - abs(old_exposure)
+            if gross_notional > self._max_gross_notional:
+                return f"Gross notional {gross_notional:.2f} above {self._max_gross_notional}"
+            net_notional = self._net_notional + new_exposure - old_exposure
+            if abs(net_notional) > self._max_net_notional:
+                return f"Net notional {net_notional:.2f} above {self._max_net_notional}"
+            for other, max_exposure, pair in self._pairs_by_symbol.get(symbol, ()):
+                pair_exposure = abs(new_exposure) + abs(self._exposure.get(other, 0.0))
+                if pair_exposure > max_exposure:
+                    return f"Exposure {pair_exposure:.2f} of the {pair} pair above {max_exposure}"
+        order_times.append(now)
+        self._pending[symbol] += new_position - position  # Reserved until on_order_inserted, so concurrent orders see each other
+        self._refresh(symbol)
+        return None
 
+    def on_order_inserted(self, symbol: str, quantity: float, side: str, order_id: Optional[str]) -> None:
+        """Replaces the reservation of an accepted check_order by the open order. order_id None releases it."""
+        signed_quantity = quantity if side == SIDE_BUY else -quantity
+        self._pending[symbol] -= signed_quantity
+        if order_id is not None:
+            trade_update = self._dataclient.get_trade_update(symbol, order_id)  # The stream can be ahead of the REST response
+            if trade_update is None or trade_update.event not in ORDER_CYLE_END_EVENT:
+                if trade_update is not None:
+                    filled_quantity = float(trade_update.order["filled_qty"])
+                    signed_quantity = signed_quantity - filled_quantity if side == SIDE_BUY else signed_quantity + filled_quantity
+                self._open_orders[order_id] = [symbol, signed_quantity]
+                self._pending[symbol] += signed_quantity
+        self._refresh(symbol)
+
+    def _on_trade_update(self, trade_update) -> None:
+        order = trade_update.order
+        symbol = order["symbol"]
+        open_order = self._open_orders.get(order["id"], None)
+        if open_order is not None:
+            if trade_update.event in ORDER_CYLE_END_EVENT:
+                unfilled = 0.0
+                del self._open_orders[order["id"]]
+            else:
+                unfilled = float(order["qty"]) - float(order["filled_qty"])
+                unfilled = unfilled if order["side"] == SIDE_BUY else -unfilled
+            self._pending[symbol] += unfilled - open_order[1]
+            open_order[1] = unfilled
+        self._refresh(symbol)
+
+
+
+def make_risk_manager(dataclient: DataClient, cointPairsparams: List[dict], total_capital: float, risk_limits: Optional[dict]) -> Optional[RiskManager]:
+    """RiskManager with the notional limits given as multiples of the capital (of each pair for the pair limits). None disables the checks."""
+    if risk_limits is None:
+        return None
+    return RiskManager(dataclient=dataclient,
+                       max_gross_notional=_notional_limit(risk_limits, "max_gross_leverage", total_capital),
+                       max_net_notional=_notional_limit(risk_limits, "max_net_leverage", total_capital),
+                       max_symbol_notional=_notional_limit(risk_limits, "max_symbol_leverage", total_capital),
+                       max_symbol_positions=risk_limits.get("max_symbol_positions", None),
+                       **pair_limits(cointPairsparams, total_capital, risk_limits),
+                       max_orders_per_second=risk_limits.get("max_orders_per_second", None),
+                       max_price_deviation=risk_limits.get("max_price_deviation", None))
+
+
+def _notional_limit(risk_limits: dict, key: str, capital: float) -> Optional[float]:
+    multiple = risk_limits.get(key, None)
+    return None if multiple is None else multiple * capital
+
+
+def pair_limits(cointPairsparams: List[dict], total_capital: float, risk_limits: dict) -> dict:
+    """max_order_notional and max_pair_exposures of RiskManager for the given pairs and baskets, which share the capital equally.
+    Baskets only get the order limit."""
+    capital_per_pair = total_capital / len(cointPairsparams)
+    max_pair_exposure = _notional_limit(risk_limits, "max_pair_leverage", capital_per_pair)
+    return {"max_order_notional": _notional_limit(risk_limits, "max_order_leverage", capital_per_pair),
+            "max_pair_exposures": None if max_pair_exposure is None else {(pair["asset 1"], pair["asset 2"]): max_pair_exposure for pair in cointPairsparams if "assets" not in pair}}
@@ -1,15 +1,25 @@
 import os
-import json
+import pickle
+import runtime
 import datetime
 import asyncio
 import logging
 import numpy as np
 import pandas as pd
 import statsmodels.api as sm 
-from typing import Optional, List , Tuple
+from typing import Optional, List , Tuple, Dict
 from itertools import combinations 
+from collections import defaultdict
 from core import MarketClockCalendar, Client, Credentials
 from alpaca_trade_api.rest import REST
+from recorder import tape_filename, tape_covers, read_tape, tape_to_frame
+from response_cache import ResponseCache
+from johansen import johansen_trace, trace_critical_value
+from bootstrap import bootstrap_pairs
+
+QUOTES_ENDPOINT = "https://data.alpaca.markets/v2/stocks/quotes"
+QUOTE_LIMIT = 3000000
+BASKET_BATCH_SIZE = 256  # Baskets per batched Johansen test, bounds the memory of the stacked price arrays
 
 
 class PairsTradeParamsCalculation():
@@ -18,7 +28,13 @@ class PairsTradeParamsCalculation():
                  symbols : List[str] = None,
                  date : str = None, 
                  lookback : int = None,
-                 downsample : int = None):     
+                 downsample : int = None,
+                 cache : Optional[ResponseCache] = None,
+                 basket_sizes : Optional[List[int]] = None,
+                 basket_prune_pvalue : float = 0.2,
+                 bootstrap_replicates : int = 0,
+                 bootstrap_pvalue : float = 0.05,
+                 bootstrap_seed : int = 0):     
         assert len(symbols) > 1, "Must have at least 1 symbol"
         self._symbols : Optional[List[str]] = symbols
         self._date : str = datetime.datetime.strptime(date, '%Y-%m-%d').date() if date else datetime.datetime.today().date()
@@ -29,16 +45,32 @@ class PairsTradeParamsCalculation():
         self._formation_days : Optional[List[str]] = None
         self._parameters_calculated : Optional[bool] = None
         self._pairs_parameters : Optional[List[dict]] = None
-        self._marketclockcalendar : MarketClockCalendar = MarketClockCalendar()
+        self._cache : ResponseCache = cache if cache is not None else ResponseCache()
+        self._marketclockcalendar : MarketClockCalendar = MarketClockCalendar(cache=self._cache)
         self._market_calendar : pd.DataFrame = None
         self._data_folder_name = "data"
         self._params_folder_name = "params"
-        self._api = REST(Credentials.KEY_ID(), Credentials.SECRET_KEY(), base_url='https://data.alpaca.markets/v2')
+        self._rest : Optional[REST] = None
         self._data_coverage : Optional[bool] = None
         self._pairs : Optional[list] = None
         self._cointPairsParams : Optional[List[dict]] = None
         self._cointPairsParams_no_repeat : Optional[List[dict]] = None
         self._paramsFilename : Optional[str] = None
+        self._quote_requests : Dict[Tuple[str, str], dict] = {}  # (symbol, YYYYMMDD) -> request of the cached quote response
+        self._basket_sizes : List[int] = basket_sizes if basket_sizes is not None else []
+        self._basket_prune_pvalue : float = basket_prune_pvalue  # Baskets are only tested when connected by pairs below this ADF p-value
+        self._pair_pvalues : Dict[Tuple[str, str], float] = {}
+        self._mid_price : Optional[pd.DataFrame] = None
+        self._cointBasketsParams : List[dict] = []
+        self._bootstrap_replicates : int = bootstrap_replicates  # 0 skips the bootstrap stage
+        self._bootstrap_pvalue : float = bootstrap_pvalue
+        self._bootstrap_seed : int = bootstrap_seed
+
+    @property
+    def _api(self) -> REST:
+        if self._rest is None:  # Created on first download, offline use needs no credentials
+            self._rest = REST(Credentials.KEY_ID(), Credentials.SECRET_KEY(), base_url='https://data.alpaca.markets/v2')
+        return self._rest
 
     async def start(self) -> None:
         await self._marketclockcalendar.start()
@@ -81,16 +113,25 @@ class PairsTradeParamsCalculation():
                 if isinstance(date, str):
                     date = datetime.datetime.strptime(date, '%Y-%m-%d')
                 csv_filename = os.path.join(self._data_folder_name, f"{symbol}_{date.strftime('%Y%m%d')}_quote.csv")
+                request = {"symbol": symbol, "start": market_open, "end": market_close, "limit": QUOTE_LIMIT}
 
-                if os.path.exists(csv_filename):
-                    logging.info(f"Data for {symbol} on {date.strftime('%Y-%m-%d')} already exists. Skipping download.")
+                if self._cache.contains(QUOTES_ENDPOINT, request):  # A csv on its own may be a partial download, the cache entry is verified
+                    self._quote_requests[(symbol, date.strftime('%Y%m%d'))] = request
+                    logging.info(f"Data for {symbol} on {date.strftime('%Y-%m-%d')} is in the cache. Skipping download.")
+                    continue
+                if tape_covers(tape_filename(self._data_folder_name, symbol, date.strftime('%Y%m%d')), start=market_open, end=market_close):
+                    logging.info(f"Recorded data for {symbol} on {date.strftime('%Y-%m-%d')} covers the session. Skipping download.")
                     continue
                 
                 logging.info(f"Start downloading quote data for {symbol} on {date.strftime('%Y-%m-%d')}...")
-                quote_data = self._api.get_quotes(symbol=symbol, start=market_open, end=market_close, limit=3000000).df  
+                quote_data = self._api.get_quotes(symbol=symbol, start=market_open, end=market_close, limit=QUOTE_LIMIT).df  
                 logging.info(f"Finished downloading quote data for {symbol} on {date.strftime('%Y-%m-%d')}")
 
-                quote_data.to_csv(csv_filename, index=True)
+                self._cache.put(QUOTES_ENDPOINT, request, pickle.dumps(quote_data, protocol=pickle.HIGHEST_PROTOCOL))
+                self._quote_requests[(symbol, date.strftime('%Y%m%d'))] = request
+                temp_filename = f"{csv_filename}.tmp"  # The csv is for other tools, written atomically as well
+                quote_data.to_csv(temp_filename, index=True)
+                os.replace(temp_filename, csv_filename)
                 logging.info(f"Saved data to {csv_filename}")
                 print("--------------------")
         
@@ -115,7 +156,15 @@ class PairsTradeParamsCalculation():
         self._pairs = list(combinations(self._symbols, 2))
 
     def load_quote_data(self, symbol: str, date: str) -> pd.DataFrame:
+        request = self._quote_requests.get((symbol, date), None)
+        if request is not None:
+            payload = self._cache.get(QUOTES_ENDPOINT, request)
+            if payload is not None:
+                return pickle.loads(payload)
         csv_name = f"{symbol}_{date}_quote.csv"
+        tape_name = tape_filename(self._data_folder_name, symbol, date)
+        if not os.path.exists(f"{self._data_folder_name}/{csv_name}") and os.path.exists(tape_name):
+            return tape_to_frame(read_tape(tape_name))  # Recorded live by DataClient, a tape with gaps is downloaded to the csv instead
         quote_data = pd.read_csv(f"{self._data_folder_name}/{csv_name}", sep=",")
         
         # Convert timestamp to datetime, handling potential errors
@@ -155,71 +204,50 @@ class PairsTradeParamsCalculation():
         return round(halflife, 0)
 
     def cointegration_check_weighted(self, price_data: pd.DataFrame, asset1: str, asset2: str) -> Tuple[bool, Optional[dict]]:
-        res_mean = 0 
-        res_std = 0
-        rsquared_adj = 0
-        const = 0
-        hedge_ratio = 0 
-        half_life = 0
-        p_value_adf_test = 0
-        adjustment_coefficient = 0
-        length = len(price_data)
-
         price_data["date"] = price_data.index.date
         unique_date = price_data["date"].unique()
-
-        for date in unique_date:
-
-            price_data_by_date = price_data[price_data.date == date]
-            weight = len(price_data_by_date) / length
-        
-            # Step 1: Perform OLS regression
-            model1 = sm.OLS(price_data_by_date[asset2], sm.add_constant(price_data_by_date[asset1])).fit()
-            res_by_date = model1.resid  # Note the change to model1.resid
-
-            # Calculate the mean and std of the residual
-            res_mean_by_date = np.mean(res_by_date)
-            res_std_by_date= np.std(res_by_date)
-            rsquared_adj_by_date = model1.rsquared_adj
-            const_by_date = model1.params[0]
-            hedge_ratio_by_date = model1.params[1]
-            half_life_by_date = self.calculate_half_life(np.array(res_by_date))   
-
-            # Step 2: ADF test on residuals
-            adf_test_result_by_date = sm.tsa.stattools.adfuller(res_by_date)
-            p_value_adf_test_by_date = adf_test_result_by_date[1]   
-
-            # Step 3: Error Correction Model (ECM)
-            # Include lagged residuals and the difference of asset1 as regressors
-            asset1_diff = sm.add_constant(pd.concat([price_data_by_date[asset1].diff(), res_by_date.shift(1)], axis=1).dropna())
-            asset2_diff = price_data_by_date[asset2].diff().dropna()
-
-            asset1_diff = asset1_diff.loc[asset2_diff.index]
-            model2 = sm.OLS(asset2_diff, asset1_diff).fit()
-
-            # Step 4: Check if the adjustment coefficient is negative
-            adjustment_coefficient_by_date = list(model2.params)[-1]
-
-            res_mean += res_mean_by_date * weight 
-            res_std += res_std_by_date * weight 
-            rsquared_adj += rsquared_adj_by_date * weight
-            const += const_by_date * weight
-            hedge_ratio += hedge_ratio_by_date * weight
-            half_life += half_life_by_date * weight
-
-            p_value_adf_test = max(p_value_adf_test_by_date, p_value_adf_test)
-            adjustment_coefficient += adjustment_coefficient_by_date * weight
-
-        coint_result = {"asset 1": asset1,
-                        "asset 2": asset2,
-                        "res mean":res_mean ,
-                        "res std":res_std,
-                        "adj rsquared": rsquared_adj,
-                        "constant" : const,
-                        "hedge ratio": hedge_ratio,
-                        "half life": half_life,
-                        "p-value of adf test" : p_value_adf_test,
-                        "adjustment coef":adjustment_coefficient}
+        stats_by_date = [self.cointegration_stats_by_date(price_data[price_data.date == date], asset1, asset2) for date in unique_date]
+        self._pair_pvalues[(asset1, asset2)] = max([stats["p-value of adf test"] for stats in stats_by_date] + [0])
+        return self.combine_cointegration_stats(stats_by_date, asset1, asset2)
+
+    def cointegration_stats_by_date(self, price_data_by_date: pd.DataFrame, asset1: str, asset2: str) -> dict:
+        """Regressions of one formation day. Kept separate so the walk-forward optimizer can reuse them across windows."""
+        # Step 1: Perform OLS regression
+        model1 = sm.OLS(price_data_by_date[asset2], sm.add_constant(price_data_by_date[asset1])).fit()
+        res_by_date = model1.resid  # Note the change to model1.resid
+
+        # Step 2: ADF test on residuals
+        adf_test_result_by_date = sm.tsa.stattools.adfuller(res_by_date)
+
+        # Step 3: Error Correction Model (ECM)
+        # Include lagged residuals and the difference of asset1 as regressors
+        asset1_diff = sm.add_constant(pd.concat([price_data_by_date[asset1].diff(), res_by_date.shift(1)], axis=1).dropna())
+        asset2_diff = price_data_by_date[asset2].diff().dropna()
+
+        asset1_diff = asset1_diff.loc[asset2_diff.index]
+        model2 = sm.OLS(asset2_diff, asset1_diff).fit()
+
+        # Step 4: Check if the adjustment coefficient is negative
+        return {"nobs": len(price_data_by_date),
+                "res mean": np.mean(res_by_date),
+                "res std": np.std(res_by_date),
+                "adj rsquared": model1.rsquared_adj,
+                "constant": model1.params[0],
+                "hedge ratio": model1.params[1],
+                "half life": self.calculate_half_life(np.array(res_by_date)),
+                "p-value of adf test": adf_test_result_by_date[1],
+                "adjustment coef": list(model2.params)[-1]}
+
+    def combine_cointegration_stats(self, stats_by_date: List[dict], asset1: str, asset2: str) -> Tuple[bool, Optional[dict]]:
+        """Weight the daily regressions by the number of data points, the p-value is the worst day."""
+        length = sum(stats["nobs"] for stats in stats_by_date)
+        coint_result = {"asset 1": asset1, "asset 2": asset2}
+        for key in ["res mean", "res std", "adj rsquared", "constant", "hedge ratio", "half life"]:
+            coint_result[key] = sum(stats[key] * (stats["nobs"] / length) for stats in stats_by_date)
+        coint_result["p-value of adf test"] = max([stats["p-value of adf test"] for stats in stats_by_date] + [0])
+        coint_result["adjustment coef"] = sum(stats["adjustment coef"] * (stats["nobs"] / length) for stats in stats_by_date)
+        p_value_adf_test = coint_result["p-value of adf test"]
+        adjustment_coefficient = coint_result["adjustment coef"]
         if (p_value_adf_test < 0.05 ) and (adjustment_coefficient < 0):
             return True, coint_result
         else:
@@ -239,6 +267,7 @@ class PairsTradeParamsCalculation():
             df_mid_price = pd.concat([df_mid_price, midprice_by_formation_day])
             df_mid_price = df_mid_price.fillna(method='ffill')
             df_mid_price = df_mid_price.fillna(method='bfill')
+        self._mid_price = df_mid_price
         coint_pair_and_params_by_day = []
         for pair in self._pairs:
             coint_result = self.cointegration_check_weighted(df_mid_price, pair[0], pair[1]) 
@@ -247,22 +276,114 @@ class PairsTradeParamsCalculation():
         self._cointPairsParams = coint_pair_and_params_by_day
         #return {"Trading Day": self._date, "Coint Pairs and Params": coint_pair_and_params_by_day}
 
+    def bootstrap_pairsParams(self, nr_workers: Optional[int] = None) -> None:
+        """Keeps the pairs whose empirical p-value is below bootstrap_pvalue and adds it and the half life confidence interval to their params."""
+        results = bootstrap_pairs(self._mid_price, [(pair["asset 1"], pair["asset 2"]) for pair in self._cointPairsParams],
+                                  nr_replicates=self._bootstrap_replicates, seed=self._bootstrap_seed, nr_workers=nr_workers)
+        selected = []
+        for pair in self._cointPairsParams:
+            pair.update(results[f"{pair['asset 1']}-{pair['asset 2']}"])
+            if pair["bootstrap p-value"] < self._bootstrap_pvalue:
+                selected.append(pair)
+            else:
+                logging.info(f"{pair['asset 1']}-{pair['asset 2']} dropped, bootstrap p-value {pair['bootstrap p-value']:.4f}")
+        logging.info(f"{len(selected)} of {len(self._cointPairsParams)} pairs pass the bootstrap at {self._bootstrap_pvalue}")
+        self._cointPairsParams = selected
+
+    def get_candidate_baskets(self, basket_size: int) -> List[Tuple[str, ...]]:
+        """Baskets whose symbols are connected by pairs with an ADF p-value below basket_prune_pvalue."""
+        neighbours = defaultdict(set)
+        for (asset1, asset2), p_value in self._pair_pvalues.items():
+            if p_value < self._basket_prune_pvalue:
+                neighbours[asset1].add(asset2)
+                neighbours[asset2].add(asset1)
+        candidates = []
+        for basket in combinations([symbol for symbol in self._symbols if symbol in neighbours], basket_size):
+            members = set(basket)
+            reached = {basket[0]}
+            frontier = [basket[0]]
+            while frontier:
+                for symbol in neighbours[frontier.pop()] & (members - reached):
+                    reached.add(symbol)
+                    frontier.append(symbol)
+            if len(reached) == basket_size:
+                candidates.append(basket)
+        return candidates
+
+    def johansen_by_date(self, baskets: List[Tuple[str, ...]]) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+        """(nobs, trace statistics of rank 0, first cointegrating vectors scaled to a first weight of 1) of every formation day."""
+        results = []
+        for _, price_data_by_date in self._mid_price.groupby(self._mid_price.index.date):
+            prices = price_data_by_date[self._symbols].to_numpy(dtype=np.float64)
+            column = {symbol: i for i, symbol in enumerate(self._symbols)}
+            index = np.array([[column[symbol] for symbol in basket] for basket in baskets])
+            trace_stats = np.full(len(baskets), -np.inf)
+            weights = np.full(index.shape, np.nan)
+            for start in range(0, len(baskets), BASKET_BATCH_SIZE):
+                batch = slice(start, start + BASKET_BATCH_SIZE)
+                try:
+                    batch_trace_stats, vectors = johansen_trace(np.transpose(prices[:, index[batch]], (1, 0, 2)))
+                except np.linalg.LinAlgError:  # A constant price makes the batch singular, test its baskets one by one
+                    batch_trace_stats, vectors = self._johansen_one_by_one(prices, index[batch])
+                trace_stats[batch] = batch_trace_stats[:, 0]
+                weights[batch] = vectors[:, :, 0] / vectors[:, :1, 0]
+            results.append((len(prices), trace_stats, weights))
+        return results
+
+    def _johansen_one_by_one(self, prices: np.ndarray, index: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        trace_stats = np.full(index.shape, -np.inf)
+        vectors = np.ones(index.shape + (index.shape[1],))
+        for i, basket_index in enumerate(index):
+            try:
+                basket_trace_stats, basket_vectors = johansen_trace(prices[np.newaxis, :, basket_index])
+                trace_stats[i], vectors[i] = basket_trace_stats[0], basket_vectors[0]
+            except np.linalg.LinAlgError:
+                pass
+        return trace_stats, vectors
+
+    def calculate_basketParams(self) -> None:
+        """Johansen trace test of the candidate baskets. A basket passes on the worst day, like the ADF p-value of the pairs."""
+        self._cointBasketsParams = []
+        for basket_size in self._basket_sizes:
+            baskets = self.get_candidate_baskets(basket_size)
+            logging.info(f"Testing {len(baskets)} candidate baskets of {basket_size} out of {len(list(combinations(self._symbols, basket_size)))}")
+            if len(baskets) == 0:
+                continue
+            critical_value = trace_critical_value(basket_size)
+            results = self.johansen_by_date(baskets)
+            length = sum(nobs for nobs, _, _ in results)
+            worst_trace_stats = np.min([trace_stats for _, trace_stats, _ in results], axis=0)
+            weights = sum(day_weights * (nobs / length) for nobs, _, day_weights in results)
+            for i in np.flatnonzero(worst_trace_stats > critical_value):
+                basket = list(baskets[i])
+                spreads_by_date = [price_data_by_date[basket].to_numpy() @ weights[i] for _, price_data_by_date in self._mid_price.groupby(self._mid_price.index.date)]
+                half_life = sum(self.calculate_half_life(spread) * (len(spread) / length) for spread in spreads_by_date)
+                if not half_life > 0:
+                    continue
+                self._cointBasketsParams.append({"assets": basket,
+                                                 "weights": weights[i].tolist(),
+                                                 "constant": sum(np.mean(spread) * (len(spread) / length) for spread in spreads_by_date),
+                                                 "res std": sum(np.std(spread) * (len(spread) / length) for spread in spreads_by_date),
+                                                 "half life": half_life,
+                                                 "trace stat": float(worst_trace_stats[i]),
+                                                 "critical value": critical_value})
+        logging.info(f"Found {len(self._cointBasketsParams)} co-integrated baskets")
+
     def find_largest_non_repeating_pairs(self) -> None:
         logging.info("Remove pairs with repeating symbols")
-        # Sort the pairs by half-life (or any other criteria) to prioritize better pairs
-        sorted_pairs = sorted(self._cointPairsParams, key=lambda x: x['half life'])
+        # Sort the pairs and baskets by half-life (or any other criteria) to prioritize better pairs. Positions are per symbol, so no symbol is traded twice
+        sorted_pairs = sorted(self._cointPairsParams + self._cointBasketsParams, key=lambda x: x['half life'])
 
         selected_pairs = []
         used_symbols = set()  # To track used symbols
 
         for pair in sorted_pairs:
-            asset1 = pair['asset 1']
-            asset2 = pair['asset 2']
+            assets = pair['assets'] if 'assets' in pair else [pair['asset 1'], pair['asset 2']]
 
-            # If neither symbol has been used, select this pair
-            if asset1 not in used_symbols and asset2 not in used_symbols:
+            # If none of the symbols has been used, select this pair
+            if used_symbols.isdisjoint(assets):
                 selected_pairs.append(pair)
-                used_symbols.update([asset1, asset2])  # Mark symbols as used
+                used_symbols.update(assets)  # Mark symbols as used
         self._cointPairsParams_no_repeat = selected_pairs
 
     def save_cointPairsParams(self) -> None:
@@ -271,9 +392,11 @@ class PairsTradeParamsCalculation():
         trading_day = trading_day.strftime('%Y%m%d')
         file_name = f"params_{trading_day}_ds{self._downsample}.txt"
         logging.info(f"saving parameters to {file_name}")
-        with open(f"{self._params_folder_name}/{file_name}", 'w') as file:
-            for entry in cointPairsParams:
-                file.write(json.dumps(entry) + '\n')
+        lines = [runtime.json_dumps(entry) + '\n' for entry in cointPairsParams]  # Encoded before the file is opened, an encoding error keeps the previous file
+        path = f"{self._params_folder_name}/{file_name}"
+        with open(path + ".tmp", 'w') as file:
+            file.writelines(lines)
+        os.replace(path + ".tmp", path)  # The params watcher of a running trader never sees a partial file
         self._paramsFilename = file_name
         logging.info("Saved")
 
@@ -290,9 +413,13 @@ class PairsTradeParamsCalculation():
             self.fetch_data()
             self.get_unique_pairs()
             self.calculate_pairsParams()
+            if self._bootstrap_replicates > 0:
+                self.bootstrap_pairsParams()
+            if len(self._basket_sizes) > 0:
+                self.calculate_basketParams()
             self.find_largest_non_repeating_pairs()
             self.save_cointPairsParams()
-            logging.info("Parameter calculation successful!")
+            logging.info(f"Parameter calculation successful! Response cache {self._cache.get_stats()}")
         except Exception as e:
             logging.warning(f"Parameter calculation failed! Error : {e}")
             
@@ -0,0 +1,141 @@
+import logging
+import numpy as np
+from typing import Optional, List, Tuple
+
+HEDGE_STATIC = "static"
+HEDGE_KALMAN = "kalman"
+HEDGE_RLS = "rls"
+ALL_HEDGE_MODES = [HEDGE_STATIC, HEDGE_KALMAN, HEDGE_RLS]
+
+
+class OnlineHedgeRatio:
+    """Online estimate of asset2 = hedge_ratio * asset1 + const for a bank of pairs.
+
+    Each pair owns one slot with the state [hedge ratio, const] and its 2x2 covariance. HEDGE_KALMAN treats
+    the state as a random walk and the observation variance as res std ** 2. The drift variance is relative to
+    the observation variance and to the regressor: delta / (1 - delta) * res std ** 2 for the constant, divided
+    by asset1 ** 2 (from the first sample of the slot) for the hedge ratio, so the fitted value drifts by the
+    same fraction of the residual at any price level. The filter then keeps a memory of about 1 / sqrt(2 delta)
+    samples, far longer than the half life of the spread, which it would otherwise absorb. HEDGE_RLS is recursive
+    least squares with exponential forgetting. Both are O(1) per sample; update() runs one sample for every
+    pair at once, update_one() runs a single slot.
+    """
+
+    def __init__(self,
+                 hedge_ratios: List[float],
+                 consts: List[float],
+                 res_stds: Optional[List[float]] = None,
+                 method: str = HEDGE_KALMAN,
+                 delta: float = 1e-6,
+                 forgetting: float = 0.999):
+        assert method in (HEDGE_KALMAN, HEDGE_RLS), f"method must be {HEDGE_KALMAN} or {HEDGE_RLS}"
+        nr_pairs = len(hedge_ratios)
+        self._method : str = method
+        self._forgetting : float = forgetting
+        self._state : np.ndarray = np.column_stack([np.asarray(hedge_ratios, dtype=np.float64), np.asarray(consts, dtype=np.float64)])
+        self._drift_var : float = delta / (1 - delta)
+        res_stds = np.ones(nr_pairs) * 1e-3 if res_stds is None else np.asarray(res_stds, dtype=np.float64)
+        self._obs_var : np.ndarray = np.maximum(res_stds, 1e-6) ** 2
+        self._drift : np.ndarray = np.zeros((nr_pairs, 2))  # Diagonal of the drift covariance, set from the first sample of the slot
+        self._drift_cov : np.ndarray = np.zeros((nr_pairs, 2, 2))  # The same as matrices, added to the covariance by update() in one step
+        self._scaled : np.ndarray = np.zeros(nr_pairs, dtype=bool)
+        self._all_scaled : bool = nr_pairs == 0
+        self._cov : np.ndarray = np.repeat(np.eye(2)[np.newaxis, :, :] * self._drift_var, nr_pairs, axis=0)  # Seeded close to the offline fit
+        self._nr_updates : np.ndarray = np.zeros(nr_pairs, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self._state)
+
+    def _scale_drift(self, index: np.ndarray, x: np.ndarray) -> None:
+        drift_const = self._drift_var * self._obs_var[index]
+        self._drift[index, 0] = drift_const / np.maximum(x * x, 1e-12)
+        self._drift[index, 1] = drift_const
+        self._drift_cov[index, 0, 0] = self._drift[index, 0]
+        self._drift_cov[index, 1, 1] = drift_const
+        fresh = index[self._nr_updates[index] == 0]  # Restored slots keep their covariance
+        self._cov[fresh] = 0.0
+        self._cov[fresh, 0, 0] = self._drift[fresh, 0]
+        self._cov[fresh, 1, 1] = self._drift[fresh, 1]
+        self._scaled[index] = True
+        self._all_scaled = bool(self._scaled.all())
+
+    def get_estimate(self, index: int) -> Tuple[float, float]:
+        return float(self._state[index, 0]), float(self._state[index, 1])
+
+    def update_one(self, index: int, x: float, y: float) -> float:
+        """Feed one (asset1, asset2) mid price sample to a slot. Returns the spread under the prior estimate."""
+        hedge_ratio, const = self._state[index].tolist()  # Python floats, scalar numpy arithmetic is much slower
+        p00, p01, p10, p11 = self._cov[index].ravel().tolist()
+        if self._method == HEDGE_KALMAN:
+            if not self._scaled[index]:
+                self._scale_drift(np.array([index]), np.array([x]))
+                p00, p01, p10, p11 = self._cov[index].ravel().tolist()
+            drift0, drift1 = self._drift[index].tolist()
+            p00 += drift0
+            p11 += drift1
+            noise = float(self._obs_var[index])
+        else:
+            noise = self._forgetting
+        spread = y - (hedge_ratio * x + const)
+        ph0 = p00 * x + p01  # P h with h = [x, 1]
+        ph1 = p10 * x + p11
+        gain0 = ph0 / (ph0 * x + ph1 + noise)
+        gain1 = ph1 / (ph0 * x + ph1 + noise)
+        self._state[index] = (hedge_ratio + gain0 * spread, const + gain1 * spread)
+        scale = 1.0 if self._method == HEDGE_KALMAN else 1.0 / self._forgetting
+        self._cov[index] = [[(p00 - gain0 * ph0) * scale, (p01 - gain0 * ph1) * scale],
+                            [(p10 - gain1 * ph0) * scale, (p11 - gain1 * ph1) * scale]]
+        self._nr_updates[index] += 1
+        return spread
+
+    def update(self, x: np.ndarray, y: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """Vectorised update_one for all slots. Slots where mask is False (or x, y is nan) are left unchanged."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        valid = ~(np.isnan(x) | np.isnan(y))
+        if mask is not None:
+            valid &= mask
+        h = np.column_stack([x, np.ones(len(x))])
+        if self._method == HEDGE_KALMAN:
+            if not self._all_scaled:
+                unscaled = np.flatnonzero(valid & ~self._scaled)
+                if len(unscaled) > 0:
+                    self._scale_drift(unscaled, x[unscaled])
+            cov = self._cov + self._drift_cov
+        else:
+            cov = self._cov
+        noise = self._obs_var if self._method == HEDGE_KALMAN else self._forgetting
+        spread = y - np.einsum('ij,ij->i', h, self._state)
+        ph = np.einsum('ijk,ik->ij', cov, h)
+        gain = ph / (np.einsum('ij,ij->i', ph, h) + noise)[:, np.newaxis]
+        new_cov = cov - gain[:, :, np.newaxis] * ph[:, np.newaxis, :]
+        if self._method == HEDGE_RLS:
+            new_cov /= self._forgetting
+        self._state[valid] += gain[valid] * spread[valid, np.newaxis]
+        self._cov[valid] = new_cov[valid]
+        self._nr_updates[valid] += 1
+        spread[~valid] = np.nan
+        return spread
+
+    def get_state(self, index: int) -> dict:
+        return {"hedge ratio": float(self._state[index, 0]),
+                "constant": float(self._state[index, 1]),
+                "covariance": self._cov[index].tolist(),
+                "nr updates": int(self._nr_updates[index])}
+
+    def restore_state(self, index: int, state: dict) -> None:
+        self._state[index] = [state["hedge ratio"], state["constant"]]
+        self._cov[index] = state["covariance"]
+        self._nr_updates[index] = state["nr updates"]
+        logging.info(f"Restored hedge ratio {state['hedge ratio']} and constant {state['constant']} after {state['nr updates']} updates")
+
+
+def make_hedge_estimator(cointPairsparams: List[dict], hedge_mode: str) -> Optional[OnlineHedgeRatio]:
+    """One estimator slot per pair, in the order of cointPairsparams. None for HEDGE_STATIC."""
+    assert hedge_mode in ALL_HEDGE_MODES, f"hedge_mode must be one of {ALL_HEDGE_MODES}"
+    if hedge_mode == HEDGE_STATIC:
+        return None
+    return OnlineHedgeRatio(hedge_ratios=[pair["hedge ratio"] for pair in cointPairsparams],
+                            consts=[pair["constant"] for pair in cointPairsparams],
+                            res_stds=[pair.get("res std", 1e-3) for pair in cointPairsparams],
+                            method=hedge_mode)
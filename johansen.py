@@ -0,0 +1,60 @@
+"""Johansen trace test for a batch of baskets at once.
+
+Same model as statsmodels.tsa.vector_ar.vecm.coint_johansen(endog, det_order=0, k_ar_diff=1): a constant and
+one lagged difference. Every step is a batched numpy operation over the first axis, so all candidate baskets
+of one size and one day are tested with a handful of calls instead of one statsmodels call per basket.
+
+    trace_stats, weights = johansen_trace(prices)  # prices (nr baskets, nr samples, basket size)
+    is_coint = trace_stats[:, 0] > trace_critical_value(basket size)
+"""
+import numpy as np
+from typing import Tuple
+from statsmodels.tsa.coint_tables import c_sjt
+
+CONFIDENCE_90 = 0
+CONFIDENCE_95 = 1
+CONFIDENCE_99 = 2
+
+
+def _demean(x: np.ndarray) -> np.ndarray:
+    return x - x.mean(axis=1, keepdims=True)
+
+
+def _residual(y: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """Residual of the least squares regression of y on x, per basket."""
+    xt = np.swapaxes(x, 1, 2)
+    beta = np.linalg.solve(xt @ x, xt @ y)
+    return y - x @ beta
+
+
+def johansen_trace(prices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Trace statistics (nr baskets, basket size) for rank 0, 1, ... and the cointegrating vectors
+    (nr baskets, basket size, basket size), one per column ordered by decreasing eigenvalue.
+
+    The vectors are normalized like statsmodels, v' Skk v = I and the first element of the first vector positive.
+    """
+    levels = _demean(np.asarray(prices, dtype=np.float64))
+    diff = np.diff(levels, axis=1)
+    lagged_diff = _demean(diff[:, :-1])
+    r0t = _residual(_demean(diff[:, 1:]), lagged_diff)
+    rkt = _residual(_demean(levels[:, 1:-1]), lagged_diff)
+    nobs = rkt.shape[1]
+    rkt_t = np.swapaxes(rkt, 1, 2)
+    skk = rkt_t @ rkt / nobs
+    sk0 = rkt_t @ r0t / nobs
+    s00 = np.swapaxes(r0t, 1, 2) @ r0t / nobs
+    sig = sk0 @ np.linalg.solve(s00, np.swapaxes(sk0, 1, 2))
+    # Generalized symmetric eigenproblem sig v = a skk v through the Cholesky factor of skk
+    chol_inv = np.linalg.inv(np.linalg.cholesky(skk))
+    eigvals, eigvecs = np.linalg.eigh(chol_inv @ sig @ np.swapaxes(chol_inv, 1, 2))
+    eigvals = np.clip(eigvals[:, ::-1], 0.0, 1.0 - 1e-12)  # Decreasing
+    vectors = np.swapaxes(chol_inv, 1, 2) @ eigvecs[:, :, ::-1]
+    vectors *= np.where(vectors[:, :1, :1] < 0, -1.0, 1.0)
+    log_one_minus = np.log(1.0 - eigvals)
+    trace_stats = -nobs * np.cumsum(log_one_minus[:, ::-1], axis=1)[:, ::-1]
+    return trace_stats, vectors
+
+
+def trace_critical_value(basket_size: int, rank: int = 0, confidence: int = CONFIDENCE_95) -> float:
+    """Critical value of the trace statistic for H0: rank <= rank, with a constant (det_order 0)."""
+    return float(c_sjt(basket_size - rank, 0)[confidence])
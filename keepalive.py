@@ -0,0 +1,82 @@
+"""Warm connections to the trading endpoint across the quiet stretches of the session.
+
+    keepalive = KeepAlive(interval=20, warm_connections=2)
+    await keepalive.warmup()  # Opens the connections before the first order
+    asyncio.create_task(keepalive.run())
+    ...
+    keepalive.close()  # Logs the connection reuse of the session
+
+Pooled connections are closed by the connector after Client.keepalive_timeout idle seconds, and by the server
+or a load balancer on its own idle timeout, so the first order after a long flat period pays for the TCP and
+TLS handshakes again. Whenever the trading pool has been idle for interval seconds, warm_connections
+concurrent GET /v2/clock take one pooled connection each and keep them open. The trader sends at most a few
+orders at once (both legs of a pair), so a couple of warm connections cover the latency sensitive requests,
+and the pool of Client grows beyond them on bursts. Reuse counts come from the trace config of Client.
+"""
+import asyncio
+import logging
+from typing import Optional
+from core import Client, Endpoints, TimeSource, POOL_TRADING
+
+
+class KeepAlive:
+
+    def __init__(self, interval: float = 20.0, warm_connections: int = 2, pool: str = POOL_TRADING, report_interval: Optional[float] = 600.0):
+        self._interval : float = interval
+        self._warm_connections : int = warm_connections
+        self._pool : str = pool
+        self._report_interval : Optional[float] = report_interval  # Seconds between the logs of the reuse ratio, None only logs on close
+        self._clock_url : str = f"{Endpoints.trading_url}/v2/clock"  # The lightest authenticated request of the trading API
+        self._nr_pings : int = 0
+        self._nr_failures : int = 0
+        if interval >= Client.keepalive_timeout:
+            logging.warning(f"Keepalive interval {interval} s is not below the keepalive timeout {Client.keepalive_timeout} s of the pool, idle connections close between pings")
+
+    async def _ping(self) -> bool:
+        try:
+            async with Client.get_session(self._pool).get(self._clock_url) as result:
+                await result.read()
+                return result.status == 200
+        except Exception as e:
+            logging.warning(f"Keepalive request failed: {e}")
+            return False
+
+    async def _ping_all(self) -> int:
+        """Concurrent pings take one connection each. Returns the number of successful ones."""
+        results = await asyncio.gather(*[self._ping() for _ in range(self._warm_connections)])
+        self._nr_pings += len(results)
+        self._nr_failures += results.count(False)
+        return results.count(True)
+
+    async def warmup(self) -> None:
+        """Opens the connections at once, so they resolve and handshake before the first order."""
+        await Client.start_session()
+        nr_warm = await self._ping_all()
+        logging.info(f"Warmed {nr_warm}/{self._warm_connections} connections of the {self._pool} pool")
+
+    async def run(self) -> None:
+        """Pings the pool whenever it has been idle for interval seconds, until cancelled. The requests of the trader keep
+        the pool warm on their own, so busy periods send nothing."""
+        last_report = TimeSource.monotonic()
+        while True:
+            if self._report_interval is not None and TimeSource.monotonic() - last_report >= self._report_interval:
+                self.report()
+                last_report = TimeSource.monotonic()
+            wait = self._interval - Client.idle_time(self._pool)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            await self._ping_all()
+            await asyncio.sleep(self._interval)  # Also paces the pings while the endpoint fails, failed requests do not reset the idle time
+
+    def get_summary(self) -> dict:
+        return {"pings": self._nr_pings, "failures": self._nr_failures, "connections": Client.get_connection_stats()}
+
+    def report(self) -> None:
+        for pool, stats in Client.get_connection_stats().items():
+            ratio = f"{stats['reuse ratio']:.1%}" if stats["reuse ratio"] is not None else "n/a"
+            logging.info(f"Connections of the {pool} pool: {stats['created']} opened, {stats['reused']} reused, reuse ratio {ratio}")
+        logging.info(f"Keepalive: {self._nr_pings} pings, {self._nr_failures} failed")
+
+    def close(self) -> None:
+        self.report()
@@ -0,0 +1,188 @@
+"""Opt-in instrumentation of the event loop: loop lag, wall time per callback and stack samples of stalls.
+
+    monitor = LoopMonitor(stall_threshold=0.05, report_interval=60)
+    monitor.instrument(dataclient, DATACLIENT_CALLBACKS)
+    monitor.instrument(pair_trade, PAIRTRADE_STEPS)
+    asyncio.create_task(monitor.run())
+    ...
+    monitor.close()  # Logs the final summary
+
+instrument() replaces the methods on the instance, so it must run before the methods are handed out as
+callbacks (DataClient.start subscribes them to the streams). A probe coroutine measures how late the loop
+wakes it up, and a watchdog thread samples the stack of the loop thread with sys._current_frames whenever the
+loop has not run the probe for longer than stall_threshold, which points at the code that blocks it.
+"""
+import sys
+import time
+import asyncio
+import logging
+import threading
+import functools
+import traceback
+from collections import deque
+from typing import Optional, Dict, Iterable, Callable
+
+DATACLIENT_CALLBACKS = ["on_quote", "on_trade", "on_bar", "on_trade_update"]
+PAIRTRADE_STEPS = ["_calculate_spread", "_calculate_pertb", "_generate_signal", "_on_quote"]
+LOOP_LAG = "event loop lag"
+
+
+class CallbackStats:
+    __slots__ = ("count", "total", "max", "slow", "recent")
+
+    def __init__(self, nr_recent: int = 1000):
+        self.count : int = 0
+        self.total : float = 0.0
+        self.max : float = 0.0
+        self.slow : int = 0
+        self.recent : deque = deque(maxlen=nr_recent)  # For the percentiles
+
+    def add(self, elapsed: float, threshold: float) -> None:
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        if elapsed > threshold:
+            self.slow += 1
+        self.recent.append(elapsed)
+
+    def summary(self) -> dict:
+        recent = sorted(self.recent)
+        return {"count": self.count,
+                "total": self.total,
+                "mean": self.total / self.count if self.count > 0 else 0.0,
+                "p50": recent[len(recent) // 2] if recent else 0.0,
+                "p99": recent[min(int(len(recent) * 0.99), len(recent) - 1)] if recent else 0.0,
+                "max": self.max,
+                "slow": self.slow}
+
+
+class LoopMonitor:
+    """Times are in seconds. A callback or probe interval longer than stall_threshold counts as slow.
+
+    Synchronous callbacks are timed exactly. Coroutine callbacks are timed from call to return, which includes
+    the time they are suspended, so they are only comparable to each other.
+    """
+
+    def __init__(self,
+                 stall_threshold: float = 0.05,
+                 probe_interval: float = 0.05,
+                 report_interval: float = 60,
+                 max_stack_samples: int = 50,
+                 stack_depth: int = 12):
+        self._stall_threshold : float = stall_threshold
+        self._probe_interval : float = probe_interval
+        self._report_interval : float = report_interval
+        self._stack_depth : int = stack_depth
+        self._stats : Dict[str, CallbackStats] = {}
+        self._lag : CallbackStats = CallbackStats()
+        self._stack_samples : deque = deque(maxlen=max_stack_samples)
+        self._current : Optional[tuple] = None  # (name, start) of the synchronous callback running on the loop
+        self._heartbeat : float = time.perf_counter()
+        self._sampled_heartbeat : Optional[float] = None
+        self._loop_thread_id : Optional[int] = None
+        self._stop_event : threading.Event = threading.Event()
+        self._watchdog : Optional[threading.Thread] = None
+
+    def instrument(self, obj, method_names: Iterable[str], name: Optional[str] = None) -> None:
+        """Replaces obj.method_name by a timed wrapper for each name. Stats are shared by all instances with the same name."""
+        for method_name in method_names:
+            method = getattr(obj, method_name)
+            label = f"{name if name is not None else type(obj).__name__}.{method_name}"
+            stats = self._stats.setdefault(label, CallbackStats())
+            if asyncio.iscoroutinefunction(method):
+                wrapper = self._wrap_coroutine(method, stats)
+            else:
+                wrapper = self._wrap_function(method, label, stats)
+            setattr(obj, method_name, wrapper)
+
+    def _wrap_function(self, method: Callable, label: str, stats: CallbackStats) -> Callable:
+        perf_counter = time.perf_counter
+        threshold = self._stall_threshold
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            previous = self._current
+            start = perf_counter()
+            self._current = (label, start)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stats.add(perf_counter() - start, threshold)
+                self._current = previous
+        return wrapper
+
+    def _wrap_coroutine(self, method: Callable, stats: CallbackStats) -> Callable:
+        perf_counter = time.perf_counter
+        threshold = self._stall_threshold
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                stats.add(perf_counter() - start, threshold)
+        return wrapper
+
+    async def run(self) -> None:
+        """Probes the loop lag and logs a summary every report_interval seconds. Starts the watchdog thread."""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.perf_counter()
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-monitor-watchdog", daemon=True)
+            self._watchdog.start()
+        next_report = loop.time() + self._report_interval
+        while not self._stop_event.is_set():
+            start = loop.time()
+            await asyncio.sleep(self._probe_interval)
+            now = loop.time()
+            self._lag.add(max(now - start - self._probe_interval, 0.0), self._stall_threshold)
+            self._heartbeat = time.perf_counter()
+            if now >= next_report:
+                self.log_summary()
+                next_report = now + self._report_interval
+
+    def _watch(self) -> None:
+        """Watchdog thread. Samples the loop thread once per stall."""
+        while not self._stop_event.wait(self._stall_threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.perf_counter() - heartbeat
+            if stalled > self._probe_interval + self._stall_threshold and self._sampled_heartbeat != heartbeat:
+                self._sampled_heartbeat = heartbeat
+                self._sample_stack(stalled)
+
+    def _sample_stack(self, stalled: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread_id, None)
+        if frame is None:
+            return
+        current = self._current
+        name = current[0] if current is not None else "event loop"
+        stack = traceback.format_stack(frame, limit=self._stack_depth)
+        self._stack_samples.append({"callback": name, "stalled": stalled, "time": time.time(), "stack": stack})
+        logging.warning(f"Event loop blocked for {stalled * 1000:.0f} ms in {name}:\n{''.join(stack)}")
+
+    def get_summary(self) -> dict:
+        return {"loop lag": self._lag.summary(),
+                "callbacks": {label: stats.summary() for label, stats in self._stats.items()},
+                "stack samples": list(self._stack_samples)}
+
+    def log_summary(self) -> None:
+        lag = self._lag.summary()
+        lines = [f"{LOOP_LAG:<40} count {lag['count']:>9} p50 {lag['p50'] * 1e3:9.3f} ms  p99 {lag['p99'] * 1e3:9.3f} ms  max {lag['max'] * 1e3:9.3f} ms  slow {lag['slow']}"]
+        for label, stats in sorted(self._stats.items(), key=lambda item: item[1].total, reverse=True):
+            if stats.count == 0:
+                continue
+            summary = stats.summary()
+            lines.append(f"{label:<40} count {summary['count']:>9} p50 {summary['p50'] * 1e6:9.1f} us  p99 {summary['p99'] * 1e6:9.1f} us  "
+                         f"max {summary['max'] * 1e3:9.3f} ms  total {summary['total']:8.3f} s  slow {summary['slow']}")
+        logging.info(f"Loop monitor summary, {len(self._stack_samples)} stack samples\n" + "\n".join(lines))
+
+    def close(self) -> dict:
+        """Stops the watchdog, logs the final summary and returns it."""
+        self._stop_event.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+        self.log_summary()
+        return self.get_summary()
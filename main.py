@@ -1,22 +1,119 @@
+"""Entry points of the pairs trader.
+
+    python main.py calibrate                      # search co-integrated pairs and write today's params file
+    python main.py trade                          # trade today's params file from the open to 5 minutes before the close
+    python main.py trade --capital 20000 --workers 4 --profile fast
+    python main.py --config my_config.json trade --calibrate-if-missing
+    python main.py replay --date 20241010          # trade a recorded day in virtual time against an in-process broker
+
+Settings come from DEFAULT_CONFIG, then the JSON config file (config.json if it exists), then the command line.
+Each command imports only what it needs: the trader never loads statsmodels and the parameter calculator,
+and the multi-process mode is only imported with --workers.
+"""
 import os
+import sys
+import time
+import signal
 import logging
-import ast
 import datetime
+import argparse
 import asyncio
-from typing import Optional, List 
-from core import DataClient, OrderManager, MarketClockCalendar, Client
-from PairTrade import PairTrade
-from find_coint_pairs_and_params import PairsTradeParamsCalculation
-
-# Create a logger
-today = datetime.datetime.today().date().strftime('%Y%m%d')
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)  # Set the log level for the logger
-file_handler = logging.FileHandler(f'logs/pairs_trade_log_{today}.txt')  # Log to file
-file_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+import runtime
+from typing import Optional, List, Callable
+from core import DataClient, OrderManager, MarketClockCalendar, Client, Endpoints, make_risk_manager, POOL_TRADING, POOL_DATA
+from PairTrade import PairTrade, SIGNAL_DOWNSAMPLE, SIGNAL_EWMA
+from BasketTrade import BasketTrade
+from checkpoint import Checkpointer
+from shutdown import ShutdownCoordinator
+from recorder import MarketDataRecorder
+from hedge import make_hedge_estimator, HEDGE_STATIC, ALL_HEDGE_MODES
+from loop_monitor import LoopMonitor, DATACLIENT_CALLBACKS, PAIRTRADE_STEPS
+from metrics import MetricsServer
+from params_watcher import ParamsWatcher
+from keepalive import KeepAlive
+from order_events import ARCHIVE_FOLDER, REPLAY_ARCHIVE_FOLDER
+
+COMMAND_CALIBRATE = "calibrate"
+COMMAND_TRADE = "trade"
+COMMAND_REPLAY = "replay"
+CONFIG_FILENAME = "config.json"
+DEFAULT_CONFIG = {
+    "capital": 10000,
+    "symbols": ["NVDA", "TSM", "AMD", "ASML", "QCOM", "INTC"],
+    "lookback": 2,
+    "basket_sizes": [],  # e.g. [3, 4] also searches Johansen baskets of 3 and 4 symbols, traded by BasketTrade
+    "basket_prune_pvalue": 0.2,  # Only baskets connected by pairs below this ADF p-value are tested
+    "bootstrap_replicates": 0,  # e.g. 2000 keeps only the pairs whose block bootstrap p-value is below bootstrap_pvalue, 0 skips the stage
+    "bootstrap_pvalue": 0.05,
+    "bootstrap_seed": 0,
+    "downsample": 30,
+    "k": 2,
+    "params_folder": "params",
+    "params_file": None,  # Default params_YYYYMMDD_ds<downsample>.txt of today
+    "calibrate_if_missing": False,  # trade: run the parameter calculator first when the params file does not exist
+    "restore": False,  # True (or --restore) resumes from the last checkpoint instead of flattening the book at the start
+    "workers": 0,  # > 0 runs the pairs in that many worker processes fed by one market data process
+    "profile": runtime.PROFILE_DEFAULT,  # runtime.PROFILE_FAST for uvloop, orjson and ormsgpack
+    "hedge_mode": HEDGE_STATIC,  # hedge.HEDGE_KALMAN or hedge.HEDGE_RLS update the hedge ratio and constant on every sample
+    "signal_mode": SIGNAL_DOWNSAMPLE,  # SIGNAL_EWMA updates %b on every quote, half life from the params file
+    "record": False,  # Write the live quotes, trades and bars to data/ for tomorrow's parameter calculation
+    "simulator_url": None,  # e.g. "http://127.0.0.1:8765" to trade against simulator.py
+    "loop_monitor": False,  # Log the event loop lag, the time per callback and stack samples of stalls longer than stall_threshold
+    "stall_threshold": 0.05,
+    "metrics_port": None,  # e.g. 9100 serves Prometheus metrics on http://127.0.0.1:9100/metrics
+    "watch_params": False,  # Reload the params file when it changes: new pairs start, removed pairs close and stop, changed pairs keep their spread window
+    "risk": {  # Pre-trade limits of core.RiskManager, notional limits as multiples of the capital. null disables the checks
+        "max_gross_leverage": 1.5,
+        "max_net_leverage": 1.0,
+        "max_pair_leverage": 1.5,  # Both legs of a pair, per pair capital
+        "max_order_leverage": 1.5,  # Per pair capital
+        "max_symbol_leverage": None,
+        "max_symbol_positions": None,  # {"NVDA": 500} caps the shares held of a symbol
+        "max_orders_per_second": 20,
+        "max_price_deviation": 0.05,  # Fat finger band around the mid price
+    },
+    "connections": {  # REST connection pools of core.Client, orders get their own pool
+        "trading_pool_size": 8,
+        "data_pool_size": 4,  # Clock, calendar and position reads
+        "dns_cache_ttl": 300,
+        "keepalive_timeout": 60,  # Idle seconds before a pooled connection is closed
+        "keepalive_interval": 20,  # Ping the trading pool after this many idle seconds, null disables the pings and the warmup
+        "warm_connections": 2,
+    },
+}
+
+def setup_logging() -> str:
+    today = datetime.datetime.today().date().strftime('%Y%m%d')
+    os.makedirs('logs', exist_ok=True)
+    log_filename = f'logs/pairs_trade_log_{today}.txt'
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)  # Set the log level for the logger
+    file_handler = logging.FileHandler(log_filename)  # Log to file
+    file_handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+    return log_filename
+
+def load_params(filename: str) -> List[dict]:
+    """One JSON object per line. Files with the python repr of the dicts still load, through ast.literal_eval."""
+    cointPairsparams = []
+    with open(filename, 'rb') as file:
+        lines = file.read().splitlines()
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        try:
+            pair = runtime.json_loads(line)
+        except ValueError:
+            import ast
+            pair = ast.literal_eval(line.decode())
+        cointPairsparams.append(pair)
+        if "assets" in pair:
+            logging.info(f"{'-'.join(pair['assets'])} Basket. Weights: {pair['weights']}. Half Life: {pair['half life']}. Const: {pair['constant']}")
+        else:
+            logging.info(f"{pair['asset 1']}-{pair['asset 2']} Pair. Hedge ratio: {pair['hedge ratio']}. Half Life: {pair['half life']}. Const: {pair['constant']}")
+    return cointPairsparams
 
 async def market_open() -> None:
     marketclockcalendar = MarketClockCalendar()
@@ -35,91 +132,317 @@ async def market_time_left() -> Optional[datetime.datetime]:
     timeout = await marketclockcalendar.time_left_before_next_close()
     return timeout
 
-async def calculate_params(symbols : List[str], lookback : int , downsample : int):
-    pairsparams = PairsTradeParamsCalculation(symbols=symbols, date = None, lookback = lookback, downsample = downsample)  # Create an instance of the classll the async start method
+async def calculate_params(symbols : List[str], lookback : int , downsample : int, basket_sizes : Optional[List[int]] = None, basket_prune_pvalue : float = 0.2,
+                           bootstrap_replicates : int = 0, bootstrap_pvalue : float = 0.05, bootstrap_seed : int = 0):
+    from find_coint_pairs_and_params import PairsTradeParamsCalculation  # statsmodels and the REST client are only needed here
+    pairsparams = PairsTradeParamsCalculation(symbols=symbols, date = None, lookback = lookback, downsample = downsample,
+                                              basket_sizes = basket_sizes, basket_prune_pvalue = basket_prune_pvalue,
+                                              bootstrap_replicates = bootstrap_replicates, bootstrap_pvalue = bootstrap_pvalue, bootstrap_seed = bootstrap_seed)  # Create an instance of the classll the async start method
     await pairsparams.main()
     await Client.close_session()
 
-async def trader(cointPairsparams: Optional[List[dict]], total_capital: float, downsample: int, k: int):
-    symbols = {symbol for pair in cointPairsparams for symbol in (pair["asset 1"], pair["asset 2"])} 
+async def trader(cointPairsparams: Optional[List[dict]], total_capital: float, downsample: int, k: int, restore: bool = False, hedge_mode: str = HEDGE_STATIC,
+                 signal_mode: str = SIGNAL_DOWNSAMPLE, record: bool = False, risk_limits: Optional[dict] = None, loop_monitor: bool = False,
+                 stall_threshold: float = 0.05, metrics_port: Optional[int] = None, params_filename: Optional[str] = None, watch_params: bool = False,
+                 stream_factory: Optional[Callable] = None, checkpoints: bool = True, keepalive_interval: Optional[float] = None, warm_connections: int = 2,
+                 order_events_folder: str = ARCHIVE_FOLDER):
+    basketsparams = [pair for pair in cointPairsparams if "assets" in pair]  # Johansen baskets, the capital is shared by pairs and baskets
+    symbols = {symbol for pair in cointPairsparams for symbol in (pair["assets"] if "assets" in pair else (pair["asset 1"], pair["asset 2"]))} 
     capital_per_pair = round(total_capital / len(cointPairsparams))
-    d = DataClient(symbols=symbols)
-    o = OrderManager()
+    d = DataClient(symbols=symbols, recorder=MarketDataRecorder() if record else None, stream_factory=stream_factory, order_events_folder=order_events_folder)  # stream_factory: e.g. the in-process stream of a replay
+    risk_manager = make_risk_manager(d, cointPairsparams, total_capital, risk_limits)
+    cointPairsparams = [pair for pair in cointPairsparams if "assets" not in pair]
+    o = OrderManager(risk_manager=risk_manager)
+    monitor = LoopMonitor(stall_threshold=stall_threshold) if loop_monitor else None
+    if monitor is not None:
+        monitor.instrument(d, DATACLIENT_CALLBACKS)  # Before d.start() subscribes the callbacks
     await asyncio.sleep(5)  
-    pair_trade_instances = []
-    for pair in cointPairsparams:
-        _pair_trade_instance = PairTrade(dataclient=d, ordermanager=o,asset1=pair['asset 1'],asset2=pair['asset 2'], capital=capital_per_pair, hedge_ratio=pair['hedge ratio'], const= pair['constant'] , downsample=downsample, k=k )
-        pair_trade_instances.append(_pair_trade_instance._trader())
+    hedge_estimator = make_hedge_estimator(cointPairsparams, hedge_mode)
+    pair_trades = []
+    for i, pair in enumerate(cointPairsparams):
+        _pair_trade_instance = PairTrade(dataclient=d, ordermanager=o,asset1=pair['asset 1'],asset2=pair['asset 2'], capital=capital_per_pair, hedge_ratio=pair['hedge ratio'], const= pair['constant'] , downsample=downsample, k=k,
+                                         hedge_estimator=hedge_estimator, hedge_index=i, signal_mode=signal_mode, half_life=pair['half life'])
+        pair_trades.append(_pair_trade_instance)
+    for basket in basketsparams:
+        pair_trades.append(BasketTrade(dataclient=d, ordermanager=o, assets=basket['assets'], weights=basket['weights'], capital=capital_per_pair, downsample=downsample,
+                                       const=basket['constant'], k=k, signal_mode=signal_mode, half_life=basket['half life']))
+
+    def make_pair_trade(pair: dict, capital: float) -> PairTrade:
+        """Pairs added by the params watcher, each with its own hedge estimator."""
+        pair_trade = PairTrade(dataclient=d, ordermanager=o, asset1=pair['asset 1'], asset2=pair['asset 2'], capital=capital, hedge_ratio=pair['hedge ratio'], const=pair['constant'],
+                               downsample=downsample, k=k, hedge_estimator=make_hedge_estimator([pair], hedge_mode), hedge_index=0, signal_mode=signal_mode, half_life=pair['half life'])
+        if monitor is not None:
+            monitor.instrument(pair_trade, PAIRTRADE_STEPS)
+        return pair_trade
+    if monitor is not None:
+        for pair_trade in pair_trades:
+            monitor.instrument(pair_trade, PAIRTRADE_STEPS)
+        asyncio.create_task(monitor.run())
+    metrics_server = MetricsServer(d, o, pair_trades, port=metrics_port, loop_monitor=monitor) if metrics_port is not None else None
+    if metrics_server is not None:
+        await metrics_server.start()
+    checkpointer = Checkpointer(dataclient=d, ordermanager=o, pair_trades=pair_trades)
+    checkpoint = checkpointer.load() if restore and checkpoints else None
+    if checkpoint is not None:
+        checkpointer.restore_state(checkpoint)
+    pair_trade_instances = [pair_trade._trader() for pair_trade in pair_trades]
     asyncio.create_task(d.start())
     await o.start()
+    keepalive = KeepAlive(interval=keepalive_interval, warm_connections=warm_connections) if keepalive_interval is not None else None
+    if keepalive is not None:
+        await keepalive.warmup()
+        asyncio.create_task(keepalive.run())
     await asyncio.sleep(2)  
-    await o.cancel_all_orders()
-    await o.close_all_positions()
+    if checkpoint is not None:
+        logging.info("Resume from checkpoint")
+        await checkpointer.reconcile(checkpoint)
+    else:
+        await o.cancel_all_orders()
+        await o.close_all_positions()
+    if risk_manager is not None:
+        risk_manager.start()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, risk_manager.kill, "SIGUSR1")  # kill -USR1 <pid> stops new positions in every pair
+    if checkpoints:
+        asyncio.create_task(checkpointer.run())
     await asyncio.sleep(2)  
     time_left_before_close = await market_time_left()
     assert time_left_before_close is not None, "time_left_before_close is None"
     timeout = (time_left_before_close - datetime.timedelta(seconds=300)).total_seconds()
+    logging.info("Start Trading")
+    pair_tasks = [asyncio.create_task(pair_trade_instance) for pair_trade_instance in pair_trade_instances]
+    if watch_params and params_filename is not None:
+        watcher = ParamsWatcher(dataclient=d, ordermanager=o, pair_trades=pair_trades, pair_tasks=pair_tasks, make_pair_trade=make_pair_trade, load_params=load_params,
+                                params_filename=params_filename, total_capital=total_capital, hedge_mode=hedge_mode, risk_limits=risk_limits)
+        watcher.start(cointPairsparams + basketsparams)
+        watcher_task = asyncio.create_task(watcher.run())
+        await asyncio.wait([watcher_task], timeout=timeout)  # Pairs come and go, trade until the close
+        watcher_task.cancel()
+    else:
+        await asyncio.wait(pair_tasks, timeout= timeout)
+    logging.info("Market closing in 5 mins. Stop pairs, cancel open orders and close positions")
+    await ShutdownCoordinator(dataclient=d, ordermanager=o, pair_tasks=pair_tasks).run()
+    if monitor is not None:
+        monitor.close()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    if keepalive is not None:
+        keepalive.close()
+    logging.info("Exit...")
+    exit()
+
+
+def load_config(filename: Optional[str] = None) -> dict:
+    """DEFAULT_CONFIG updated with the JSON config file. Without filename, config.json is used if it exists."""
+    config = dict(DEFAULT_CONFIG)
+    if filename is None:
+        if not os.path.exists(CONFIG_FILENAME):
+            return config
+        filename = CONFIG_FILENAME
+    with open(filename, 'rb') as file:
+        file_config = runtime.json_loads(file.read())
+    unknown = set(file_config) - set(DEFAULT_CONFIG)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown settings {sorted(unknown)} in {filename}")
+    for key, value in file_config.items():
+        config[key] = {**DEFAULT_CONFIG[key], **value} if isinstance(DEFAULT_CONFIG[key], dict) and isinstance(value, dict) else value
+    return config
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Settings left out on the command line are None, so they do not override the config file."""
+    parser = argparse.ArgumentParser(description="Pairs trading on Alpaca Markets")
+    parser.add_argument("--config", default=None, help=f"JSON config file, default {CONFIG_FILENAME} if it exists")
+    parser.add_argument("--downsample", type=int, default=None, help="Trading frequency in seconds, also selects the params file")
+    parser.add_argument("--params-folder", dest="params_folder", default=None)
+    parser.add_argument("--params-file", dest="params_file", default=None, help="Params file name in the params folder, default the one of today")
+    commands = parser.add_subparsers(dest="command")
+
+    calibrate = commands.add_parser(COMMAND_CALIBRATE, help="Search co-integrated pairs and write the params file")
+    calibrate.add_argument("--symbols", nargs="+", default=None)
+    calibrate.add_argument("--lookback", type=int, default=None, help="Formation period in days")
+    calibrate.add_argument("--basket-sizes", dest="basket_sizes", type=int, nargs="+", default=None, help="Also search Johansen baskets of these sizes")
+    calibrate.add_argument("--bootstrap-replicates", dest="bootstrap_replicates", type=int, default=None, help="Block bootstrap replicates per pair, 0 skips the stage")
+    calibrate.add_argument("--bootstrap-seed", dest="bootstrap_seed", type=int, default=None)
+
+    trade = commands.add_parser(COMMAND_TRADE, help="Trade the pairs of the params file until 5 minutes before the close")
+    trade.add_argument("--capital", type=float, default=None)
+    trade.add_argument("--k", type=float, default=None, help="Width of the Bollinger Bands in standard deviations")
+    trade.add_argument("--workers", type=int, default=None)
+    trade.add_argument("--profile", choices=runtime.ALL_PROFILES, default=None)
+    trade.add_argument("--hedge-mode", dest="hedge_mode", choices=ALL_HEDGE_MODES, default=None)
+    trade.add_argument("--signal-mode", dest="signal_mode", choices=[SIGNAL_DOWNSAMPLE, SIGNAL_EWMA], default=None)
+    trade.add_argument("--simulator-url", dest="simulator_url", default=None)
+    trade.add_argument("--restore", dest="restore", action="store_true", default=None, help="Resume from the last checkpoint")
+    trade.add_argument("--no-restore", dest="restore", action="store_false", help="Flatten the book at the start, the default")
+    trade.add_argument("--record", action="store_true", default=None)
+    trade.add_argument("--loop-monitor", dest="loop_monitor", action="store_true", default=None)
+    trade.add_argument("--watch-params", dest="watch_params", action="store_true", default=None, help="Reload the params file when it changes")
+    trade.add_argument("--metrics-port", dest="metrics_port", type=int, default=None, help="Serve Prometheus metrics on this port")
+    trade.add_argument("--calibrate-if-missing", dest="calibrate_if_missing", action="store_true", default=None)
+    trade.add_argument("--symbols", nargs="+", default=None, help="Symbols for --calibrate-if-missing")
+    trade.add_argument("--lookback", type=int, default=None, help="Lookback for --calibrate-if-missing")
+
+    replay = commands.add_parser(COMMAND_REPLAY, help="Trade a recorded day in virtual time against an in-process broker")
+    replay.add_argument("--date", required=True, help="Day of the recorded quotes, YYYYMMDD")
+    replay.add_argument("--data-folder", dest="data_folder", default="data")
+    replay.add_argument("--synthetic", action="store_true", help="Random-walk quotes of the params symbols instead of the recorded ones")
+    replay.add_argument("--quotes-per-second", dest="quotes_per_second", type=float, default=50, help="Of --synthetic")
+    replay.add_argument("--latency-ms", dest="latency_ms", type=float, default=0.0, help="Virtual latency of every REST request")
+    replay.add_argument("--seed", type=int, default=0, help="Of the order ids and of --synthetic")
+    replay.add_argument("--capital", type=float, default=None)
+    replay.add_argument("--k", type=float, default=None, help="Width of the Bollinger Bands in standard deviations")
+    replay.add_argument("--hedge-mode", dest="hedge_mode", choices=ALL_HEDGE_MODES, default=None)
+    replay.add_argument("--signal-mode", dest="signal_mode", choices=[SIGNAL_DOWNSAMPLE, SIGNAL_EWMA], default=None)
+    replay.add_argument("--loop-monitor", dest="loop_monitor", action="store_true", default=None)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args.command = COMMAND_TRADE
+    return args
+
+
+def make_config(args: argparse.Namespace) -> dict:
+    config = load_config(args.config)
+    for key in DEFAULT_CONFIG:
+        value = getattr(args, key, None)
+        if value is not None:
+            config[key] = value
+    if config["params_file"] is None:
+        day = getattr(args, "date", None) or datetime.datetime.today().date().strftime('%Y%m%d')  # The replayed day for replay
+        config["params_file"] = f"params_{day}_ds{config['downsample']}.txt"
+    return config
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """A loop of the installed runtime profile. uvloop does not create one implicitly."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def run_loop(coroutine) -> None:
+    loop = new_event_loop()
     try:
-        logging.info("Start Trading")
-        await asyncio.wait_for(asyncio.gather(*pair_trade_instances), timeout= timeout)
-    except asyncio.TimeoutError:
-        logging.info("Market closing in 5 mins. Cancel open orders and close positions")
-        await o.cancel_all_orders()
-        await o.close_all_positions()
-        logging.info("Exit...")
-        exit()
-         
-if __name__ == "__main__":
-    Total_capital = 10000 
-    symbols = ["NVDA", "TSM", "AMD", "ASML", "QCOM", "INTC"]  ##TODO remove ASML, TSM
-    lookback = 2
-    downsample = 30
-    k = 2
-    RUN_PARAMS_CALCULATOR = False
-    today = datetime.datetime.today().date()
-    data_folder = "data/"
-    params_folder = "params/"
-    paramsFilename = f"params_{today.strftime('%Y%m%d')}_ds{downsample}.txt"
-    #paramsFilename = f"params_20241004_ds{downsample}.txt"
-    logging.info("Main script has started.")
-    if os.path.exists(params_folder + paramsFilename):
-        logging.info(f"The file {params_folder + paramsFilename} exists.")
+        loop.run_until_complete(coroutine)
+    except KeyboardInterrupt:
+        logging.info('Stopped (KeyboardInterrupt)')
+    finally:
+        loop.run_until_complete(Client.close_session())
+
+
+def calibrate(config: dict) -> None:
+    logging.info("Search for co-integrated pairs and calculate parameters")
+    run_loop(calculate_params(symbols=config["symbols"], lookback=config["lookback"], downsample=config["downsample"],
+                              basket_sizes=config["basket_sizes"], basket_prune_pvalue=config["basket_prune_pvalue"],
+                              bootstrap_replicates=config["bootstrap_replicates"], bootstrap_pvalue=config["bootstrap_pvalue"], bootstrap_seed=config["bootstrap_seed"]))
+
+
+def trade(config: dict, log_filename: Optional[str] = None) -> None:
+    params_filename = os.path.join(config["params_folder"], config["params_file"])
+    if os.path.exists(params_filename):
+        logging.info(f"The file {params_filename} exists.")
     else:
-        logging.info(f"The file {params_folder + paramsFilename} does not exist.")
-        
-        if RUN_PARAMS_CALCULATOR:
-            logging.info("Search for co-integrated pairs and calculate parameters")
-            loop = asyncio.get_event_loop()
-            try:
-               loop.run_until_complete(calculate_params(symbols=symbols, lookback=lookback, downsample=downsample))
-            except KeyboardInterrupt:
-                logging.info('Stopped (KeyboardInterrupt)')
-            finally:
-              loop.run_until_complete(Client.close_session()) 
-        else:
+        logging.info(f"The file {params_filename} does not exist.")
+        if not config["calibrate_if_missing"]:
             logging.info("Exit...")
-            exit()
+            return
+        calibrate(config)
     # Load parameters
-    cointPairsparams = []
     try:
-        with open(params_folder + paramsFilename, 'r') as file:
-            for line in file:
-                line = line.strip()
-                line = ast.literal_eval(line)
-                cointPairsparams.append(line)
-                logging.info(f"{line['asset 1']}-{line['asset 2']} Pair. Hedge ratio: {line['hedge ratio']}. Half Life: {line['half life']}. Const: {line['constant']}")
-            if len(cointPairsparams) == 0:
-                logging.info(f"No co-integrated pairs to trade today ({today}). Exit...")
-                exit()
+        cointPairsparams = load_params(params_filename)
+        if len(cointPairsparams) == 0:
+            logging.info(f"No co-integrated pairs to trade today ({datetime.datetime.today().date()}). Exit...")
+            return
     except Exception as e:
-        logging.warning(f"Cannot load {paramsFilename}! Error: {e}")
+        logging.warning(f"Cannot load {params_filename}! Error: {e}")
         logging.info("Exit...")
-        exit()
-    loop = asyncio.get_event_loop()
+        return
+    loop = new_event_loop()
     try:
-        loop.run_until_complete(market_open()) 
-        loop.run_until_complete(trader(cointPairsparams=cointPairsparams, total_capital=Total_capital, downsample=downsample, k=k)) 
+        loop.run_until_complete(market_open())
+        if config["workers"] > 0:
+            from sharded import sharded_trader
+            if config["signal_mode"] == SIGNAL_EWMA:
+                logging.warning("The ewma signal mode needs quote callbacks, the sharded workers trade the downsample mode")
+            if any("assets" in pair for pair in cointPairsparams):
+                logging.warning("The sharded workers trade pairs only, the baskets of the params file are skipped")
+                cointPairsparams = [pair for pair in cointPairsparams if "assets" not in pair]
+                if len(cointPairsparams) == 0:
+                    return
+            loop.run_until_complete(sharded_trader(cointPairsparams=cointPairsparams, total_capital=config["capital"], downsample=config["downsample"], k=config["k"],
+                                                   nr_workers=config["workers"], log_filename=log_filename, runtime_profile=config["profile"],
+                                                   hedge_mode=config["hedge_mode"], record=config["record"], risk_limits=config["risk"],
+                                                   metrics_port=config["metrics_port"], keepalive_interval=config["connections"]["keepalive_interval"],
+                                                   warm_connections=config["connections"]["warm_connections"]))
+        else:
+            loop.run_until_complete(trader(cointPairsparams=cointPairsparams, total_capital=config["capital"], downsample=config["downsample"], k=config["k"],
+                                           restore=config["restore"], hedge_mode=config["hedge_mode"], signal_mode=config["signal_mode"], record=config["record"], risk_limits=config["risk"],
+                                           loop_monitor=config["loop_monitor"], stall_threshold=config["stall_threshold"], metrics_port=config["metrics_port"],
+                                           params_filename=params_filename, watch_params=config["watch_params"],
+                                           keepalive_interval=config["connections"]["keepalive_interval"], warm_connections=config["connections"]["warm_connections"]))
     except KeyboardInterrupt:
         logging.info('Stopped (KeyboardInterrupt)')
     finally:
-        loop.run_until_complete(Client.close_session()) 
\ No newline at end of file
+        loop.run_until_complete(Client.close_session())
+
+
+def replay(config: dict, args: argparse.Namespace) -> None:
+    """Runs trader on the quotes of args.date in virtual time. Checkpoints, the recorder, the metrics endpoint and the keepalive are off,
+    the order events are archived under order_events/replay."""
+    from replay import SimulatedBroker, trading_session
+    from simulator import QuoteReplay, SyntheticQuotes
+    params_filename = os.path.join(config["params_folder"], config["params_file"])
+    try:
+        cointPairsparams = load_params(params_filename)
+    except Exception as e:
+        logging.warning(f"Cannot load {params_filename}! Error: {e}")
+        return
+    if len(cointPairsparams) == 0:
+        logging.info(f"No pairs in {params_filename}. Exit...")
+        return
+    symbols = sorted({symbol for pair in cointPairsparams for symbol in (pair["assets"] if "assets" in pair else (pair["asset 1"], pair["asset 2"]))})
+    if args.synthetic:
+        quotes = SyntheticQuotes(nr_symbols=len(symbols), quotes_per_second=args.quotes_per_second, seed=args.seed, symbols=symbols)
+    else:
+        quotes = QuoteReplay(symbols=symbols, date=args.date, data_folder=args.data_folder)
+    broker = SimulatedBroker(quotes, *trading_session(args.date), latency=args.latency_ms / 1000, seed=args.seed)
+    loop = broker.install()
+    start = time.perf_counter()
+    try:
+        loop.run_until_complete(market_open())
+        loop.run_until_complete(trader(cointPairsparams=cointPairsparams, total_capital=config["capital"], downsample=config["downsample"], k=config["k"],
+                                       restore=False, hedge_mode=config["hedge_mode"], signal_mode=config["signal_mode"], risk_limits=config["risk"],
+                                       loop_monitor=config["loop_monitor"], stall_threshold=config["stall_threshold"], params_filename=params_filename,
+                                       watch_params=config["watch_params"], stream_factory=broker.stream, checkpoints=False,
+                                       order_events_folder=REPLAY_ARCHIVE_FOLDER))
+    except SystemExit:
+        pass  # trader exits the process after the shutdown
+    except KeyboardInterrupt:
+        logging.info('Stopped (KeyboardInterrupt)')
+    finally:
+        loop.run_until_complete(Client.close_session())
+        broker.uninstall()
+    logging.info(f"Replay of {args.date} done in {time.perf_counter() - start:.1f} s: {broker.get_summary()}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    config = make_config(args)
+    log_filename = setup_logging()
+    logging.info(f"Main script has started. Command: {args.command}")
+    runtime.install_profile(config["profile"])
+    connections = config["connections"]
+    Client.configure(pool_sizes={POOL_TRADING: connections["trading_pool_size"], POOL_DATA: connections["data_pool_size"]},
+                     dns_cache_ttl=connections["dns_cache_ttl"], keepalive_timeout=connections["keepalive_timeout"])
+    if config["simulator_url"] is not None:
+        logging.info(f"Using simulator at {config['simulator_url']}")
+        Endpoints.configure(trading_url=config["simulator_url"], data_stream_url=config["simulator_url"])
+    if args.command == COMMAND_CALIBRATE:
+        calibrate(config)
+    elif args.command == COMMAND_REPLAY:
+        replay(config, args)
+    else:
+        trade(config, log_filename)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
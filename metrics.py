@@ -0,0 +1,233 @@
+"""Prometheus scrape endpoint served from the event loop of the trader.
+
+    server = MetricsServer(dataclient, ordermanager, pair_trades, port=9100)
+    await server.start()
+    ...
+    await server.stop()
+
+    curl http://127.0.0.1:9100/metrics
+
+The callbacks of DataClient and OrderManager only increment plain dict counters, everything else (quote
+ages, pair state, positions, exposure) is read when the endpoint is scraped. REST latency is timed with an
+aiohttp TraceConfig on the shared sessions, and a probe coroutine wakes up once per probe_interval to measure
+the loop lag. Quote ages are measured against the exchange timestamp of the last quote, so they include the
+feed delay and, with the simulator, the replay offset.
+"""
+import re
+import time
+import asyncio
+import logging
+import aiohttp
+from aiohttp import web
+from typing import Optional, List, Dict, Tuple
+from core import Client, DataClient, OrderManager, TimeSource
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+REST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PREFIX = "pairs"
+
+_ID_SEGMENT = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
+_SYMBOL_COLLECTIONS = {"positions", "assets"}
+
+
+def normalize_endpoint(path: str) -> str:
+    """/v2/orders/<uuid> becomes /v2/orders/{id} and /v2/positions/AAPL /v2/positions/{symbol}, to bound the label values."""
+    segments = path.split("/")
+    for i in range(1, len(segments)):
+        if _ID_SEGMENT.match(segments[i]):
+            segments[i] = "{id}"
+        elif segments[i - 1] in _SYMBOL_COLLECTIONS and segments[i]:
+            segments[i] = "{symbol}"
+    return "/".join(segments)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Optional[dict]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus layout, observe() is a linear scan over a few buckets."""
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets : Tuple[float, ...] = buckets
+        self.counts : List[int] = [0] * len(buckets)
+        self.count : int = 0
+        self.sum : float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def render(self, name: str, labels: Optional[dict] = None) -> List[str]:
+        labels = labels or {}
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {self.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {self.count}")
+        return lines
+
+
+class MetricsServer:
+
+    def __init__(self,
+                 dataclient: DataClient,
+                 ordermanager: OrderManager,
+                 pair_trades: Optional[list] = None,
+                 host: str = "127.0.0.1",
+                 port: int = 9100,
+                 loop_monitor=None,
+                 probe_interval: float = 1.0):
+        self._dataclient : DataClient = dataclient
+        self._ordermanager : OrderManager = ordermanager
+        self._pair_trades : list = pair_trades if pair_trades is not None else []
+        self._host : str = host
+        self._port : int = port
+        self._loop_monitor = loop_monitor  # LoopMonitor, its callback timings are exported when set
+        self._probe_interval : float = probe_interval
+        self._rest_latency : Dict[Tuple[str, str], Histogram] = {}
+        self._rest_errors : Dict[Tuple[str, str], int] = {}
+        self._loop_lag : Histogram = Histogram(LOOP_LAG_BUCKETS)
+        self._last_loop_lag : float = 0.0
+        self._runner : Optional[web.AppRunner] = None
+        self._probe_task : Optional[asyncio.Task] = None
+        self._start_time : float = TimeSource.time()
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params) -> None:
+        context.start = time.perf_counter()
+
+    async def _on_request_end(self, session, context, params) -> None:
+        key = (params.method, normalize_endpoint(params.url.path))
+        histogram = self._rest_latency.get(key, None)
+        if histogram is None:
+            histogram = self._rest_latency[key] = Histogram(REST_BUCKETS)
+        histogram.observe(time.perf_counter() - context.start)
+
+    async def _on_request_exception(self, session, context, params) -> None:
+        key = (params.method, normalize_endpoint(params.url.path))
+        self._rest_errors[key] = self._rest_errors.get(key, 0) + 1
+
+    async def start(self) -> None:
+        """Serves GET /metrics, starts the lag probe and traces the shared REST sessions."""
+        await Client.add_trace_config(self.trace_config())
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        self._probe_task = asyncio.create_task(self._probe())
+        logging.info(f"Metrics served on http://{self._host}:{self._port}/metrics")
+
+    async def stop(self) -> None:
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _probe(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self._probe_interval)
+            self._last_loop_lag = max(loop.time() - start - self._probe_interval, 0.0)
+            self._loop_lag.observe(self._last_loop_lag)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    def render(self) -> str:
+        lines : List[str] = []
+
+        def metric(name: str, kind: str, help: str, samples) -> None:
+            lines.append(f"# HELP {PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{PREFIX}_{name}{_labels(labels)} {value}")
+
+        counts = self._dataclient.get_message_counts()
+        metric("quotes_received_total", "counter", "Quotes received per symbol.", [({"symbol": symbol}, n) for symbol, n in counts["quote"].items()])
+        metric("trades_received_total", "counter", "Trades received per symbol.", [({"symbol": symbol}, n) for symbol, n in counts["trade"].items()])
+        metric("bars_received_total", "counter", "Bars received per symbol.", [({"symbol": symbol}, n) for symbol, n in counts["bar"].items()])
+        metric("trade_updates_total", "counter", "Trade updates received per event.", [({"event": event}, n) for event, n in counts["trade update"].items()])
+
+        now_ns = TimeSource.time_ns()
+        ages = []
+        for symbol in counts["quote"]:
+            quote = self._dataclient.get_last_quote(symbol)
+            timestamp = getattr(quote, "_raw", {}).get("timestamp", None) if quote is not None else None
+            if isinstance(timestamp, int):
+                ages.append(({"symbol": symbol}, (now_ns - timestamp) / 1e9))
+        metric("quote_age_seconds", "gauge", "Seconds since the exchange timestamp of the last quote.", ages)
+
+        positions = [({"symbol": symbol}, position.get("position", 0)) for symbol, position in self._dataclient.get_all_positions().items()]
+        metric("position", "gauge", "Position per symbol.", positions)
+
+        pair_samples = {"spread": [], "pertb": [], "spread position": [], "hedge ratio": [], "spread points": []}
+        for pair_trade in self._pair_trades:
+            labels = {"pair": pair_trade.get_name()}
+            for name, value in pair_trade.get_metrics().items():
+                if value is not None:
+                    pair_samples[name].append((labels, value))
+        metric("pair_spread", "gauge", "Last spread of the pair.", pair_samples["spread"])
+        metric("pair_percent_b", "gauge", "Last %b of the spread within the bands.", pair_samples["pertb"])
+        metric("pair_spread_position", "gauge", "Spread position, 1 long, -1 short, 0 flat.", pair_samples["spread position"])
+        metric("pair_hedge_ratio", "gauge", "Hedge ratio of the pair.", pair_samples["hedge ratio"])
+        metric("pair_spread_points", "gauge", "Spread data points in the rolling window.", pair_samples["spread points"])
+
+        metric("order_requests_total", "counter", "Order requests by outcome.",
+               [({"result": result.replace(" ", "_")}, n) for result, n in self._ordermanager.get_request_counts().items()])
+        risk_manager = self._ordermanager.get_risk_manager()
+        if risk_manager is not None:
+            exposure = risk_manager.get_exposure()
+            metric("gross_notional", "gauge", "Gross notional including pending orders.", [(None, exposure["gross notional"])])
+            metric("net_notional", "gauge", "Net notional including pending orders.", [(None, exposure["net notional"])])
+            metric("risk_open_orders", "gauge", "Open orders tracked by the risk manager.", [(None, exposure["open orders"])])
+            metric("kill_switch", "gauge", "1 once the kill switch is engaged.", [(None, int(exposure["killed"] is not None))])
+
+        lines.append(f"# HELP {PREFIX}_rest_request_duration_seconds REST request latency by method and endpoint.")
+        lines.append(f"# TYPE {PREFIX}_rest_request_duration_seconds histogram")
+        for (method, endpoint), histogram in self._rest_latency.items():
+            lines.extend(histogram.render(f"{PREFIX}_rest_request_duration_seconds", {"method": method, "endpoint": endpoint}))
+        connections = Client.get_connection_stats()
+        metric("rest_connections_opened_total", "counter", "REST connections opened per pool.", [({"pool": pool}, stats["created"]) for pool, stats in connections.items()])
+        metric("rest_connections_reused_total", "counter", "REST requests served by a pooled connection, per pool.", [({"pool": pool}, stats["reused"]) for pool, stats in connections.items()])
+        metric("rest_connection_reuse_ratio", "gauge", "Share of the REST requests that found a warm connection, per pool.",
+               [({"pool": pool}, stats["reuse ratio"]) for pool, stats in connections.items() if stats["reuse ratio"] is not None])
+        metric("rest_request_errors_total", "counter", "REST requests that raised, by method and endpoint.",
+               [({"method": method, "endpoint": endpoint}, n) for (method, endpoint), n in self._rest_errors.items()])
+
+        metric("event_loop_lag_seconds", "gauge", "Last measured event loop lag.", [(None, self._last_loop_lag)])
+        lines.append(f"# HELP {PREFIX}_event_loop_lag_seconds_distribution Event loop lag of the probe.")
+        lines.append(f"# TYPE {PREFIX}_event_loop_lag_seconds_distribution histogram")
+        lines.extend(self._loop_lag.render(f"{PREFIX}_event_loop_lag_seconds_distribution"))
+        if self._loop_monitor is not None:
+            callbacks = self._loop_monitor.get_summary()["callbacks"]
+            metric("callback_calls_total", "counter", "Calls per instrumented callback.", [({"callback": label}, s["count"]) for label, s in callbacks.items()])
+            metric("callback_seconds_total", "counter", "Wall time per instrumented callback.", [({"callback": label}, s["total"]) for label, s in callbacks.items()])
+            metric("callback_max_seconds", "gauge", "Longest call per instrumented callback.", [({"callback": label}, s["max"]) for label, s in callbacks.items()])
+
+        metric("start_time_seconds", "gauge", "Unix time the trader started.", [(None, self._start_time)])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,154 @@
+import os
+import queue
+import asyncio
+import atexit
+import logging
+import datetime
+import threading
+import runtime
+from collections import OrderedDict, defaultdict
+from typing import Optional, List, Dict, Iterable, Callable
+from alpaca_trade_api.entity import Entity
+
+ARCHIVE_FOLDER = "order_events"
+REPLAY_ARCHIVE_FOLDER = os.path.join(ARCHIVE_FOLDER, "replay")  # Replays never append to the archive of a live session
+
+
+class OrderEventStore:
+    """Latest trade update of every order, with bounded memory.
+
+    Orders that are still working stay in memory. When an order reaches a terminal event it moves to a
+    small LRU of completed orders, and the event is appended to a JSON lines archive by a background
+    thread, one file per day of today(), e.g. TimeSource.today so a replay files under its own date. Orders evicted from the LRU can still be looked up by id in the archive, off the
+    event loop with get_archived.
+    """
+
+    def __init__(self,
+                 terminal_events: Iterable[str],
+                 archive_folder: str = ARCHIVE_FOLDER,
+                 max_completed: int = 1000,
+                 today: Callable[[], datetime.date] = datetime.date.today):
+        self._terminal_events : set = set(terminal_events)
+        self._archive_folder : str = archive_folder
+        self._archive_filename : str = os.path.join(archive_folder, f"order_events_{today().strftime('%Y%m%d')}.jsonl")
+        self._max_completed : int = max_completed
+        self._active : Dict[str, Entity] = {}
+        self._active_by_symbol : Dict[str, Dict[str, Entity]] = defaultdict(dict)
+        self._completed : OrderedDict = OrderedDict()
+        self._archive_queue : queue.Queue = queue.Queue()
+        self._archive_thread : Optional[threading.Thread] = None
+        self._nr_archived : int = 0
+
+    def add(self, trade_update: Entity) -> None:
+        order = trade_update.order
+        symbol = order["symbol"]
+        id = order["id"]
+        if trade_update.event in self._terminal_events:
+            self._active.pop(id, None)
+            symbol_orders = self._active_by_symbol.get(symbol, None)
+            if symbol_orders is not None:
+                symbol_orders.pop(id, None)
+                if len(symbol_orders) == 0:
+                    del self._active_by_symbol[symbol]
+            self._completed[id] = trade_update
+            self._completed.move_to_end(id)
+            while len(self._completed) > self._max_completed:
+                self._completed.popitem(last=False)
+            self._archive(trade_update)
+        else:
+            self._active[id] = trade_update
+            self._active_by_symbol[symbol][id] = trade_update
+
+    def get(self, id: str, search_archive: bool = False) -> Optional[Entity]:
+        """Latest trade update of an order in memory. search_archive falls back to a blocking scan of the archive of
+        today for evicted orders, which does not belong on the event loop: use get_archived there."""
+        trade_update = self._active.get(id, None)
+        if trade_update is None:
+            trade_update = self._completed.get(id, None)
+        if trade_update is None and search_archive:
+            trade_update = self._find_archived(id)
+        return trade_update
+
+    async def get_archived(self, id: str) -> Optional[Entity]:
+        """get with the archive scan run in the default executor."""
+        trade_update = self.get(id)
+        if trade_update is None:
+            trade_update = await asyncio.get_running_loop().run_in_executor(None, self._find_archived, id)
+        return trade_update
+
+    def _find_archived(self, id: str) -> Optional[Entity]:
+        self.flush()
+        return find_order_event(id, [self._archive_filename])
+
+    def get_by_symbol(self, symbol: str) -> Dict[str, Entity]:
+        """Working orders of a symbol and the completed ones still in memory."""
+        trade_updates = {id: trade_update for id, trade_update in self._completed.items() if trade_update.order["symbol"] == symbol}
+        trade_updates.update(self._active_by_symbol.get(symbol, {}))
+        return trade_updates
+
+    def get_active(self) -> Dict[str, Entity]:
+        return dict(self._active)
+
+    def _archive(self, trade_update: Entity) -> None:
+        if self._archive_thread is None or not self._archive_thread.is_alive():
+            if self._archive_thread is None:
+                atexit.register(self.close)  # Write the tail of the archive on exit
+            self._archive_thread = threading.Thread(target=self._write_archive, name="order-event-archive", daemon=True)
+            self._archive_thread.start()
+        self._archive_queue.put(trade_update._raw)
+
+    def _write_archive(self) -> None:
+        os.makedirs(self._archive_folder, exist_ok=True)
+        with open(self._archive_filename, 'a') as file:
+            while True:
+                raw = self._archive_queue.get()
+                lines = []
+                nr_items = 0
+                stop = False
+                while True:  # Write everything that is queued with one flush
+                    nr_items += 1
+                    if raw is None:
+                        stop = True
+                    else:
+                        lines.append(runtime.json_dumps(raw) + '\n')
+                    try:
+                        raw = self._archive_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                file.writelines(lines)
+                file.flush()
+                self._nr_archived += len(lines)
+                for _ in range(nr_items):  # Only once written, so flush returns after the batch is in the file
+                    self._archive_queue.task_done()
+                if stop:
+                    return
+
+    def flush(self) -> None:
+        """Block until every queued event is written."""
+        if self._archive_thread is not None and self._archive_thread.is_alive():
+            self._archive_queue.join()
+
+    def close(self) -> None:
+        if self._archive_thread is not None and self._archive_thread.is_alive():
+            self._archive_queue.put(None)
+            self._archive_thread.join()
+            logging.info(f"Archived {self._nr_archived} order events to {self._archive_filename}")
+
+
+def find_order_event(id: str, filenames: Optional[List[str]] = None, archive_folder: str = ARCHIVE_FOLDER) -> Optional[Entity]:
+    """Last archived trade update of an order. Searches all archive files of archive_folder unless filenames is given."""
+    if filenames is None:
+        if not os.path.isdir(archive_folder):
+            return None
+        filenames = sorted(os.path.join(archive_folder, filename) for filename in os.listdir(archive_folder) if filename.endswith(".jsonl"))
+    found = None
+    for filename in filenames:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, 'r') as file:
+            for line in file:
+                if id in line:  # Cheap filter before decoding
+                    raw = runtime.json_loads(line)
+                    if raw["order"]["id"] == id:
+                        found = raw
+    return None if found is None else Entity(found)
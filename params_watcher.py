@@ -0,0 +1,203 @@
+"""Hot reload of the params file while trading.
+
+    watcher = ParamsWatcher(dataclient, ordermanager, pair_trades, pair_tasks, make_pair_trade, load_params,
+                            params_filename, total_capital, hedge_mode)
+    asyncio.create_task(watcher.run())
+
+The file is polled for a new modification time or size and parsed completely before anything changes, so a
+file that does not parse leaves the running pairs alone. Write the new file next to the old one and rename it
+into place. A reload then, in one pass:
+
+1. subscribes the symbols of the new pairs on the live stream
+2. updates the per pair limits of the risk manager, the capital is shared equally by the new pairs
+3. re-parameterizes the pairs that stay, with their spread window recomputed from the stored mid prices
+4. retires the pairs that left the file, they close their position and stop once both legs are flat
+5. starts the new pairs. A new pair that shares a symbol with a retiring pair waits until that one is flat,
+   both would otherwise size their orders from the same position and trade against each other
+
+Pairs are matched regardless of the order of their legs: a pair whose legs swapped in the file keeps running,
+with the new parameters turned around to its own leg order.
+
+pair_trades and pair_tasks are the lists of the trader, pair_tasks[i] runs pair_trades[i]. They are changed
+in place, so the checkpointer, the metrics endpoint and the shutdown coordinator see the current pairs.
+Symbols are unsubscribed once no pair trades them and their position is flat.
+"""
+import os
+import asyncio
+import logging
+from typing import Optional, List, Dict, Tuple, Callable
+from core import DataClient, OrderManager, pair_limits
+from PairTrade import PairTrade
+from hedge import make_hedge_estimator
+
+PARAM_KEYS = ("hedge ratio", "constant", "half life")
+
+
+def pair_name(pair: dict) -> str:
+    return f"{pair['asset 1']}-{pair['asset 2']}"
+
+
+def pair_key(symbols) -> Tuple[str, ...]:
+    """Identifies a pair by its symbols, whatever the order of its legs."""
+    return tuple(sorted(symbols))
+
+
+def swap_legs(pair: dict) -> dict:
+    """The params of the pair with asset 1 and asset 2 swapped: asset 2 = h * asset 1 + c is asset 1 = asset 2 / h - c / h."""
+    hedge_ratio = pair["hedge ratio"]
+    swapped = dict(pair)
+    swapped.update({"asset 1": pair["asset 2"], "asset 2": pair["asset 1"], "hedge ratio": 1 / hedge_ratio, "constant": -pair["constant"] / hedge_ratio})
+    if "res std" in pair:
+        swapped["res std"] = pair["res std"] / abs(hedge_ratio)
+    if "res mean" in pair:
+        swapped["res mean"] = -pair["res mean"] / hedge_ratio
+    return swapped
+
+
+class ParamsWatcher:
+
+    def __init__(self,
+                 dataclient: DataClient,
+                 ordermanager: OrderManager,
+                 pair_trades: List[PairTrade],
+                 pair_tasks: List[asyncio.Task],
+                 make_pair_trade: Callable[[dict, float], PairTrade],
+                 load_params: Callable[[str], List[dict]],
+                 params_filename: str,
+                 total_capital: float,
+                 hedge_mode: str,
+                 risk_limits: Optional[dict] = None,
+                 poll_interval: float = 5):
+        self._dataclient : DataClient = dataclient
+        self._ordermanager : OrderManager = ordermanager
+        self._pair_trades : List[PairTrade] = pair_trades
+        self._pair_tasks : List[asyncio.Task] = pair_tasks
+        self._make_pair_trade : Callable[[dict, float], PairTrade] = make_pair_trade  # (params of the pair, capital) -> PairTrade
+        self._load_params : Callable[[str], List[dict]] = load_params
+        self._params_filename : str = params_filename
+        self._total_capital : float = total_capital
+        self._hedge_mode : str = hedge_mode
+        self._risk_limits : Optional[dict] = risk_limits
+        self._poll_interval : float = poll_interval
+        self._params : Dict[Tuple[str, ...], dict] = {}  # pair key -> params in the leg order of the running pair
+        self._capital_per_pair : Optional[float] = None
+        self._retiring : Dict[PairTrade, asyncio.Task] = {}
+        self._deferred : Dict[Tuple[str, ...], dict] = {}  # New pairs waiting for a retiring pair on one of their symbols
+        self._file_version : Optional[Tuple[int, int]] = None
+        self._nr_reloads : int = 0
+
+    def _read_version(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._params_filename)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self, cointPairsparams: List[dict]) -> None:
+        """Records the params the pairs were started with. Call before run()."""
+        self._params = {pair_key((pair["asset 1"], pair["asset 2"])): pair for pair in cointPairsparams if "assets" not in pair}
+        self._capital_per_pair = round(self._total_capital / len(cointPairsparams)) if len(cointPairsparams) > 0 else None
+        self._file_version = self._read_version()
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            await self._reap_retired()
+            version = self._read_version()
+            if version is None or version == self._file_version:
+                continue
+            self._file_version = version
+            try:
+                cointPairsparams = self._load_params(self._params_filename)
+            except Exception as e:
+                logging.warning(f"Cannot load {self._params_filename}, keep the current pairs. Error: {e}")
+                continue
+            await self.reload(cointPairsparams)
+
+    def _pair_trade_by_key(self) -> Dict[Tuple[str, ...], PairTrade]:
+        pair_trades = {pair_key(pair_trade.get_symbols()): pair_trade for pair_trade in self._pair_trades if not pair_trade.is_retiring()}
+        return {key: pair_trade for key, pair_trade in pair_trades.items() if key in self._params}
+
+    async def reload(self, cointPairsparams: List[dict]) -> None:
+        """Baskets keep running as they were started, only the pairs of the file are reloaded."""
+        nr_baskets = sum(1 for pair in cointPairsparams if "assets" in pair)
+        active = self._pair_trade_by_key()
+        params = {}
+        for pair in cointPairsparams:
+            if "assets" in pair:
+                continue
+            key = pair_key((pair["asset 1"], pair["asset 2"]))
+            swapped = key in active and active[key].get_symbols()[0] != pair["asset 1"]
+            params[key] = swap_legs(pair) if swapped else pair
+        self._deferred.clear()  # Pairs still waiting are added again below, if they are still in the file
+        added = [key for key in params if key not in active]
+        removed = [key for key in active if key not in params]
+        capital_per_pair = round(self._total_capital / (len(params) + nr_baskets)) if len(params) + nr_baskets > 0 else None
+        changed = [key for key in params if key in active and
+                   (capital_per_pair != self._capital_per_pair or any(params[key].get(name) != self._params.get(key, {}).get(name) for name in PARAM_KEYS))]
+        if len(params) == 0:
+            logging.warning(f"No pairs in {self._params_filename}, retire every pair")
+        logging.info(f"Reload {self._params_filename}: {len(added)} new, {len(removed)} retired, {len(changed)} re-parameterized pairs")
+
+        await self._dataclient.subscribe({symbol for key in added for symbol in key})
+        risk_manager = self._ordermanager.get_risk_manager()
+        if risk_manager is not None and self._risk_limits is not None and len(params) > 0:
+            risk_manager.set_pair_limits(**pair_limits(cointPairsparams, self._total_capital, self._risk_limits))
+
+        for key in changed:
+            pair = params[key]
+            await active[key].reparameterize(hedge_ratio=pair["hedge ratio"], const=pair["constant"], capital=capital_per_pair, half_life=pair.get("half life", None),
+                                              hedge_estimator=make_hedge_estimator([pair], self._hedge_mode), hedge_index=0)
+        for key in removed:
+            pair_trade = active[key]
+            pair_trade.retire()
+            self._retiring[pair_trade] = self._task_of(pair_trade)
+        for key in added:
+            for pair_trade in [pair_trade for pair_trade in self._retiring if pair_key(pair_trade.get_symbols()) == key]:
+                task = self._retiring.pop(pair_trade)
+                if task is not None:
+                    task.cancel()  # Back in the file before it was flat, the new instance takes over the legs
+                self._remove(pair_trade)
+        for key in added:
+            if self._held_by_retiring(key):
+                logging.info(f"Start of the {pair_name(params[key])} pair deferred until the retiring pairs on its symbols are flat")
+                self._deferred[key] = params[key]
+            else:
+                self._start(params[key], capital_per_pair)
+
+        self._params = params
+        self._capital_per_pair = capital_per_pair
+        self._nr_reloads += 1
+        await self._reap_retired()
+
+    def _held_by_retiring(self, key: Tuple[str, ...]) -> bool:
+        return any(symbol in key for pair_trade in self._retiring for symbol in pair_trade.get_symbols())
+
+    def _start(self, pair: dict, capital: float) -> None:
+        pair_trade = self._make_pair_trade(pair, capital)
+        self._pair_trades.append(pair_trade)
+        self._pair_tasks.append(asyncio.create_task(pair_trade._trader()))
+
+    def _task_of(self, pair_trade: PairTrade) -> Optional[asyncio.Task]:
+        index = self._pair_trades.index(pair_trade)
+        return self._pair_tasks[index] if index < len(self._pair_tasks) else None
+
+    def _remove(self, pair_trade: PairTrade) -> None:
+        index = self._pair_trades.index(pair_trade)
+        del self._pair_trades[index]
+        if index < len(self._pair_tasks):
+            del self._pair_tasks[index]
+
+    async def _reap_retired(self) -> None:
+        """Drops the retired pairs that are flat, starts the deferred pairs they held up and unsubscribes the symbols
+        nobody trades any more."""
+        for pair_trade, task in list(self._retiring.items()):
+            if task is None or task.done():
+                del self._retiring[pair_trade]
+                self._remove(pair_trade)
+        for key in [key for key in self._deferred if not self._held_by_retiring(key)]:
+            self._start(self._deferred.pop(key), self._capital_per_pair)
+        symbols_in_use = {symbol for pair_trade in self._pair_trades for symbol in pair_trade.get_symbols()} | {symbol for key in self._deferred for symbol in key}
+        unused = {symbol for symbol in self._dataclient.get_symbols() - symbols_in_use if self._dataclient.get_position_by_symbol(symbol) == 0}
+        if len(unused) > 0:
+            await self._dataclient.unsubscribe(unused)
@@ -0,0 +1,127 @@
+"""Append-only binary tape of the live market data seen by DataClient.
+
+Every symbol, day and kind gets one file of fixed-width little-endian records, e.g.
+data/NVDA_20241011_quote.bin. The record layouts are the numpy dtypes below, so a tape is read with
+np.fromfile(filename, dtype=QUOTE_DTYPE) from any tool. Timestamps are nanoseconds since the epoch (UTC).
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from collections import deque, defaultdict
+from typing import Optional, Dict, List
+
+QUOTE_DTYPE = np.dtype([("timestamp", "<i8"), ("bid_price", "<f8"), ("bid_size", "<f8"), ("ask_price", "<f8"), ("ask_size", "<f8")])
+TRADE_DTYPE = np.dtype([("timestamp", "<i8"), ("price", "<f8"), ("size", "<f8")])
+BAR_DTYPE = np.dtype([("timestamp", "<i8"), ("open", "<f8"), ("high", "<f8"), ("low", "<f8"), ("close", "<f8"), ("volume", "<f8")])
+
+KIND_QUOTE = "quote"
+KIND_TRADE = "trade"
+KIND_BAR = "bar"
+DTYPES = {KIND_QUOTE: QUOTE_DTYPE, KIND_TRADE: TRADE_DTYPE, KIND_BAR: BAR_DTYPE}
+
+NANOSECONDS_PER_DAY = 86400 * 1_000_000_000
+
+
+def tape_filename(data_folder: str, symbol: str, date: str, kind: str = KIND_QUOTE) -> str:
+    """date as YYYYMMDD, like the csv files of the parameter calculator."""
+    return os.path.join(data_folder, f"{symbol}_{date}_{kind}.bin")
+
+
+def read_tape(filename: str, kind: str = KIND_QUOTE) -> np.ndarray:
+    dtype = DTYPES[kind]
+    nr_records = os.path.getsize(filename) // dtype.itemsize  # Ignore a partly written last record
+    return np.fromfile(filename, dtype=dtype, count=nr_records)
+
+
+def tape_to_frame(records: np.ndarray) -> pd.DataFrame:
+    """DataFrame indexed by a UTC timestamp, with the same column names as the downloaded quote csv files."""
+    frame = pd.DataFrame({name: records[name] for name in records.dtype.names if name != "timestamp"})
+    frame.index = pd.DatetimeIndex(pd.to_datetime(records["timestamp"], unit="ns", utc=True), name="timestamp")
+    return frame
+
+
+def tape_covers(filename: str, start: str, end: str, tolerance: float = 300) -> bool:
+    """True if the tape starts within tolerance seconds after start, ends within tolerance seconds before end and has
+    no hole of more than tolerance seconds in between, e.g. while the trader was down."""
+    if not os.path.exists(filename):
+        return False
+    records = read_tape(filename, KIND_QUOTE)
+    if len(records) == 0:
+        return False
+    start_ns = pd.Timestamp(start).value
+    end_ns = pd.Timestamp(end).value
+    timestamps = records["timestamp"]
+    if (timestamps[0] > start_ns + tolerance * 1e9) or (timestamps[-1] < end_ns - tolerance * 1e9):
+        return False
+    session = timestamps[(timestamps >= start_ns) & (timestamps <= end_ns)]
+    return len(session) > 0 and np.diff(session).max(initial=0) <= tolerance * 1e9
+
+
+class MarketDataRecorder:
+    """Collects quotes, trades and bars on the event loop and appends them to the tape from a background thread.
+
+    The event loop only appends a tuple to a deque. The writer thread wakes up every flush_interval
+    seconds, drains the deques, groups the records by symbol and day and appends each group with one write.
+    """
+
+    def __init__(self, data_folder: str = "data", flush_interval: float = 1.0):
+        self._data_folder : str = data_folder
+        self._flush_interval : float = flush_interval
+        self._pending : Dict[str, deque] = {kind: deque() for kind in DTYPES}
+        self._nr_records : Dict[str, int] = defaultdict(int)
+        self._stop_event : threading.Event = threading.Event()
+        self._thread : Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            os.makedirs(self._data_folder, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name="market-data-recorder", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+            logging.info(f"Recording market data to {self._data_folder}")
+
+    def record_quote(self, quote) -> None:
+        raw = quote._raw
+        self._pending[KIND_QUOTE].append((raw["symbol"], raw["timestamp"], raw["bid_price"], raw["bid_size"], raw["ask_price"], raw["ask_size"]))
+
+    def record_trade(self, trade) -> None:
+        raw = trade._raw
+        self._pending[KIND_TRADE].append((raw["symbol"], raw["timestamp"], raw["price"], raw["size"]))
+
+    def record_bar(self, bar) -> None:
+        raw = bar._raw
+        self._pending[KIND_BAR].append((raw["symbol"], raw["timestamp"], raw["open"], raw["high"], raw["low"], raw["close"], raw["volume"]))
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        for kind, pending in self._pending.items():
+            nr_pending = len(pending)  # deque.popleft is thread safe, records appended meanwhile wait for the next flush
+            if nr_pending == 0:
+                continue
+            groups : Dict[tuple, List[tuple]] = defaultdict(list)
+            for _ in range(nr_pending):
+                record = pending.popleft()
+                groups[(record[0], record[1] // NANOSECONDS_PER_DAY)].append(record[1:])
+            for (symbol, day), records in groups.items():
+                date = time.strftime('%Y%m%d', time.gmtime(day * 86400))
+                try:
+                    with open(tape_filename(self._data_folder, symbol, date, kind), 'ab') as file:
+                        file.write(np.array(records, dtype=DTYPES[kind]).tobytes())
+                except Exception as e:
+                    logging.error(f"Failed to record {len(records)} {kind} records of {symbol}: {e}")
+                    continue
+                self._nr_records[kind] += len(records)
+
+    def close(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            self._stop_event.set()
+            self._thread.join()
+            logging.info(f"Recorded {dict(self._nr_records)} records to {self._data_folder}")
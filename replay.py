@@ -0,0 +1,336 @@
+"""Replay of a recorded trading day through the real trader, in virtual time.
+
+    python main.py --downsample 30 replay --date 20241010
+    python main.py --downsample 5 --params-file test_ds5.txt replay --date 20241010 --synthetic --quotes-per-second 50
+
+main.trader runs unchanged on a VirtualTimeEventLoop, against an in-process SimulatedBroker instead of the
+Alpaca endpoints:
+
+- VirtualTimeEventLoop: loop.time() is a virtual clock. Whenever every task waits, the loop jumps to its next
+  timer instead of sleeping, so asyncio.sleep, wait_for and the deadlines of the shutdown cost no wall time.
+  run_in_executor runs inline, a thread would let the clock run ahead of it.
+- core.TimeSource follows the loop, for the rate limits of the risk manager, the ewma signal, the checkpoint
+  timestamps and the order timestamps of the matching engine.
+- SimulatedSession answers the REST calls of OrderManager, PositionManager and MarketClockCalendar from the
+  MatchingEngine of simulator.py and the session of the replayed day, without a socket.
+- SimulatedStream stands in for the Alpaca stream of DataClient. It delivers every quote at its timestamp on
+  the virtual clock, and the trade updates and fills of the matching engine in the order they happen.
+
+A 6.5 hour session then takes as long as the CPU needs for its quotes. With the same quotes, seed and
+PYTHONHASHSEED two replays send the same orders in the same order, which makes them usable as regression runs.
+"""
+import asyncio
+import logging
+import datetime
+import selectors
+import pandas as pd
+from yarl import URL
+from collections import deque
+from typing import Optional, Callable, Iterator, Tuple, Dict
+from alpaca_trade_api.entity import Entity
+from alpaca_trade_api.entity_v2 import Quote, Trade, quote_mapping_v2, trade_mapping_v2  # The entities of the live stream
+import runtime
+from core import TimeSource, Client, FILL_EVENT, SIDE_BUY
+from simulator import MatchingEngine, market_clock, market_calendar
+
+MARKET_TIMEZONE = "America/New_York"
+MARKET_OPEN = pd.Timedelta(hours=9, minutes=30)
+MARKET_CLOSE = pd.Timedelta(hours=16)
+
+
+def trading_session(date: str) -> Tuple[datetime.datetime, datetime.datetime]:
+    """Open and close of date (YYYYMMDD) as naive UTC datetimes, like the times of the clock endpoint."""
+    day = pd.Timestamp(date)
+    return tuple((day + offset).tz_localize(MARKET_TIMEZONE).tz_convert("UTC").tz_localize(None).to_pydatetime() for offset in (MARKET_OPEN, MARKET_CLOSE))
+
+
+class _VirtualTimeSelector(selectors.DefaultSelector):
+    """Polls the file descriptors without blocking. When none is ready the wait for the next timer is skipped
+    and the virtual clock advanced by it instead."""
+
+    def __init__(self, advance: Callable[[float], None]):
+        super().__init__()
+        self._advance : Callable[[float], None] = advance
+
+    def select(self, timeout: Optional[float] = None):
+        events = super().select(0)
+        if len(events) > 0 or timeout == 0:
+            return events
+        if timeout is None:
+            return super().select(None)  # No timer, only I/O can wake the loop
+        self._advance(timeout)
+        return events
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+
+    def __init__(self, start_time_ns: int):
+        self._start_time_ns : int = start_time_ns  # Epoch time of loop.time() 0, small loop times keep the float precision
+        self._virtual_time : float = 0.0
+        super().__init__(selector=_VirtualTimeSelector(self._advance))
+
+    def _advance(self, seconds: float) -> None:
+        self._virtual_time += seconds
+
+    def time(self) -> float:
+        return self._virtual_time
+
+    def time_ns(self) -> int:
+        return self._start_time_ns + round(self._virtual_time * 1e9)
+
+    def run_in_executor(self, executor, func, *args) -> asyncio.Future:
+        future = self.create_future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class _SimulatedResponse:
+    """The part of aiohttp.ClientResponse the clients of core.py read."""
+
+    def __init__(self, status: int, body):
+        self.status : int = status
+        self._text : str = "" if body is None else runtime.json_dumps(body)
+
+    async def text(self) -> str:
+        return self._text
+
+    async def json(self, loads: Callable = runtime.json_loads):
+        return loads(self._text)
+
+
+class _SimulatedRequest:
+
+    def __init__(self, session: "SimulatedSession", method: str, url: str, params: Optional[dict], body: Optional[dict]):
+        self._session : SimulatedSession = session
+        self._method : str = method
+        self._url : URL = URL(url)
+        self._params : Optional[dict] = params
+        self._body : Optional[dict] = body
+
+    async def __aenter__(self) -> _SimulatedResponse:
+        if self._session.latency > 0:
+            await asyncio.sleep(self._session.latency)
+        query = {**self._url.query, **{key: str(value) for key, value in (self._params or {}).items()}}
+        return _SimulatedResponse(*self._session.broker.handle(self._method, self._url.path, query, self._body))
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+class SimulatedSession:
+    """Stands in for the aiohttp session of core.Client. Every request reaches the broker after latency seconds of virtual time."""
+
+    def __init__(self, broker: "SimulatedBroker", latency: float = 0.0):
+        self.broker : SimulatedBroker = broker
+        self.latency : float = latency
+        self.closed : bool = False
+
+    def get(self, url: str, params: Optional[dict] = None, json: Optional[dict] = None) -> _SimulatedRequest:
+        return _SimulatedRequest(self, "GET", url, params, json)
+
+    def post(self, url: str, params: Optional[dict] = None, json: Optional[dict] = None) -> _SimulatedRequest:
+        return _SimulatedRequest(self, "POST", url, params, json)
+
+    def delete(self, url: str, params: Optional[dict] = None, json: Optional[dict] = None) -> _SimulatedRequest:
+        return _SimulatedRequest(self, "DELETE", url, params, json)
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+def _entity(mapping: Dict[str, str], message: dict) -> dict:
+    return {mapping[key]: value for key, value in message.items() if key in mapping}
+
+
+class SimulatedStream:
+    """Stands in for alpaca_trade_api.stream.Stream in DataClient, fed by the broker."""
+
+    def __init__(self, broker: "SimulatedBroker"):
+        self._broker : SimulatedBroker = broker
+        self._handlers : Dict[str, Optional[Callable]] = {"quotes": None, "trades": None, "bars": None, "trade_updates": None}
+        self._symbols : Dict[str, set] = {"quotes": set(), "trades": set(), "bars": set()}
+
+    def _subscribe(self, channel: str, handler: Callable, symbols) -> None:
+        self._handlers[channel] = handler
+        self._symbols[channel].update(symbols)
+
+    def subscribe_quotes(self, handler: Callable, *symbols) -> None:
+        self._subscribe("quotes", handler, symbols)
+
+    def subscribe_trades(self, handler: Callable, *symbols) -> None:
+        self._subscribe("trades", handler, symbols)
+
+    def subscribe_bars(self, handler: Callable, *symbols) -> None:
+        self._subscribe("bars", handler, symbols)  # The replay has no bars
+
+    def subscribe_trade_updates(self, handler: Callable) -> None:
+        self._handlers["trade_updates"] = handler
+
+    def unsubscribe_quotes(self, *symbols) -> None:
+        self._symbols["quotes"].difference_update(symbols)
+
+    def unsubscribe_trades(self, *symbols) -> None:
+        self._symbols["trades"].difference_update(symbols)
+
+    def unsubscribe_bars(self, *symbols) -> None:
+        self._symbols["bars"].difference_update(symbols)
+
+    def handler(self, channel: str, symbol: Optional[str] = None) -> Optional[Callable]:
+        """Handler of the channel, None when nobody listens to it or to the symbol."""
+        if symbol is not None and symbol not in self._symbols[channel]:
+            return None
+        return self._handlers[channel]
+
+    async def _run_forever(self) -> None:
+        await self._broker.run(self)
+
+    def run(self) -> None:
+        asyncio.get_event_loop().run_until_complete(self._run_forever())
+
+
+class SimulatedBroker:
+    """Quotes, matching engine, market clock and cash of the simulated account of a replay.
+
+        broker = SimulatedBroker(QuoteReplay(symbols, "20241010"), *trading_session("20241010"))
+        loop = broker.install()
+        loop.run_until_complete(trader(..., stream_factory=broker.stream))
+    """
+
+    def __init__(self,
+                 quotes: Iterator,
+                 session_open: datetime.datetime,
+                 session_close: datetime.datetime,
+                 latency: float = 0.0,
+                 seed: int = 0):
+        self._quotes : Iterator = quotes
+        self._session_open : datetime.datetime = session_open
+        self._session_close : datetime.datetime = session_close
+        self._latency : float = latency
+        self._engine : MatchingEngine = MatchingEngine(seed=seed)
+        self._engine.add_trade_update_listener(self._on_trade_update)
+        self._engine.add_trade_listener(self._on_trade)
+        self._stream : Optional[SimulatedStream] = None
+        self._messages : deque = deque()  # (handler, entity) of the trade updates and trades, dispatched in order
+        self._message_event : asyncio.Event = asyncio.Event()
+        self._cash : float = 0.0
+        self._nr_quotes : int = 0
+        self._record_factory : Optional[Callable] = None
+
+    def install(self) -> VirtualTimeEventLoop:
+        """Creates the virtual time loop, starting at the open, and points core.TimeSource, core.Client and the
+        timestamps of the log records at it."""
+        start_time_ns = pd.Timestamp(self._session_open).value
+        loop = VirtualTimeEventLoop(start_time_ns)
+        asyncio.set_event_loop(loop)
+        TimeSource.configure(time_ns=loop.time_ns, monotonic=loop.time)
+        Client.use_session(SimulatedSession(self, latency=self._latency))
+        record_factory = self._record_factory = logging.getLogRecordFactory()
+
+        def virtual_time_record(*args, **kwargs) -> logging.LogRecord:
+            record = record_factory(*args, **kwargs)
+            record.created = TimeSource.time()
+            record.msecs = (record.created - int(record.created)) * 1000
+            return record
+        logging.setLogRecordFactory(virtual_time_record)
+        return loop
+
+    def uninstall(self) -> None:
+        TimeSource.reset()
+        if self._record_factory is not None:
+            logging.setLogRecordFactory(self._record_factory)
+            self._record_factory = None
+
+    def stream(self) -> SimulatedStream:
+        self._stream = SimulatedStream(self)
+        return self._stream
+
+    def get_summary(self) -> dict:
+        """P&L of the fills, with the open positions valued at their last mid."""
+        positions = self._engine.get_positions()
+        return {"quotes": self._nr_quotes, "orders": self._engine.nr_orders, "fills": self._engine.nr_fills, "open positions": len(positions),
+                "pnl": round(self._cash + sum(float(position["market_value"]) for position in positions), 2)}
+
+    # REST
+
+    def handle(self, method: str, path: str, query: dict, body: Optional[dict]) -> Tuple[int, object]:
+        """(status, json body) of a request, with the routes of SimulatorServer."""
+        engine = self._engine
+        segments = path.strip("/").split("/")
+        resource = segments[1] if len(segments) > 1 else None
+        key = segments[2] if len(segments) > 2 else None
+        if resource == "clock" and method == "GET":
+            return 200, market_clock(datetime.datetime.utcfromtimestamp(TimeSource.time()), self._session_open, self._session_close)
+        if resource == "calendar" and method == "GET":
+            return 200, market_calendar(query["start"], query["end"])
+        if resource == "orders":
+            if key is not None:
+                if method == "DELETE":
+                    return engine.cancel_order(key)
+                order = engine.get_order(key)
+                return (200, order) if order is not None else (404, {"code": 40410000, "message": "order not found"})
+            if method == "POST":
+                limit_price = body.get("limit_price", None)
+                return engine.submit_order(symbol=body["symbol"], qty=float(body["qty"]), side=body["side"], order_type=body.get("type", "limit"),
+                                           time_in_force=body["time_in_force"], limit_price=None if limit_price is None else float(limit_price))
+            if method == "DELETE":
+                return 207, engine.cancel_all_orders()
+            symbols = query.get("symbols", None)
+            return 200, engine.get_orders(status=query.get("status", "open"), symbols=symbols.split(",") if symbols else None)
+        if resource == "positions":
+            if key is not None:
+                if method == "DELETE":
+                    qty, percentage = query.get("qty", None), query.get("percentage", None)
+                    return engine.close_position(key, qty=None if qty is None else float(qty), percentage=None if percentage is None else float(percentage))
+                position = engine.get_position(key)
+                return (200, position) if position is not None else (404, {"code": 40410000, "message": "position does not exist"})
+            if method == "DELETE":
+                return 207, engine.close_all_positions(cancel_orders=bool((body or {}).get("cancel_orders", False)))
+            return 200, engine.get_positions()
+        return 404, {"code": 40410000, "message": f"{method} {path} not found"}
+
+    # Stream
+
+    def _queue(self, handler: Optional[Callable], entity) -> None:
+        if handler is not None:
+            self._messages.append((handler, entity))
+            self._message_event.set()
+
+    def _on_trade_update(self, trade_update: dict) -> None:
+        if trade_update["event"] in FILL_EVENT:
+            notional = float(trade_update["price"]) * float(trade_update["qty"])
+            self._cash += -notional if trade_update["order"]["side"] == SIDE_BUY else notional
+        if self._stream is not None:
+            self._queue(self._stream.handler("trade_updates"), Entity(trade_update))
+
+    def _on_trade(self, symbol: str, price: float, qty: float) -> None:
+        if self._stream is not None:
+            self._queue(self._stream.handler("trades", symbol), Trade(_entity(trade_mapping_v2, {"T": "t", "S": symbol, "i": self._engine.nr_fills, "x": "V", "p": price,
+                                                                                                  "s": qty, "t": TimeSource.time_ns(), "c": ["@"], "z": "C"})))
+
+    async def _dispatch(self) -> None:
+        """Trade updates and trades, one at a time like the handlers of the Alpaca stream."""
+        while True:
+            await self._message_event.wait()
+            self._message_event.clear()
+            while len(self._messages) > 0:
+                handler, entity = self._messages.popleft()
+                await handler(entity)
+
+    async def run(self, stream: SimulatedStream) -> None:
+        """Delivers every quote at its timestamp on the virtual clock. Quotes before the start arrive at once."""
+        dispatch_task = asyncio.create_task(self._dispatch())
+        for timestamp, symbol, bid, bid_size, ask, ask_size in self._quotes:
+            delay = (timestamp - TimeSource.time_ns()) / 1e9
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._nr_quotes += 1
+            self._engine.on_quote(symbol, bid, ask)
+            handler = stream.handler("quotes", symbol)
+            if handler is not None:
+                await handler(Quote(_entity(quote_mapping_v2, {"T": "q", "S": symbol, "bx": "V", "bp": bid, "bs": bid_size, "ax": "V", "ap": ask, "as": ask_size,
+                                                               "t": timestamp, "c": ["R"], "z": "C"})))
+        logging.info(f"Replay finished after {self._nr_quotes} quotes")
+        await dispatch_task  # Trade updates of the shutdown still arrive after the last quote
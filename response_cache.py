@@ -0,0 +1,107 @@
+"""Content-addressed on-disk cache of API responses.
+
+An entry is keyed on the sha256 of the normalized request (endpoint and sorted parameters), so the same
+request always maps to the same file, cache/<first 2 hex digits>/<key>.entry. The first line of an entry is
+a JSON header with the request, the creation time, the payload size and the payload sha256, the rest is the
+payload. Entries are written to a temporary file and renamed into place, and a payload that does not match
+its header is deleted and treated as a miss, so a crash never leaves a partial response that is reused.
+
+    cache = ResponseCache("cache")
+    payload = cache.get("/v2/calendar", {"start": "2024-10-01", "end": "2024-10-14"}, ttl=CALENDAR_TTL)
+    if payload is None:
+        payload = download()
+        cache.put("/v2/calendar", {"start": "2024-10-01", "end": "2024-10-14"}, payload)
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import datetime
+from typing import Optional
+
+CALENDAR_TTL = 12 * 3600  # Seconds. Sessions can be added or shortened, historical quotes never change and have no TTL
+
+
+def normalize_request(endpoint: str, params: Optional[dict] = None) -> str:
+    """Canonical text of a request. Parameters that are None are dropped, dates become ISO strings."""
+    normalized = {}
+    for name, value in (params or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        normalized[name] = value if isinstance(value, (int, float, bool, list)) else str(value)
+    return json.dumps({"endpoint": endpoint, "params": normalized}, sort_keys=True, separators=(',', ':'))
+
+
+class ResponseCache:
+
+    def __init__(self, cache_folder: str = "cache"):
+        self._cache_folder : str = cache_folder
+        self._nr_hits : int = 0
+        self._nr_misses : int = 0
+
+    def key(self, endpoint: str, params: Optional[dict] = None) -> str:
+        return hashlib.sha256(normalize_request(endpoint, params).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._cache_folder, key[:2], f"{key}.entry")
+
+    def get(self, endpoint: str, params: Optional[dict] = None, ttl: Optional[float] = None) -> Optional[bytes]:
+        """Payload of a valid entry younger than ttl seconds, None otherwise."""
+        key = self.key(endpoint, params)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                header = json.loads(file.readline())
+                payload = file.read()
+        except FileNotFoundError:
+            self._nr_misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Unreadable cache entry {path}: {e}")
+            self._discard(path)
+            self._nr_misses += 1
+            return None
+        if header.get("key") != key or header.get("size") != len(payload) or header.get("sha256") != hashlib.sha256(payload).hexdigest():
+            logging.warning(f"Cache entry {path} failed the integrity check, discarded")
+            self._discard(path)
+            self._nr_misses += 1
+            return None
+        if ttl is not None and time.time() - header["created"] > ttl:
+            self._nr_misses += 1
+            return None
+        self._nr_hits += 1
+        return payload
+
+    def put(self, endpoint: str, params: Optional[dict], payload: bytes) -> str:
+        """Atomically writes the entry and returns its key."""
+        key = self.key(endpoint, params)
+        path = self._path(key)
+        header = {"key": key, "request": normalize_request(endpoint, params), "created": time.time(),
+                  "size": len(payload), "sha256": hashlib.sha256(payload).hexdigest()}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(json.dumps(header, separators=(',', ':')).encode() + b'\n')
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        return key
+
+    def contains(self, endpoint: str, params: Optional[dict] = None, ttl: Optional[float] = None) -> bool:
+        return self.get(endpoint, params, ttl) is not None
+
+    def invalidate(self, endpoint: str, params: Optional[dict] = None) -> None:
+        self._discard(self._path(self.key(endpoint, params)))
+
+    def _discard(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get_stats(self) -> dict:
+        return {"hits": self._nr_hits, "misses": self._nr_misses}
@@ -0,0 +1,118 @@
+"""Selectable runtime profile: event loop implementation and JSON / msgpack codecs.
+
+    import runtime
+    runtime.install_profile(runtime.PROFILE_FAST)
+
+PROFILE_DEFAULT keeps the asyncio loop and the standard library / msgpack codecs. PROFILE_FAST
+installs uvloop, orjson and ormsgpack (decoding only) when they are importable and falls back to the default
+for each one that is missing. Callers always go through runtime.json_loads, runtime.json_dumps,
+runtime.msgpack_packb and runtime.msgpack_unpackb, so the profile can be switched at startup.
+"""
+import json
+import asyncio
+import logging
+import msgpack
+from typing import Callable, Dict, Tuple
+
+PROFILE_DEFAULT = "default"
+PROFILE_FAST = "fast"
+ALL_PROFILES = [PROFILE_DEFAULT, PROFILE_FAST]
+
+json_loads : Callable = json.loads
+json_dumps : Callable = json.dumps
+msgpack_packb : Callable = msgpack.packb
+msgpack_unpackb : Callable = msgpack.unpackb
+installed_profile : str = PROFILE_DEFAULT
+
+
+class _SdkMsgpack:
+    """Stands in for the msgpack module inside alpaca_trade_api.stream."""
+    Timestamp = msgpack.Timestamp
+
+    @staticmethod
+    def packb(obj, **kwargs):
+        return msgpack_packb(obj)
+
+    @staticmethod
+    def unpackb(data, **kwargs):
+        return msgpack_unpackb(data)
+
+
+class _SdkJson:
+    """Stands in for the json module inside alpaca_trade_api.stream."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return json_dumps(obj)
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return json_loads(data)
+
+
+def _json_default(obj):
+    """numpy scalars and arrays the encoders do not take natively, e.g. the float64 values of the params dicts under orjson."""
+    if hasattr(obj, "tolist") and hasattr(obj, "dtype"):
+        return obj.tolist()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def json_codecs(profile: str) -> Tuple[Callable, Callable]:
+    if profile == PROFILE_FAST:
+        try:
+            import orjson
+            option = orjson.OPT_SERIALIZE_NUMPY
+            return orjson.loads, lambda obj: orjson.dumps(obj, default=_json_default, option=option).decode()
+        except ImportError:
+            logging.info("orjson is not installed, using the json module")
+    return json.loads, json.JSONEncoder(default=_json_default).encode  # Built once, json.dumps builds an encoder per call for any non-default argument
+
+
+def msgpack_codecs(profile: str) -> Tuple[Callable, Callable]:
+    if profile == PROFILE_FAST:
+        try:
+            import ormsgpack
+
+            def _ext_hook(code: int, data: bytes):
+                if code == -1:
+                    return msgpack.Timestamp.from_bytes(data)  # Market data timestamps
+                return msgpack.ExtType(code, data)
+
+            # ormsgpack only packs extension codes 0..127, so frames carrying msgpack.Timestamp
+            # (extension -1) are still packed with msgpack; decoding is the hot path.
+            return msgpack.packb, lambda data: ormsgpack.unpackb(data, ext_hook=_ext_hook)
+        except ImportError:
+            logging.info("ormsgpack is not installed, using the msgpack module")
+    return msgpack.packb, msgpack.unpackb
+
+
+def event_loop_policy(profile: str) -> asyncio.AbstractEventLoopPolicy:
+    if profile == PROFILE_FAST:
+        try:
+            import uvloop
+            return uvloop.EventLoopPolicy()
+        except ImportError:
+            logging.info("uvloop is not installed, using the asyncio event loop")
+    return asyncio.DefaultEventLoopPolicy()
+
+
+def install_profile(profile: str = PROFILE_DEFAULT) -> Dict[str, str]:
+    """Install the codecs and the event loop policy of a profile. Call before the event loop is created."""
+    global json_loads, json_dumps, msgpack_packb, msgpack_unpackb, installed_profile
+    assert profile in ALL_PROFILES, f"profile must be one of {ALL_PROFILES}"
+    json_loads, json_dumps = json_codecs(profile)
+    msgpack_packb, msgpack_unpackb = msgpack_codecs(profile)
+    policy = event_loop_policy(profile)
+    asyncio.set_event_loop_policy(policy)
+
+    import alpaca_trade_api.stream as sdk_stream  # The SDK decodes every stream message with these modules
+    sdk_stream.msgpack = _SdkMsgpack if profile == PROFILE_FAST else msgpack
+    sdk_stream.json = _SdkJson if profile == PROFILE_FAST else json
+
+    installed_profile = profile
+    installed = {"profile": profile,
+                 "event loop": type(policy).__module__.split(".")[0],
+                 "json": getattr(json_loads, "__module__", None) or "json",
+                 "msgpack": "ormsgpack" if msgpack_unpackb is not msgpack.unpackb else ("msgpack" if msgpack.Packer.__module__ != "msgpack.fallback" else "msgpack (pure python)")}
+    logging.info(f"Runtime profile: {installed}")
+    return installed
@@ -0,0 +1,352 @@
+"""Multi-process deployment: one feed process, N worker processes.
+
+The feed process (the one calling sharded_trader) owns the single market data and trading stream
+connection through DataClient, publishes the latest quotes, mids and positions into a shared-memory
+table and runs the order gateway, so every order still goes out through one REST session. Each
+worker process runs a shard of the PairTrade instances against the shared table.
+"""
+import math
+import time
+import signal
+import asyncio
+import logging
+import datetime
+import threading
+import itertools
+import multiprocessing
+import numpy as np
+import runtime
+from multiprocessing import shared_memory
+from typing import Optional, List, Dict, Set
+from core import DataClient, OrderManager, MarketClockCalendar, InsertOrderResponse, CancelOrderResponse, make_risk_manager
+from PairTrade import PairTrade
+from hedge import make_hedge_estimator, HEDGE_STATIC
+from recorder import MarketDataRecorder
+from shutdown import ShutdownCoordinator
+from metrics import MetricsServer
+from keepalive import KeepAlive
+
+BID, ASK, MID, BID_SIZE, ASK_SIZE, TIMESTAMP, POSITION = range(7)
+NR_FIELDS = 7
+READ_SPINS = 100  # Retries of a row being written before the reader yields the CPU to the writer
+READ_RETRIES = 1000  # A writer that stays odd this long (tens of ms) has died mid-write
+
+
+class SharedMarketTable:
+    """Latest quote, mid price and position per symbol in shared memory.
+
+    One writer (the feed process), many readers. Every row is guarded by a sequence counter
+    (seqlock): the writer makes it odd while a row is being updated, readers retry until they
+    see the same even counter before and after copying the row. Readers give up after
+    READ_RETRIES and fall back to the last row they read, so a writer that died mid-write does
+    not hang the workers.
+    """
+
+    def __init__(self, symbols: List[str], name: Optional[str] = None):
+        self._symbols : List[str] = list(symbols)
+        self._symbol_index : Dict[str, int] = {symbol: idx for idx, symbol in enumerate(self._symbols)}
+        nr_symbols = len(self._symbols)
+        size = nr_symbols * 8 + nr_symbols * NR_FIELDS * 8
+        self._owner : bool = name is None
+        self._shm : shared_memory.SharedMemory = shared_memory.SharedMemory(name=name, create=self._owner, size=size)
+        self._seq : np.ndarray = np.ndarray((nr_symbols,), dtype=np.uint64, buffer=self._shm.buf, offset=0)
+        self._values : np.ndarray = np.ndarray((nr_symbols, NR_FIELDS), dtype=np.float64, buffer=self._shm.buf, offset=nr_symbols * 8)
+        self._last_rows : Dict[int, np.ndarray] = {}  # Last consistent row per symbol read by this process
+        self._stale : Set[int] = set()  # Rows already reported as stuck
+        if self._owner:
+            self._seq[:] = 0
+            self._values[:] = np.nan
+            self._values[:, POSITION] = 0.0
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def symbols(self) -> List[str]:
+        return self._symbols
+
+    def _write(self, symbol: str, fields: tuple, values: tuple) -> None:
+        idx = self._symbol_index.get(symbol, None)
+        if idx is None:
+            return
+        self._seq[idx] += 1
+        for field, value in zip(fields, values):
+            self._values[idx, field] = value
+        self._seq[idx] += 1
+
+    def publish_quote(self, symbol: str, bid: float, ask: float, mid: float, bid_size: float, ask_size: float, timestamp: float) -> None:
+        self._write(symbol, (BID, ASK, MID, BID_SIZE, ASK_SIZE, TIMESTAMP), (bid, ask, mid, bid_size, ask_size, timestamp))
+
+    def publish_position(self, symbol: str, position: float) -> None:
+        self._write(symbol, (POSITION,), (position,))
+
+    def read(self, symbol: str) -> Optional[np.ndarray]:
+        idx = self._symbol_index.get(symbol, None)
+        if idx is None:
+            return None
+        for attempt in range(READ_SPINS if idx in self._stale else READ_RETRIES):  # Rows known to be stuck only get a short spin
+            seq_before = int(self._seq[idx])
+            if seq_before % 2 == 0:
+                row = self._values[idx].copy()
+                if int(self._seq[idx]) == seq_before:
+                    self._last_rows[idx] = row
+                    self._stale.discard(idx)
+                    return row
+            if attempt >= READ_SPINS:
+                time.sleep(0)
+        if idx not in self._stale:
+            self._stale.add(idx)
+            logging.warning(f"Row of {symbol} stays locked in the shared table, the feed process may have died. Using the last row read")
+        return self._last_rows.get(idx, None)
+
+    def close(self) -> None:
+        self._seq = None
+        self._values = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class FeedDataClient(DataClient):
+    """DataClient of the feed process, mirrors every quote and position update into the shared table."""
+
+    def __init__(self, table: SharedMarketTable, **kwargs):
+        super().__init__(**kwargs)
+        self._table : SharedMarketTable = table
+
+    async def on_quote(self, quote) -> None:
+        await super().on_quote(quote)
+        symbol = quote.symbol
+        self._table.publish_quote(symbol, quote.bid_price, quote.ask_price, self._last_mid_price.get(symbol, math.nan),
+                                  quote.bid_size, quote.ask_size, quote._raw["timestamp"] / 1e9)
+
+    async def on_trade_update(self, trade_update) -> None:
+        await super().on_trade_update(trade_update)
+        symbol = trade_update.order["symbol"]
+        self._table.publish_position(symbol, self.get_position_by_symbol(symbol))
+
+    def publish_positions(self) -> None:
+        for symbol in self._table.symbols:
+            self._table.publish_position(symbol, self.get_position_by_symbol(symbol))
+
+
+class SharedMemoryDataClient:
+    """Read-only DataClient stand-in for worker processes. Implements what PairTrade uses."""
+
+    def __init__(self, table: SharedMarketTable):
+        self._table : SharedMarketTable = table
+
+    def get_last_mid_price(self, symbol: str) -> Optional[float]:
+        row = self._table.read(symbol)
+        if row is None or math.isnan(row[MID]):
+            return None
+        return float(row[MID])
+
+    def get_last_quote(self, symbol: str) -> Optional[dict]:
+        row = self._table.read(symbol)
+        if row is None or math.isnan(row[TIMESTAMP]):
+            return None
+        return {"symbol": symbol, "bid_price": row[BID], "ask_price": row[ASK], "bid_size": row[BID_SIZE], "ask_size": row[ASK_SIZE], "timestamp": row[TIMESTAMP]}
+
+    def get_position_by_symbol(self, symbol: str) -> float:
+        row = self._table.read(symbol)
+        return 0.0 if row is None else float(row[POSITION])
+
+
+class OrderGateway:
+    """Runs in the feed process. Executes order requests of all workers on the single OrderManager."""
+
+    def __init__(self, ordermanager: OrderManager, request_queue: multiprocessing.Queue, response_queues: List[multiprocessing.Queue]):
+        self._ordermanager : OrderManager = ordermanager
+        self._request_queue : multiprocessing.Queue = request_queue
+        self._response_queues : List[multiprocessing.Queue] = response_queues
+        self._loop : Optional[asyncio.AbstractEventLoop] = None
+        self._thread : Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.Thread(target=self._read_requests, name="order-gateway", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._request_queue.put(None)
+
+    def _read_requests(self) -> None:
+        while True:
+            request = self._request_queue.get()
+            if request is None:
+                return
+            future = asyncio.run_coroutine_threadsafe(self._handle(*request), self._loop)
+            future.add_done_callback(self._on_handled)
+
+    def _on_handled(self, future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logging.warning(f"Order gateway failed to reply: {future.exception()}")
+
+    async def _handle(self, worker_id: int, request_id: int, method: str, kwargs: dict) -> None:
+        """Always replies, a worker waits for the response of every request."""
+        try:
+            if method == "insert_order":
+                response = await self._ordermanager.insert_order(**kwargs)
+            elif method == "cancel_order":
+                response = await self._ordermanager.cancel_order(**kwargs)
+            else:
+                response = None
+                logging.warning(f"Order gateway received unknown request {method} from worker {worker_id}")
+        except Exception as e:
+            logging.warning(f"Order gateway request {method} {kwargs} of worker {worker_id} failed: {e!r}")
+            if method == "insert_order":
+                response = InsertOrderResponse(success=False, order_id=None, error=repr(e))
+            else:
+                response = CancelOrderResponse(success=False, error=repr(e))
+        self._response_queues[worker_id].put((request_id, response))
+
+
+class GatewayOrderManager:
+    """OrderManager stand-in for worker processes. Forwards requests to the OrderGateway of the feed process."""
+
+    def __init__(self, worker_id: int, request_queue: multiprocessing.Queue, response_queue: multiprocessing.Queue):
+        self._worker_id : int = worker_id
+        self._request_queue : multiprocessing.Queue = request_queue
+        self._response_queue : multiprocessing.Queue = response_queue
+        self._request_ids = itertools.count()
+        self._pending : Dict[int, asyncio.Future] = {}
+        self._loop : Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        threading.Thread(target=self._read_responses, name="order-gateway-responses", daemon=True).start()
+
+    def _read_responses(self) -> None:
+        while True:
+            request_id, response = self._response_queue.get()
+            try:
+                self._loop.call_soon_threadsafe(self._resolve, request_id, response)
+            except RuntimeError:  # Event loop closed, the worker is shutting down
+                return
+
+    def _resolve(self, request_id: int, response) -> None:
+        future = self._pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    async def _request(self, method: str, **kwargs):
+        request_id = next(self._request_ids)
+        future = self._loop.create_future()
+        self._pending[request_id] = future
+        self._request_queue.put((self._worker_id, request_id, method, kwargs))
+        return await future
+
+    async def insert_order(self, symbol: str, price: float, quantity: int, side: str, order_type: str) -> InsertOrderResponse:
+        return await self._request("insert_order", symbol=symbol, price=price, quantity=quantity, side=side, order_type=order_type)
+
+    async def cancel_order(self, order_id: str) -> CancelOrderResponse:
+        return await self._request("cancel_order", order_id=order_id)
+
+
+def shard_pairs(cointPairsparams: List[dict], nr_workers: int) -> List[List[dict]]:
+    return [cointPairsparams[i::nr_workers] for i in range(nr_workers)]
+
+
+def _worker_main(worker_id: int, table_name: str, symbols: List[str], pairs: List[dict], capital_per_pair: float, downsample: int, k: int,
+                 request_queue: multiprocessing.Queue, response_queue: multiprocessing.Queue, stop_event, log_filename: Optional[str],
+                 runtime_profile: str, hedge_mode: str) -> None:
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - %(levelname)s - worker {worker_id} - %(message)s')
+    if log_filename is not None:
+        file_handler = logging.FileHandler(log_filename)
+        file_handler.setFormatter(logging.Formatter(f'%(asctime)s - %(levelname)s - worker {worker_id} - %(message)s'))
+        logging.getLogger().addHandler(file_handler)
+    runtime.install_profile(runtime_profile)
+    table = SharedMarketTable(symbols, name=table_name)
+
+    async def run():
+        d = SharedMemoryDataClient(table)
+        o = GatewayOrderManager(worker_id, request_queue, response_queue)
+        await o.start()
+        hedge_estimator = make_hedge_estimator(pairs, hedge_mode)
+        tasks = [asyncio.create_task(PairTrade(dataclient=d, ordermanager=o, asset1=pair['asset 1'], asset2=pair['asset 2'], capital=capital_per_pair,
+                                               hedge_ratio=pair['hedge ratio'], const=pair['constant'], downsample=downsample, k=k,
+                                               hedge_estimator=hedge_estimator, hedge_index=i)._trader())
+                 for i, pair in enumerate(pairs)]
+        logging.info(f"Worker {worker_id} trading {len(tasks)} pairs")
+        while not stop_event.is_set():
+            await asyncio.sleep(0.5)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        asyncio.run(run())
+    finally:
+        table.close()
+        logging.info(f"Worker {worker_id} stopped")
+
+
+async def sharded_trader(cointPairsparams: List[dict], total_capital: float, downsample: int, k: int, nr_workers: int, log_filename: Optional[str] = None,
+                         runtime_profile: str = runtime.PROFILE_DEFAULT, hedge_mode: str = HEDGE_STATIC, record: bool = False, risk_limits: Optional[dict] = None,
+                         metrics_port: Optional[int] = None, keepalive_interval: Optional[float] = None, warm_connections: int = 2):
+    symbols = sorted({symbol for pair in cointPairsparams for symbol in (pair["asset 1"], pair["asset 2"])})
+    capital_per_pair = round(total_capital / len(cointPairsparams))
+    nr_workers = min(nr_workers, len(cointPairsparams))
+    context = multiprocessing.get_context("spawn")
+    table = SharedMarketTable(symbols)
+    request_queue = context.Queue()
+    response_queues = [context.Queue() for _ in range(nr_workers)]
+    stop_event = context.Event()
+
+    d = FeedDataClient(table=table, symbols=set(symbols), recorder=MarketDataRecorder() if record else None)
+    risk_manager = make_risk_manager(d, cointPairsparams, total_capital, risk_limits)  # Checks the orders of all workers in one place
+    o = OrderManager(risk_manager=risk_manager)
+    gateway = OrderGateway(o, request_queue, response_queues)
+    asyncio.create_task(d.start())
+    await o.start()
+    keepalive = KeepAlive(interval=keepalive_interval, warm_connections=warm_connections) if keepalive_interval is not None else None  # The orders of all workers share the pool of this process
+    if keepalive is not None:
+        await keepalive.warmup()
+        asyncio.create_task(keepalive.run())
+    await asyncio.sleep(2)
+    await o.cancel_all_orders()
+    await o.close_all_positions()
+    await asyncio.sleep(2)
+    d.publish_positions()
+    if risk_manager is not None:
+        risk_manager.start()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, risk_manager.kill, "SIGUSR1")
+    gateway.start()
+    metrics_server = MetricsServer(d, o, port=metrics_port) if metrics_port is not None else None  # Feed, orders and risk, the pair state lives in the workers
+    if metrics_server is not None:
+        await metrics_server.start()
+
+    workers = [context.Process(target=_worker_main, name=f"pairs-worker-{worker_id}",
+                               args=(worker_id, table.name, symbols, shard, capital_per_pair, downsample, k, request_queue, response_queues[worker_id], stop_event, log_filename, runtime_profile,
+                                     hedge_mode))
+               for worker_id, shard in enumerate(shard_pairs(cointPairsparams, nr_workers))]
+    for worker in workers:
+        worker.start()
+
+    marketclockcalendar = MarketClockCalendar()
+    time_left_before_close = await marketclockcalendar.time_left_before_next_close()
+    assert time_left_before_close is not None, "time_left_before_close is None"
+    timeout = (time_left_before_close - datetime.timedelta(seconds=300)).total_seconds()
+    logging.info(f"Start Trading with {nr_workers} worker processes")
+    deadline = asyncio.get_running_loop().time() + timeout
+    try:
+        while asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(1)
+            d.publish_positions()  # Positions can also change through REST refreshes, not only trade updates
+            if not any(worker.is_alive() for worker in workers):
+                logging.warning("All workers exited")
+                break
+    finally:
+        logging.info("Market closing in 5 mins. Stop workers, cancel open orders and close positions")
+        stop_event.set()
+        for worker in workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.join, 10)
+        gateway.stop()
+        await ShutdownCoordinator(dataclient=d, ordermanager=o).run()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        if keepalive is not None:
+            keepalive.close()
+        table.close()
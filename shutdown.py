@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from typing import Optional, List, Dict
+from core import DataClient, OrderManager
+from core import ORDER_TYPE_IOC, SIDE_BUY, SIDE_SELL, ORDER_CYLE_END_EVENT
+
+MAX_SLIPPAGE = 0.02  # Cap of the slippage beyond the touch, inside the 0.05 price band of the RiskManager around the mid
+
+
+class ShutdownCoordinator:
+    """Flattens the book before the close under a hard deadline.
+
+    1. cancels the pair loops, so no new orders are sent
+    2. per symbol and concurrently: cancels its open orders and sends marketable IOC limit orders until the
+       position is zero, each retry crossing the spread further
+    3. confirms every position through the trade updates of the DataClient, there is no REST polling
+    4. falls back to the bulk DELETE /v2/orders and /v2/positions when escalate_before seconds are left
+    """
+
+    def __init__(self,
+                 dataclient: DataClient,
+                 ordermanager: OrderManager,
+                 pair_tasks: Optional[List[asyncio.Task]] = None,
+                 deadline: float = 60,
+                 escalate_before: float = 20,
+                 retry_interval: float = 2,
+                 slippage: float = 0.001):
+        self._dataclient : DataClient = dataclient
+        self._ordermanager : OrderManager = ordermanager
+        self._pair_tasks : List[asyncio.Task] = pair_tasks if pair_tasks is not None else []
+        self._deadline : float = deadline
+        self._escalate_before : float = escalate_before
+        self._retry_interval : float = retry_interval
+        self._slippage : float = slippage  # Fraction of the price beyond the far touch, doubled on every retry up to MAX_SLIPPAGE
+        self._updated : Dict[str, asyncio.Event] = {}
+        self._any_update : asyncio.Event = asyncio.Event()
+        self._loop : Optional[asyncio.AbstractEventLoop] = None
+        self._end_time : Optional[float] = None
+
+    def _time_left(self) -> float:
+        return self._end_time - self._loop.time()
+
+    def _on_trade_update(self, trade_update) -> None:
+        event = self._updated.get(trade_update.order["symbol"], None)
+        if event is not None:
+            event.set()
+        self._any_update.set()
+
+    async def _wait_for_update(self, symbol: str, timeout: float) -> None:
+        event = self._updated[symbol]
+        try:
+            await asyncio.wait_for(event.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    async def _wait_for_order(self, symbol: str, order_id: str, timeout: float) -> bool:
+        """True once the order has a terminal trade update."""
+        end_time = self._loop.time() + timeout
+        while True:
+            trade_update = self._dataclient.get_trade_update(symbol, order_id)
+            if (trade_update is not None) and (trade_update.event in ORDER_CYLE_END_EVENT):
+                return True
+            if self._loop.time() >= end_time:
+                return False
+            await self._wait_for_update(symbol, end_time - self._loop.time())
+
+    async def _stop_pair_loops(self) -> None:
+        for task in self._pair_tasks:
+            task.cancel()
+        if len(self._pair_tasks) > 0:
+            await asyncio.wait(self._pair_tasks, timeout=min(2, self._time_left()))
+        logging.info(f"Stopped {len(self._pair_tasks)} pair loops")
+
+    def _marketable_price(self, symbol: str, side: str, attempt: int) -> Optional[float]:
+        quote = self._dataclient.get_last_quote(symbol)
+        mid_price = self._dataclient.get_last_mid_price(symbol)
+        if quote is not None and quote.ask_price > 0 and quote.bid_price > 0:
+            touch = quote.ask_price if side == SIDE_BUY else quote.bid_price
+        elif mid_price is not None:
+            touch = mid_price
+        else:
+            return None
+        slippage = min(self._slippage * 2 ** attempt, MAX_SLIPPAGE)
+        price = touch * (1 + slippage) if side == SIDE_BUY else touch * (1 - slippage)
+        return round(price, 2)
+
+    async def _flatten_symbol(self, symbol: str, open_order_ids: List[str]) -> bool:
+        results = await asyncio.gather(*[self._ordermanager.cancel_order(order_id) for order_id in open_order_ids])
+        if not all(result.success for result in results):
+            await self._wait_for_update(symbol, min(self._retry_interval, self._time_left() - self._escalate_before))
+        attempt = 0
+        while self._time_left() > self._escalate_before:
+            position = self._dataclient.get_position_by_symbol(symbol)
+            if position == 0:
+                return True
+            side = SIDE_SELL if position > 0 else SIDE_BUY
+            price = self._marketable_price(symbol, side, attempt)
+            if price is None:
+                logging.warning(f"No quote for {symbol}, leave it to the bulk close")
+                return False
+            logging.info(f"Flatten {symbol}: {side} {abs(position)} at {price}, attempt {attempt + 1}")
+            response = await self._ordermanager.insert_order(symbol=symbol, price=price, quantity=abs(position), side=side, order_type=ORDER_TYPE_IOC)
+            if response.success:
+                timeout = min(self._retry_interval, self._time_left() - self._escalate_before)
+                if not await self._wait_for_order(symbol, response.order_id, timeout):  # Never send a second order while one may still fill
+                    await self._ordermanager.cancel_order(response.order_id)
+                    await self._wait_for_order(symbol, response.order_id, timeout)
+            else:  # Rejected, e.g. by the risk manager, which answers without yielding to the event loop
+                await self._wait_for_update(symbol, min(self._retry_interval, self._time_left() - self._escalate_before))
+            attempt += 1
+        return self._dataclient.get_position_by_symbol(symbol) == 0
+
+    def _open_positions(self) -> Dict[str, float]:
+        return {symbol: position["position"] for symbol, position in self._dataclient.get_all_positions().items() if position.get("position", 0) != 0}
+
+    async def run(self) -> bool:
+        """Returns True if every position is confirmed flat before the deadline."""
+        self._loop = asyncio.get_running_loop()
+        self._end_time = self._loop.time() + self._deadline
+        self._dataclient.add_trade_update_listener(self._on_trade_update)
+        try:
+            await self._stop_pair_loops()
+            open_orders = await self._ordermanager.get_orders(status="open")
+            if open_orders is None:
+                open_orders = []
+            order_ids_by_symbol : Dict[str, List[str]] = {}
+            for order in open_orders:
+                order_ids_by_symbol.setdefault(order["symbol"], []).append(order["id"])
+            symbols = set(order_ids_by_symbol) | set(self._open_positions())
+            self._updated = {symbol: asyncio.Event() for symbol in symbols}
+            logging.info(f"Flatten {len(symbols)} symbols with {len(open_orders)} open orders, {self._deadline} seconds deadline")
+
+            await asyncio.gather(*[self._flatten_symbol(symbol, order_ids_by_symbol.get(symbol, [])) for symbol in symbols])
+
+            remaining = self._open_positions()
+            if len(remaining) > 0:
+                logging.warning(f"Positions left {remaining} with {self._time_left():.1f} seconds to the deadline. Escalate to bulk cancel and close")
+                await self._ordermanager.cancel_all_orders()
+                await self._ordermanager.close_all_positions()
+                while len(self._open_positions()) > 0 and self._time_left() > 0:
+                    self._any_update.clear()
+                    try:
+                        await asyncio.wait_for(self._any_update.wait(), timeout=self._time_left())
+                    except asyncio.TimeoutError:
+                        pass
+            remaining = self._open_positions()
+            if len(remaining) > 0:
+                logging.error(f"Deadline reached with open positions {remaining}")
+                return False
+            logging.info(f"All positions confirmed flat with {self._time_left():.1f} seconds to spare")
+            return True
+        finally:
+            self._dataclient.remove_trade_update_listener(self._on_trade_update)
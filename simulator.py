@@ -0,0 +1,566 @@
+"""Local stand-in for the Alpaca paper trading REST API, the trading stream and the market data stream.
+
+Replays recorded quote files (or synthetic quotes) at a configurable speed multiple and fills limit
+orders against the replayed book, so DataClient, OrderManager and PairTrade can run offline.
+
+    python simulator.py --date 20241010 --symbols NVDA AMD INTC TSM --speed 10
+    python simulator.py --synthetic-symbols 300 --quotes-per-second 5000
+
+Point the trader at it with Endpoints.configure(trading_url="http://127.0.0.1:8765", data_stream_url="http://127.0.0.1:8765").
+Any key id and secret are accepted.
+"""
+import os
+import time
+import runtime
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import datetime
+import msgpack
+import numpy as np
+import pandas as pd
+from aiohttp import web, WSMsgType
+from collections import defaultdict
+from typing import Optional, List, Callable, Iterator, Tuple
+from recorder import tape_filename, read_tape
+from core import SIDE_BUY, SIDE_SELL, ORDER_TYPE_IOC, ORDER_TYPE_DAY, ORDER_TYPE_GTC, FILL, CANCELED, TimeSource
+
+logging.basicConfig(level=logging.INFO , format='%(asctime)s - %(levelname)s - %(message)s')
+
+NEW = "new"
+QUOTE_COLUMNS = ["timestamp", "bid_price", "bid_size", "ask_price", "ask_size"]
+
+
+def _isoformat(timestamp_ns: int) -> str:
+    return datetime.datetime.fromtimestamp(timestamp_ns / 1e9, tz=datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def market_clock(now: datetime.datetime, session_open: datetime.datetime, session_close: datetime.datetime) -> dict:
+    """GET /v2/clock of a single session. All times are naive UTC."""
+    is_open = session_open <= now < session_close
+    next_open = session_open if now < session_open else (now if is_open else session_open + datetime.timedelta(days=1))
+    fmt = '%Y-%m-%dT%H:%M:%S'
+    return {"timestamp": now.strftime(fmt) + "Z", "is_open": is_open, "next_open": next_open.strftime(fmt) + "Z", "next_close": session_close.strftime(fmt) + "Z"}
+
+
+def market_calendar(start: str, end: str) -> List[dict]:
+    """GET /v2/calendar, every weekday between start and end (YYYY-MM-DD...) is a trading day."""
+    start = datetime.datetime.strptime(start[:10], '%Y-%m-%d').date()
+    end = datetime.datetime.strptime(end[:10], '%Y-%m-%d').date()
+    days = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+    return [{"date": day.strftime('%Y-%m-%d'), "open": "09:30", "close": "16:00", "session_open": "0400", "session_close": "2000",
+             "settlement_date": (day + datetime.timedelta(days=1)).strftime('%Y-%m-%d')} for day in days if day.weekday() < 5]
+
+
+class QuoteReplay:
+    """Merge the recorded quote files (csv, or the tape of recorder.py) of several symbols into one time-ordered array."""
+
+    def __init__(self, symbols: List[str], date: str, data_folder: str = "data"):
+        self._symbols : List[str] = symbols
+        self._date : str = date
+        self._data_folder : str = data_folder
+
+    def load(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        timestamps, symbol_idx, quotes = [], [], []
+        for idx, symbol in enumerate(self._symbols):
+            csv_name = f"{self._data_folder}/{symbol}_{self._date}_quote.csv"
+            tape_name = tape_filename(self._data_folder, symbol, self._date)
+            if not os.path.exists(csv_name) and os.path.exists(tape_name):  # Recorded live by DataClient
+                records = read_tape(tape_name)
+                timestamps.append(records["timestamp"])
+                quotes.append(np.stack([records[column] for column in QUOTE_COLUMNS[1:]], axis=1))
+            else:
+                quote_data = pd.read_csv(csv_name, usecols=QUOTE_COLUMNS)
+                timestamps.append(pd.to_datetime(quote_data["timestamp"], format='mixed').astype('int64').to_numpy())
+                quotes.append(quote_data[["bid_price", "bid_size", "ask_price", "ask_size"]].to_numpy(dtype=np.float64))
+            symbol_idx.append(np.full(len(timestamps[-1]), idx, dtype=np.int32))
+            logging.info(f"Loaded {len(timestamps[-1])} quotes for {symbol} on {self._date}")
+        timestamps = np.concatenate(timestamps)
+        order = np.argsort(timestamps, kind="stable")
+        return timestamps[order], np.concatenate(symbol_idx)[order], np.concatenate(quotes)[order]
+
+    def __iter__(self) -> Iterator[Tuple[int, str, float, float, float, float]]:
+        timestamps, symbol_idx, quotes = self.load()
+        for ts, idx, (bid, bid_size, ask, ask_size) in zip(timestamps.tolist(), symbol_idx.tolist(), quotes.tolist()):
+            yield ts, self._symbols[idx], bid, bid_size, ask, ask_size
+
+
+class SyntheticQuotes:
+    """Random-walk quotes for load testing, generated in vectorized chunks."""
+
+    def __init__(self, nr_symbols: int, quotes_per_second: float, seed: int = 0, chunk_size: int = 10000, symbols: Optional[List[str]] = None):
+        self._symbols : List[str] = list(symbols) if symbols is not None else [f"SYM{i:04d}" for i in range(nr_symbols)]
+        self._quotes_per_second : float = quotes_per_second
+        self._rng : np.random.Generator = np.random.default_rng(seed)
+        self._chunk_size : int = chunk_size
+
+    @property
+    def symbols(self) -> List[str]:
+        return self._symbols
+
+    def __iter__(self) -> Iterator[Tuple[int, str, float, float, float, float]]:
+        nr_symbols = len(self._symbols)
+        mids = self._rng.uniform(20, 500, nr_symbols)
+        timestamp = TimeSource.time_ns()
+        step = int(1e9 / self._quotes_per_second)
+        while True:
+            symbol_idx = self._rng.integers(0, nr_symbols, self._chunk_size).tolist()
+            returns = self._rng.normal(0, 2e-4, self._chunk_size).tolist()
+            half_spreads = (self._rng.integers(1, 4, self._chunk_size) * 0.01).tolist()
+            sizes = (self._rng.integers(1, 10, (self._chunk_size, 2)) * 100.0).tolist()
+            for i in range(self._chunk_size):
+                idx = symbol_idx[i]
+                mids[idx] *= 1 + returns[i]
+                mid = round(float(mids[idx]), 2)
+                timestamp += step
+                yield timestamp, self._symbols[idx], round(mid - half_spreads[i], 2), sizes[i][0], round(mid + half_spreads[i], 2), sizes[i][1]
+
+
+class MatchingEngine:
+    """Orders, positions and fills of a single simulated account. Independent of the transport.
+
+    Timestamps come from core.TimeSource, so the engine follows the virtual clock of a replay. With a seed the
+    order ids are drawn from a seeded generator and a replay writes the same ids on every run.
+    """
+
+    def __init__(self, seed: Optional[int] = None):
+        self._rng : Optional[random.Random] = random.Random(seed) if seed is not None else None
+        self._orders : dict = {}
+        self._open_orders_by_symbol : defaultdict = defaultdict(dict)
+        self._positions : dict = {}
+        self._last_quote : dict = {}
+        self._trade_update_listeners : List[Callable] = []
+        self._trade_listeners : List[Callable] = []
+        self.nr_orders : int = 0
+        self.nr_fills : int = 0
+
+    def add_trade_update_listener(self, listener: Callable) -> None:
+        self._trade_update_listeners.append(listener)
+
+    def add_trade_listener(self, listener: Callable) -> None:
+        self._trade_listeners.append(listener)
+
+    def _emit(self, event: str, order: dict, price: Optional[float] = None, qty: Optional[float] = None) -> None:
+        position = self._positions.get(order["symbol"], {"qty": 0.0})["qty"]
+        trade_update = {"event": event, "order": dict(order), "timestamp": _isoformat(TimeSource.time_ns()), "position_qty": str(position)}
+        if price is not None:
+            trade_update["price"] = str(price)
+            trade_update["qty"] = str(qty)
+        for listener in self._trade_update_listeners:
+            listener(trade_update)
+
+    def _new_id(self) -> str:
+        if self._rng is None:
+            return str(uuid.uuid4())
+        return str(uuid.UUID(int=self._rng.getrandbits(128), version=4))
+
+    def _new_order(self, symbol: str, qty: float, side: str, order_type: str, time_in_force: str, limit_price: Optional[float]) -> dict:
+        now = _isoformat(TimeSource.time_ns())
+        return {"id": self._new_id(), "client_order_id": self._new_id(), "created_at": now, "updated_at": now, "submitted_at": now,
+                "filled_at": None, "canceled_at": None, "symbol": symbol, "asset_class": "us_equity", "qty": str(qty), "filled_qty": "0",
+                "filled_avg_price": None, "order_type": order_type, "type": order_type, "side": side, "time_in_force": time_in_force,
+                "limit_price": None if limit_price is None else str(limit_price), "status": "new"}
+
+    def _fill(self, order: dict, price: float) -> None:
+        symbol = order["symbol"]
+        qty = float(order["qty"]) - float(order["filled_qty"])
+        signed_qty = qty if order["side"] == SIDE_BUY else -qty
+        position = self._positions.setdefault(symbol, {"qty": 0.0, "avg_entry_price": 0.0})
+        new_qty = position["qty"] + signed_qty
+        if new_qty == 0:
+            position["avg_entry_price"] = 0.0
+        elif position["qty"] == 0 or (position["qty"] > 0) != (new_qty > 0):
+            position["avg_entry_price"] = price
+        elif abs(new_qty) > abs(position["qty"]):
+            position["avg_entry_price"] = (position["avg_entry_price"] * abs(position["qty"]) + price * qty) / abs(new_qty)
+        position["qty"] = new_qty
+        if new_qty == 0:
+            del self._positions[symbol]
+        order.update({"status": "filled", "filled_qty": order["qty"], "filled_avg_price": str(price),
+                      "filled_at": _isoformat(TimeSource.time_ns())})
+        self._open_orders_by_symbol[symbol].pop(order["id"], None)
+        self.nr_fills += 1
+        self._emit(FILL, order, price=price, qty=qty)
+        for listener in self._trade_listeners:
+            listener(symbol, price, qty)
+
+    def _marketable_price(self, order: dict) -> Optional[float]:
+        quote = self._last_quote.get(order["symbol"], None)
+        if quote is None:
+            return None
+        bid, ask = quote
+        limit_price = None if order["limit_price"] is None else float(order["limit_price"])
+        if order["side"] == SIDE_BUY and ask > 0 and (limit_price is None or limit_price >= ask):
+            return ask
+        if order["side"] == SIDE_SELL and bid > 0 and (limit_price is None or limit_price <= bid):
+            return bid
+        return None
+
+    def _cancel(self, order: dict) -> None:
+        order.update({"status": CANCELED, "canceled_at": _isoformat(TimeSource.time_ns())})
+        self._open_orders_by_symbol[order["symbol"]].pop(order["id"], None)
+        self._emit(CANCELED, order)
+
+    def on_quote(self, symbol: str, bid: float, ask: float) -> None:
+        self._last_quote[symbol] = (bid, ask)
+        open_orders = self._open_orders_by_symbol.get(symbol, None)
+        if open_orders:
+            for order in list(open_orders.values()):
+                price = self._marketable_price(order)
+                if price is not None:
+                    self._fill(order, price)
+
+    def submit_order(self, symbol: str, qty: float, side: str, order_type: str, time_in_force: str, limit_price: Optional[float]) -> Tuple[int, dict]:
+        if side not in (SIDE_BUY, SIDE_SELL) or qty <= 0 or time_in_force not in (ORDER_TYPE_DAY, ORDER_TYPE_GTC, ORDER_TYPE_IOC):
+            return 422, {"code": 42210000, "message": f"invalid order: side={side}, qty={qty}, time_in_force={time_in_force}"}
+        if order_type == "limit" and (limit_price is None or limit_price <= 0):
+            return 422, {"code": 42210000, "message": "limit_price must be positive"}
+        if order_type == "market" and symbol not in self._last_quote:
+            return 422, {"code": 42210000, "message": f"no quote for {symbol}"}
+        order = self._new_order(symbol, qty, side, order_type, time_in_force, limit_price)
+        self._orders[order["id"]] = order
+        self._open_orders_by_symbol[symbol][order["id"]] = order
+        self.nr_orders += 1
+        self._emit(NEW, order)
+        response = dict(order)
+        price = self._marketable_price(order)
+        if price is not None:
+            self._fill(order, price)
+        elif time_in_force == ORDER_TYPE_IOC:
+            self._cancel(order)
+        return 200, response
+
+    def cancel_order(self, order_id: str) -> Tuple[int, Optional[dict]]:
+        order = self._orders.get(order_id, None)
+        if order is None:
+            return 404, {"code": 40410000, "message": "order not found"}
+        if order["id"] not in self._open_orders_by_symbol[order["symbol"]]:
+            return 422, {"code": 42210000, "message": f"order is already in \"{order['status']}\" state"}
+        self._cancel(order)
+        return 204, None
+
+    def cancel_all_orders(self) -> List[dict]:
+        responses = []
+        for open_orders in self._open_orders_by_symbol.values():
+            for order in list(open_orders.values()):
+                self._cancel(order)
+                responses.append({"id": order["id"], "status": 200, "body": dict(order)})
+        return responses
+
+    def get_orders(self, status: str = "open", symbols: Optional[List[str]] = None) -> List[dict]:
+        orders = [order for open_orders in self._open_orders_by_symbol.values() for order in open_orders.values()] if status == "open" else list(self._orders.values())
+        if status == "closed":
+            orders = [order for order in orders if order["status"] in ("filled", CANCELED)]
+        if symbols:
+            orders = [order for order in orders if order["symbol"] in symbols]
+        return [dict(order) for order in orders]
+
+    def get_order(self, order_id: str) -> Optional[dict]:
+        order = self._orders.get(order_id, None)
+        return None if order is None else dict(order)
+
+    def _position_json(self, symbol: str) -> dict:
+        position = self._positions[symbol]
+        bid, ask = self._last_quote.get(symbol, (0.0, 0.0))
+        current_price = (bid + ask) * 0.5
+        return {"symbol": symbol, "asset_class": "us_equity", "qty": str(position["qty"]), "qty_available": str(position["qty"]),
+                "side": "long" if position["qty"] > 0 else "short", "avg_entry_price": str(position["avg_entry_price"]),
+                "current_price": str(current_price), "market_value": str(position["qty"] * current_price),
+                "unrealized_pl": str((current_price - position["avg_entry_price"]) * position["qty"])}
+
+    def get_positions(self) -> List[dict]:
+        return [self._position_json(symbol) for symbol in self._positions]
+
+    def get_position(self, symbol: str) -> Optional[dict]:
+        return self._position_json(symbol) if symbol in self._positions else None
+
+    def close_position(self, symbol: str, qty: Optional[float] = None, percentage: Optional[float] = None) -> Tuple[int, dict]:
+        if symbol not in self._positions:
+            return 404, {"code": 40410000, "message": "position does not exist"}
+        position = self._positions[symbol]["qty"]
+        close_qty = abs(position)
+        if qty is not None:
+            close_qty = min(qty, close_qty)
+        elif percentage is not None:
+            close_qty = close_qty * percentage / 100
+        side = SIDE_SELL if position > 0 else SIDE_BUY
+        return self.submit_order(symbol, close_qty, side, "market", ORDER_TYPE_DAY, None)
+
+    def close_all_positions(self, cancel_orders: bool = False) -> List[dict]:
+        if cancel_orders:
+            self.cancel_all_orders()
+        responses = []
+        for symbol in list(self._positions):
+            status, body = self.close_position(symbol)
+            responses.append({"symbol": symbol, "status": status, "body": body})
+        return responses
+
+
+class SimulatorServer:
+
+    def __init__(self,
+                 quotes: Iterator,
+                 speed: float = 1.0,
+                 session_seconds: float = 23400,
+                 bar_seconds: int = 60,
+                 max_batch: int = 1000,
+                 latency: float = 0.0):
+        self._quotes : Iterator = quotes
+        self._speed : float = speed
+        self._session_seconds : float = session_seconds
+        self._bar_seconds : int = bar_seconds
+        self._max_batch : int = max_batch
+        self._latency : float = latency
+        self._engine : MatchingEngine = MatchingEngine()
+        self._engine.add_trade_update_listener(self._publish_trade_update)
+        self._engine.add_trade_listener(self._publish_trade)
+        self._data_subscribers : dict = {}
+        self._trading_subscribers : set = set()
+        self._bars : dict = {}
+        self._pending : defaultdict = defaultdict(list)
+        self._start_time : float = time.time()
+        self._replay_task : Optional[asyncio.Task] = None
+        self._nr_quotes : int = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._latency_middleware])
+        app.router.add_get("/v2/clock", self.get_clock)
+        app.router.add_get("/v2/calendar", self.get_calendar)
+        app.router.add_post("/v2/orders", self.post_order)
+        app.router.add_get("/v2/orders", self.get_orders)
+        app.router.add_delete("/v2/orders", self.delete_orders)
+        app.router.add_get("/v2/orders/{order_id}", self.get_order)
+        app.router.add_delete("/v2/orders/{order_id}", self.delete_order)
+        app.router.add_get("/v2/positions", self.get_positions)
+        app.router.add_delete("/v2/positions", self.delete_positions)
+        app.router.add_get("/v2/positions/{symbol}", self.get_position)
+        app.router.add_delete("/v2/positions/{symbol}", self.delete_position)
+        app.router.add_get("/stream/", self.trading_stream)
+        app.router.add_get("/stream", self.trading_stream)
+        app.router.add_get("/v2/{feed}", self.data_stream)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    @web.middleware
+    async def _latency_middleware(self, request: web.Request, handler):
+        if self._latency > 0 and not request.path.startswith(("/stream", "/v2/iex", "/v2/sip")):
+            await asyncio.sleep(self._latency)
+        return await handler(request)
+
+    async def _on_cleanup(self, app: web.Application) -> None:
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+
+    # REST
+
+    async def get_clock(self, request: web.Request) -> web.Response:
+        session_open = datetime.datetime.utcfromtimestamp(self._start_time)
+        return web.json_response(market_clock(datetime.datetime.utcnow(), session_open, session_open + datetime.timedelta(seconds=self._session_seconds)))
+
+    async def get_calendar(self, request: web.Request) -> web.Response:
+        return web.json_response(market_calendar(request.query["start"], request.query["end"]))
+
+    async def post_order(self, request: web.Request) -> web.Response:
+        params = await request.json()
+        limit_price = params.get("limit_price", None)
+        status, body = self._engine.submit_order(symbol=params["symbol"], qty=float(params["qty"]), side=params["side"], order_type=params.get("type", "limit"),
+                                                 time_in_force=params["time_in_force"], limit_price=None if limit_price is None else float(limit_price))
+        return web.json_response(body, status=status)
+
+    async def get_orders(self, request: web.Request) -> web.Response:
+        symbols = request.query.get("symbols", None)
+        return web.json_response(self._engine.get_orders(status=request.query.get("status", "open"), symbols=symbols.split(",") if symbols else None))
+
+    async def delete_orders(self, request: web.Request) -> web.Response:
+        return web.json_response(self._engine.cancel_all_orders(), status=207)
+
+    async def get_order(self, request: web.Request) -> web.Response:
+        order = self._engine.get_order(request.match_info["order_id"])
+        if order is None:
+            return web.json_response({"code": 40410000, "message": "order not found"}, status=404)
+        return web.json_response(order)
+
+    async def delete_order(self, request: web.Request) -> web.Response:
+        status, body = self._engine.cancel_order(request.match_info["order_id"])
+        if body is None:
+            return web.Response(status=status)
+        return web.json_response(body, status=status)
+
+    async def get_positions(self, request: web.Request) -> web.Response:
+        return web.json_response(self._engine.get_positions())
+
+    async def get_position(self, request: web.Request) -> web.Response:
+        position = self._engine.get_position(request.match_info["symbol"])
+        if position is None:
+            return web.json_response({"code": 40410000, "message": "position does not exist"}, status=404)
+        return web.json_response(position)
+
+    async def delete_positions(self, request: web.Request) -> web.Response:
+        cancel_orders = request.query.get("cancel_orders", "false").lower() == "true"
+        if request.can_read_body:
+            cancel_orders = bool((await request.json()).get("cancel_orders", cancel_orders))
+        return web.json_response(self._engine.close_all_positions(cancel_orders=cancel_orders), status=207)
+
+    async def delete_position(self, request: web.Request) -> web.Response:
+        qty = request.query.get("qty", None)
+        percentage = request.query.get("percentage", None)
+        status, body = self._engine.close_position(request.match_info["symbol"], qty=None if qty is None else float(qty),
+                                                   percentage=None if percentage is None else float(percentage))
+        return web.json_response(body, status=status)
+
+    # Trading stream (json)
+
+    def _publish_trade_update(self, trade_update: dict) -> None:
+        message = runtime.json_dumps({"stream": "trade_updates", "data": trade_update})
+        for ws in list(self._trading_subscribers):
+            asyncio.ensure_future(ws.send_str(message))
+
+    async def trading_stream(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            if msg.type not in (WSMsgType.TEXT, WSMsgType.BINARY):
+                break
+            message = runtime.json_loads(msg.data)
+            if message.get("action") == "authenticate":
+                await ws.send_str(runtime.json_dumps({"stream": "authorization", "data": {"status": "authorized", "action": "authenticate"}}))
+            elif message.get("action") == "listen":
+                streams = message.get("data", {}).get("streams", [])
+                if "trade_updates" in streams:
+                    self._trading_subscribers.add(ws)
+                await ws.send_str(runtime.json_dumps({"stream": "listening", "data": {"streams": streams}}))
+        self._trading_subscribers.discard(ws)
+        return ws
+
+    # Market data stream (msgpack)
+
+    def _publish_trade(self, symbol: str, price: float, qty: float) -> None:
+        timestamp = time.time_ns()
+        self._queue("trades", symbol, {"T": "t", "S": symbol, "i": self._engine.nr_fills, "x": "V", "p": price, "s": qty,
+                                       "t": msgpack.Timestamp.from_unix_nano(timestamp), "c": ["@"], "z": "C"})
+
+    def _queue(self, channel: str, symbol: str, message: dict) -> None:
+        for ws, subscriptions in self._data_subscribers.items():
+            symbols = subscriptions[channel]
+            if symbol in symbols or "*" in symbols:
+                self._pending[ws].append(message)
+
+    async def _flush(self) -> None:
+        for ws, messages in list(self._pending.items()):
+            if ws.closed:
+                continue
+            try:
+                for i in range(0, len(messages), self._max_batch):
+                    await ws.send_bytes(runtime.msgpack_packb(messages[i:i + self._max_batch]))
+            except ConnectionResetError:
+                logging.info("Data stream client disconnected")
+        self._pending.clear()
+
+    def _update_bar(self, timestamp: int, symbol: str, mid: float) -> None:
+        bucket = timestamp // (self._bar_seconds * 1_000_000_000)
+        bar = self._bars.get(symbol, None)
+        if bar is not None and bar["bucket"] != bucket:
+            self._queue("bars", symbol, {"T": "b", "S": symbol, "o": bar["o"], "h": bar["h"], "l": bar["l"], "c": bar["c"], "v": 0, "n": 0, "vw": bar["c"],
+                                         "t": msgpack.Timestamp.from_unix_nano(bar["bucket"] * self._bar_seconds * 1_000_000_000)})
+            bar = None
+        if bar is None:
+            self._bars[symbol] = {"bucket": bucket, "o": mid, "h": mid, "l": mid, "c": mid}
+        else:
+            bar["h"] = max(bar["h"], mid)
+            bar["l"] = min(bar["l"], mid)
+            bar["c"] = mid
+
+    async def _replay(self) -> None:
+        wall_start = time.perf_counter()
+        data_start = None
+        last_report = wall_start
+        nr_quotes_at_last_report = 0
+        for timestamp, symbol, bid, bid_size, ask, ask_size in self._quotes:
+            if data_start is None:
+                data_start = timestamp
+            if self._speed > 0:
+                delay = (timestamp - data_start) / 1e9 / self._speed - (time.perf_counter() - wall_start)
+                if delay > 0:
+                    await self._flush()
+                    await asyncio.sleep(delay)
+            elif self._nr_quotes % self._max_batch == 0:
+                await self._flush()
+                await asyncio.sleep(0)
+            self._nr_quotes += 1
+            self._engine.on_quote(symbol, bid, ask)
+            self._queue("quotes", symbol, {"T": "q", "S": symbol, "bx": "V", "bp": bid, "bs": bid_size, "ax": "V", "ap": ask, "as": ask_size,
+                                           "t": msgpack.Timestamp.from_unix_nano(timestamp), "c": ["R"], "z": "C"})
+            if bid > 0 and ask > 0:
+                self._update_bar(timestamp, symbol, (bid + ask) * 0.5)
+            now = time.perf_counter()
+            if now - last_report >= 10:
+                logging.info(f"Replayed {self._nr_quotes} quotes ({(self._nr_quotes - nr_quotes_at_last_report) / (now - last_report):.0f}/s), "
+                             f"{self._engine.nr_orders} orders, {self._engine.nr_fills} fills")
+                last_report, nr_quotes_at_last_report = now, self._nr_quotes
+        await self._flush()
+        logging.info(f"Replay finished after {self._nr_quotes} quotes")
+
+    def _on_replay_done(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Replay failed: {task.exception()!r}")
+
+    async def data_stream(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_bytes(runtime.msgpack_packb([{"T": "success", "msg": "connected"}]))
+        async for msg in ws:
+            if msg.type != WSMsgType.BINARY:
+                break
+            message = runtime.msgpack_unpackb(msg.data)
+            action = message.get("action")
+            if action == "auth":
+                await ws.send_bytes(runtime.msgpack_packb([{"T": "success", "msg": "authenticated"}]))
+                continue
+            subscriptions = self._data_subscribers.setdefault(ws, {"trades": set(), "quotes": set(), "bars": set()})
+            for channel in subscriptions:
+                if action == "subscribe":
+                    subscriptions[channel].update(message.get(channel, []))
+                elif action == "unsubscribe":
+                    subscriptions[channel].difference_update(message.get(channel, []))
+            await ws.send_bytes(runtime.msgpack_packb([{"T": "subscription", **{channel: sorted(symbols) for channel, symbols in subscriptions.items()}}]))
+            if self._replay_task is None:
+                self._replay_task = asyncio.create_task(self._replay())
+                self._replay_task.add_done_callback(self._on_replay_done)
+        self._data_subscribers.pop(ws, None)
+        self._pending.pop(ws, None)
+        return ws
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Alpaca paper trading and market data simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--date", help="Day of the recorded quote files, YYYYMMDD")
+    parser.add_argument("--symbols", nargs="+", default=[])
+    parser.add_argument("--data-folder", default="data")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiple, 0 replays as fast as possible")
+    parser.add_argument("--synthetic-symbols", type=int, default=0, help="Generate random-walk quotes for this many symbols instead of replaying files")
+    parser.add_argument("--quotes-per-second", type=float, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--session-minutes", type=float, default=None, help="Time until the simulated market close. Defaults to 6.5 hours divided by the speed")
+    parser.add_argument("--max-batch", type=int, default=1000, help="Maximum number of messages per websocket frame")
+    parser.add_argument("--profile", default=runtime.PROFILE_DEFAULT, choices=runtime.ALL_PROFILES, help="Runtime profile for the event loop and codecs")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Artificial latency added to every REST request")
+    args = parser.parse_args()
+    runtime.install_profile(args.profile)
+
+    if args.synthetic_symbols > 0:
+        quotes = SyntheticQuotes(nr_symbols=args.synthetic_symbols, quotes_per_second=args.quotes_per_second, seed=args.seed)
+        logging.info(f"Synthetic quotes for {args.synthetic_symbols} symbols at {args.quotes_per_second} quotes per second")
+    else:
+        assert args.date and args.symbols, "--date and --symbols are required to replay recorded quotes"
+        quotes = QuoteReplay(symbols=args.symbols, date=args.date, data_folder=args.data_folder)
+    session_seconds = args.session_minutes * 60 if args.session_minutes is not None else 23400 / max(args.speed, 1)
+    server = SimulatorServer(quotes=quotes, speed=args.speed, session_seconds=session_seconds, max_batch=args.max_batch, latency=args.latency_ms / 1000)
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""Archive lookups of the OrderEventStore.
+
+    python -m pytest -q test_order_events.py
+"""
+import asyncio
+import pytest
+from alpaca_trade_api.entity import Entity
+from order_events import OrderEventStore
+
+NR_EVENTS = 2000
+
+
+def trade_update(id: str) -> Entity:
+    return Entity({"event": "fill", "order": {"id": id, "symbol": "AAA", "side": "buy", "qty": "1", "filled_qty": "1"}})
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = OrderEventStore(terminal_events=["fill"], archive_folder=str(tmp_path), max_completed=0)  # Every completed order is evicted at once
+    yield store
+    store.close()
+
+
+def test_get_archived_right_after_archiving(store):
+    for i in range(NR_EVENTS):
+        store.add(trade_update(f"order-{i}"))
+    assert store.get(f"order-{NR_EVENTS - 1}") is None  # Not in memory, the archive is only searched on request
+    trade_update_found = asyncio.run(store.get_archived(f"order-{NR_EVENTS - 1}"))
+    assert trade_update_found is not None
+    assert trade_update_found.order["id"] == f"order-{NR_EVENTS - 1}"
+    assert asyncio.run(store.get_archived("unknown")) is None
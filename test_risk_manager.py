@@ -0,0 +1,60 @@
+"""Exposure accounting of the RiskManager across the life of an order.
+
+    python -m pytest -q test_risk_manager.py
+"""
+import asyncio
+import pytest
+from alpaca_trade_api.entity import Entity
+from core import DataClient, RiskManager, SIDE_BUY, SIDE_SELL
+
+SYMBOL = "AAA"
+MID_PRICE = 100.0
+
+
+def quote(bid_price: float, ask_price: float) -> Entity:
+    return Entity({"symbol": SYMBOL, "bid_price": bid_price, "ask_price": ask_price})
+
+
+def trade_update(event: str, qty: float, filled_qty: float, position_qty: float, side: str = SIDE_BUY) -> Entity:
+    return Entity({"event": event, "position_qty": position_qty,
+                   "order": {"id": "order-1", "symbol": SYMBOL, "side": side, "qty": str(qty), "filled_qty": str(filled_qty)}})
+
+
+@pytest.fixture
+def dataclient(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # Terminal trade updates are archived under the working folder
+    dataclient = DataClient(symbols={SYMBOL})
+    asyncio.run(dataclient.on_quote(quote(MID_PRICE - 0.01, MID_PRICE + 0.01)))
+    yield dataclient
+    dataclient._order_events.close()  # Before the working folder is restored
+
+
+def test_exposure_after_insert_partial_fill_cancel(dataclient):
+    risk_manager = RiskManager(dataclient, max_symbol_notional=2000.0)
+    risk_manager.start()
+    assert risk_manager.check_order(SYMBOL, MID_PRICE, 10, SIDE_BUY) is None
+    assert risk_manager.get_exposure()["gross notional"] == pytest.approx(1000.0)  # Reserved before the response
+    risk_manager.on_order_inserted(SYMBOL, 10, SIDE_BUY, "order-1")
+    assert risk_manager.get_exposure()["gross notional"] == pytest.approx(1000.0)
+    assert risk_manager.get_exposure()["open orders"] == 1
+
+    asyncio.run(dataclient.on_trade_update(trade_update("partial_fill", qty=10, filled_qty=4, position_qty=4)))
+    assert dataclient.get_position_by_symbol(SYMBOL) == 4
+    assert risk_manager.get_exposure()["gross notional"] == pytest.approx(1000.0)  # 4 held and 6 still open
+
+    asyncio.run(dataclient.on_trade_update(trade_update("canceled", qty=10, filled_qty=4, position_qty=4)))
+    exposure = risk_manager.get_exposure()
+    assert exposure["gross notional"] == pytest.approx(400.0)
+    assert exposure["net notional"] == pytest.approx(400.0)
+    assert exposure["open orders"] == 0
+    assert risk_manager.check_order(SYMBOL, MID_PRICE, 16, SIDE_BUY) is None  # The canceled quantity is released
+    assert risk_manager.check_order(SYMBOL, MID_PRICE, 1, SIDE_BUY) is not None
+
+
+def test_reduce_only_orders_pass_the_price_band(dataclient):
+    asyncio.run(dataclient.on_trade_update(trade_update("fill", qty=10, filled_qty=10, position_qty=10)))
+    risk_manager = RiskManager(dataclient, max_price_deviation=0.05)
+    risk_manager.start()
+    assert risk_manager.check_order(SYMBOL, MID_PRICE * 0.9, 10, SIDE_SELL) is None
+    assert risk_manager.check_order(SYMBOL, MID_PRICE * 0.9, 10, SIDE_SELL) is not None  # Would go short
+    assert risk_manager.check_order(SYMBOL, MID_PRICE * 1.1, 1, SIDE_BUY) is not None
@@ -0,0 +1,233 @@
+"""Walk-forward optimization of k, lookback and downsample on the local quote data.
+
+    python walkforward.py --symbols NVDA AMD INTC QCOM --start 2024-09-03 --end 2024-10-11 --k 1.5 2 2.5 --lookback 1 2 3 --downsample 5 10 30
+
+For every test day the pairs are selected and fitted on the preceding lookback trading days, like
+PairsTradeParamsCalculation does in the morning, and the test day is traded with the PairTrade rules
+for every k. Trading days are the days for which every symbol has a quote csv or a recorded tape in
+the data folder. The work runs in three cached stages on a process pool:
+
+    1. quotes of every (symbol, day) are loaded once and downsampled to every downsample of the grid
+    2. the daily regressions of every (pair, day, downsample) are computed once
+    3. every (test day, lookback, downsample) combines its daily regressions and trades all k
+
+Orders are assumed to fill at the mid price of the signal, positions are flat at the end of the day.
+"""
+import os
+import logging
+import argparse
+import warnings
+import datetime
+import numpy as np
+import pandas as pd
+from itertools import combinations
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Dict, Tuple
+from find_coint_pairs_and_params import PairsTradeParamsCalculation
+
+RESULT_COLUMNS = ["date", "k", "lookback", "downsample", "nr pairs", "pnl", "nr trades", "return"]
+
+_panels : Dict[Tuple[str, int], pd.DataFrame] = {}  # (date, downsample) -> mid prices of all symbols, set in every worker
+
+
+def _calculation(symbols: List[str], downsample: int, data_folder: str) -> PairsTradeParamsCalculation:
+    calculation = PairsTradeParamsCalculation(symbols=symbols, date=None, lookback=0, downsample=downsample)
+    calculation._data_folder_name = data_folder
+    return calculation
+
+
+def _init_worker(panels: Optional[Dict[Tuple[str, int], pd.DataFrame]]) -> None:
+    global _panels
+    logging.getLogger().setLevel(logging.WARNING)
+    warnings.simplefilter("ignore")
+    if panels is not None:
+        _panels = panels
+
+
+def trading_days(data_folder: str, symbols: List[str]) -> List[str]:
+    """Days (YYYYMMDD) with quote data of every symbol."""
+    days = None
+    for symbol in symbols:
+        symbol_days = set()
+        for filename in os.listdir(data_folder):
+            for suffix in ("_quote.csv", "_quote.bin"):
+                if filename.startswith(f"{symbol}_") and filename.endswith(suffix):
+                    symbol_days.add(filename[len(symbol) + 1:-len(suffix)])
+        days = symbol_days if days is None else days & symbol_days
+    return sorted(days or [])
+
+
+def _load_mid_prices(task: tuple) -> Tuple[str, str, Dict[int, pd.Series]]:
+    symbol, date, downsamples, symbols, data_folder = task
+    calculation = _calculation(symbols, downsamples[0], data_folder)
+    quote_data = calculation.load_quote_data(symbol=symbol, date=date)
+    return symbol, date, {downsample: calculation.calculate_midprice_and_downsample(quote_data=quote_data.copy(), downsample=downsample)
+                          for downsample in downsamples}
+
+
+def _daily_stats(task: tuple) -> Tuple[str, int, Dict[Tuple[str, str], Optional[dict]]]:
+    date, downsample, pairs, symbols, data_folder = task
+    price_data = _panels[(date, downsample)]
+    calculation = _calculation(symbols, downsample, data_folder)
+    stats = {}
+    for asset1, asset2 in pairs:
+        try:
+            stats[(asset1, asset2)] = calculation.cointegration_stats_by_date(price_data, asset1, asset2)
+        except Exception as e:
+            logging.warning(f"Regression of {asset1}-{asset2} on {date} at ds{downsample} failed: {e}")
+            stats[(asset1, asset2)] = None
+    return date, downsample, stats
+
+
+def simulate_pair(asset1_prices: np.ndarray, asset2_prices: np.ndarray, hedge_ratio: float, const: float, downsample: int, k: float,
+                  capital: float) -> Tuple[float, int]:
+    """Trade one day of one pair with the PairTrade rules. Returns the pnl and the number of position changes."""
+    window = int(1200 / downsample)
+    if len(asset1_prices) <= window:
+        return 0.0, 0
+    spread = pd.Series(asset2_prices - (hedge_ratio * asset1_prices + const))
+    rolling_mean = spread.rolling(window).mean().to_numpy()
+    rolling_std = spread.rolling(window).std(ddof=0).to_numpy()  # np.std, as in PairTrade._calculate_pertb
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pertb = (spread.to_numpy() - rolling_mean + k * rolling_std) / (2 * k * rolling_std)
+    asset2_max_position = capital / (hedge_ratio * asset1_prices[0] + asset2_prices[0])
+    asset1_max_position = round(asset2_max_position * hedge_ratio)
+    asset2_max_position = round(asset2_max_position)
+
+    spread_positions = np.zeros(len(spread))
+    spread_position = 0
+    nr_trades = 0
+    for t in range(window, len(spread)):
+        previous, current = pertb[t - 1], pertb[t]
+        if spread_position == 0:
+            if current < 0:
+                spread_position = 1
+                nr_trades += 1
+            elif current > 1:
+                spread_position = -1
+                nr_trades += 1
+        elif (spread_position == 1) and (previous < 0.5) and (current >= 0.5):
+            spread_position = 0
+            nr_trades += 1
+        elif (spread_position == -1) and (previous > 0.5) and (current <= 0.5):
+            spread_position = 0
+            nr_trades += 1
+        spread_positions[t] = spread_position
+    # Long the spread is short asset 1 and long asset 2, the position is held from t to t + 1
+    pnl = np.sum(spread_positions[:-1] * (asset2_max_position * np.diff(asset2_prices) - asset1_max_position * np.diff(asset1_prices)))
+    return float(pnl), nr_trades
+
+
+def _evaluate(task: tuple) -> List[dict]:
+    test_date, formation_dates, lookback, downsample, ks, total_capital, stats_by_date, symbols, data_folder = task
+    calculation = _calculation(symbols, downsample, data_folder)
+    coint_pairs = []
+    for pair in stats_by_date[0].keys():
+        pair_stats = [stats[pair] for stats in stats_by_date]
+        if any(stats is None for stats in pair_stats):
+            continue
+        is_coint, coint_result = calculation.combine_cointegration_stats(pair_stats, pair[0], pair[1])
+        if is_coint:
+            coint_pairs.append(coint_result)
+    calculation._cointPairsParams = coint_pairs
+    calculation.find_largest_non_repeating_pairs()
+    selected_pairs = calculation._cointPairsParams_no_repeat
+
+    price_data = _panels[(test_date, downsample)]
+    rows = []
+    for k in ks:
+        pnl = 0.0
+        nr_trades = 0
+        for pair in selected_pairs:
+            pair_pnl, pair_nr_trades = simulate_pair(price_data[pair["asset 1"]].to_numpy(), price_data[pair["asset 2"]].to_numpy(), pair["hedge ratio"],
+                                                     pair["constant"], downsample, k, round(total_capital / len(selected_pairs)))
+            pnl += pair_pnl
+            nr_trades += pair_nr_trades
+        rows.append({"date": test_date, "k": k, "lookback": lookback, "downsample": downsample, "nr pairs": len(selected_pairs),
+                     "pnl": pnl, "nr trades": nr_trades, "return": pnl / total_capital})
+    return rows
+
+
+def summarize(results: pd.DataFrame) -> pd.DataFrame:
+    grouped = results.groupby(["k", "lookback", "downsample"])["return"]
+    summary = pd.DataFrame({"nr days": grouped.size(),
+                            "total pnl": results.groupby(["k", "lookback", "downsample"])["pnl"].sum(),
+                            "mean daily return": grouped.mean(),
+                            "std daily return": grouped.std(ddof=0),
+                            "hit rate": grouped.apply(lambda returns: (returns > 0).mean())})
+    summary["sharpe"] = np.sqrt(252) * summary["mean daily return"] / summary["std daily return"].replace(0, np.nan)
+    return summary.sort_values("sharpe", ascending=False)
+
+
+def walk_forward(symbols: List[str], start: str, end: str, ks: List[float], lookbacks: List[int], downsamples: List[int],
+                 total_capital: float = 10000, data_folder: str = "data", nr_workers: Optional[int] = None) -> pd.DataFrame:
+    """start and end as YYYY-MM-DD. Returns one row per (test day, k, lookback, downsample)."""
+    days = trading_days(data_folder, symbols)
+    start = start.replace("-", "")
+    end = end.replace("-", "")
+    test_days = [(i, day) for i, day in enumerate(days) if (start <= day <= end) and (i >= min(lookbacks))]
+    if len(test_days) == 0:
+        logging.warning(f"No test days between {start} and {end} with enough formation days in {data_folder}")
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    needed_days = sorted({days[j] for i, _ in test_days for j in range(max(0, i - max(lookbacks)), i + 1)})
+    pairs = list(combinations(symbols, 2))
+    logging.info(f"Walk-forward over {len(test_days)} test days, {len(ks) * len(lookbacks) * len(downsamples)} configurations, {len(pairs)} pairs")
+
+    with ProcessPoolExecutor(max_workers=nr_workers, initializer=_init_worker, initargs=(None,)) as executor:
+        mid_prices = defaultdict(dict)
+        for symbol, date, mids_by_downsample in executor.map(_load_mid_prices, [(symbol, date, downsamples, symbols, data_folder) for symbol in symbols for date in needed_days]):
+            for downsample, mids in mids_by_downsample.items():
+                mid_prices[(date, downsample)][symbol] = mids
+    panels = {key: pd.DataFrame(mids).ffill().bfill() for key, mids in mid_prices.items()}  # Filled within the day
+    logging.info(f"Stage 1 done: {len(panels)} mid price panels")
+
+    with ProcessPoolExecutor(max_workers=nr_workers, initializer=_init_worker, initargs=(panels,)) as executor:
+        stats = {}
+        for date, downsample, stats_by_pair in executor.map(_daily_stats, [(date, downsample, pairs, symbols, data_folder) for date in needed_days for downsample in downsamples]):
+            stats[(date, downsample)] = stats_by_pair
+        logging.info(f"Stage 2 done: {len(stats) * len(pairs)} daily regressions")
+
+        tasks = []
+        for i, test_date in test_days:
+            for lookback in lookbacks:
+                if i < lookback:
+                    continue
+                formation_dates = days[i - lookback:i]
+                for downsample in downsamples:
+                    tasks.append((test_date, formation_dates, lookback, downsample, ks, total_capital,
+                                  [stats[(date, downsample)] for date in formation_dates], symbols, data_folder))
+        rows = [row for task_rows in executor.map(_evaluate, tasks) for row in task_rows]
+    logging.info(f"Stage 3 done: {len(rows)} results")
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Walk-forward optimization of k, lookback and downsample")
+    parser.add_argument("--symbols", nargs="+", default=["NVDA", "TSM", "AMD", "ASML", "QCOM", "INTC"])
+    parser.add_argument("--start", required=True, help="first test day, YYYY-MM-DD")
+    parser.add_argument("--end", default=datetime.datetime.today().date().strftime('%Y-%m-%d'), help="last test day, YYYY-MM-DD")
+    parser.add_argument("--k", nargs="+", type=float, default=[1.5, 2, 2.5])
+    parser.add_argument("--lookback", nargs="+", type=int, default=[1, 2, 3])
+    parser.add_argument("--downsample", nargs="+", type=int, default=[5, 10, 30])
+    parser.add_argument("--capital", type=float, default=10000)
+    parser.add_argument("--data-folder", default="data")
+    parser.add_argument("--output-folder", default="walkforward")
+    parser.add_argument("--workers", type=int, default=None, help="processes, default is the number of cpus")
+    args = parser.parse_args()
+
+    results = walk_forward(symbols=args.symbols, start=args.start, end=args.end, ks=args.k, lookbacks=args.lookback, downsamples=args.downsample,
+                           total_capital=args.capital, data_folder=args.data_folder, nr_workers=args.workers)
+    if len(results) == 0:
+        return
+    os.makedirs(args.output_folder, exist_ok=True)
+    name = f"{args.start.replace('-', '')}_{args.end.replace('-', '')}"
+    results.to_csv(os.path.join(args.output_folder, f"results_{name}.csv"), index=False)
+    summary = summarize(results)
+    summary.to_csv(os.path.join(args.output_folder, f"summary_{name}.csv"))
+    logging.info(f"Saved results and summary to {args.output_folder}")
+    print(summary.head(20).to_string())
+
+
+if __name__ == "__main__":
+    main()